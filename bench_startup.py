@@ -0,0 +1,94 @@
+"""
+Misura il tempo di avvio a freddo degli entry point, dai sorgenti e dallo
+zipapp se presente:
+
+  - import del modulo in un processo nuovo;
+  - tick a vuoto del cron: createOrders3 eseguito per intero, in una cartella
+    temporanea con il mese corrente già completato in orders_state.json (esce
+    subito, senza DB né API). È il caso più frequente in produzione.
+
+Uso:
+  python bench_startup.py [--runs 20]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import tempfile
+import subprocess
+from datetime import date
+
+from build_zipapp import ENTRY_POINTS, TARGET
+
+SNIPPET = (
+    "import sys, time; sys.path.insert(0, {path!r}); "
+    "t0 = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - t0)"
+)
+
+
+def measure(module, path, runs):
+    """Ritorna (mediana, minimo) in millisecondi su `runs` processi nuovi."""
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", SNIPPET.format(path=path, module=module)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        samples.append(float(out.strip().splitlines()[-1]) * 1000)
+    return statistics.median(samples), min(samples)
+
+
+def noop_tick_command(label, path):
+    if label == "zipapp":
+        return [sys.executable, path, "createOrders3"]
+    return [sys.executable, os.path.join(path, "createOrders3.py")]
+
+
+def measure_noop_tick(command, runs):
+    """Durata (mediana, minimo) in ms dell'intero processo createOrders3 con il mese già completato."""
+    env = dict(os.environ)
+    env.setdefault("COMPANY_ID", "0")
+    env.pop("START_INDEX", None)   # forzerebbe la ripartenza e quindi un run vero
+    samples = []
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, "orders_state.json"), "w", encoding="utf-8") as f:
+            json.dump({"next_index": 0, "completed_month": date.today().strftime("%Y-%m")}, f)
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            result = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+            samples.append((time.perf_counter() - t0) * 1000)
+            if result.returncode != 0 or "già generati" not in result.stdout:
+                raise RuntimeError(f"Il tick a vuoto non è uscito come previsto:\n{result.stdout}{result.stderr}")
+    return statistics.median(samples), min(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del tempo di avvio degli script")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    sources = [("sorgenti", here)]
+    if os.path.exists(TARGET):
+        sources.append(("zipapp", os.path.abspath(TARGET)))
+    else:
+        print(f"{TARGET} non trovato: eseguo solo il benchmark dei sorgenti (python build_zipapp.py per crearlo)")
+
+    print(f"{'modulo':<22}{'origine':<10}{'mediana ms':>12}{'min ms':>10}")
+    for module in ENTRY_POINTS:
+        for label, path in sources:
+            median, best = measure(module, path, args.runs)
+            print(f"{module:<22}{label:<10}{median:>12.1f}{best:>10.1f}")
+
+    print()
+    print(f"{'tick a vuoto':<22}{'origine':<10}{'mediana ms':>12}{'min ms':>10}")
+    for label, path in sources:
+        median, best = measure_noop_tick(noop_tick_command(label, path), args.runs)
+        print(f"{'createOrders3':<22}{label:<10}{median:>12.1f}{best:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Budget di un run: tempo massimo e chiamate API massime per invocazione.
+
+Al posto di un BATCH_SIZE fisso i job elaborano elementi finché il prossimo
+ci sta nel budget rimasto, stimandone il costo dalla latenza osservata:
+all'avvio quella dei run precedenti (runhistory.py), poi quella misurata nel
+run corrente. Nei giorni tranquilli un run fa più lavoro, in quelli con molte
+chiamate (o API lente) si ferma prima, sempre con il checkpoint salvato.
+
+  FIC_RUN_MAX_SECONDS   durata massima del run (default 240 s, sotto l'intervallo del cron)
+  FIC_RUN_MAX_CALLS     chiamate API massime del run (default 250, sotto la quota FIC di 300 ogni 5 minuti)
+"""
+import os
+import time
+from contextlib import contextmanager
+
+import ratelimit
+
+RUN_MAX_SECONDS = float(os.getenv("FIC_RUN_MAX_SECONDS", "240"))
+RUN_MAX_CALLS = int(os.getenv("FIC_RUN_MAX_CALLS", "250"))
+DEFAULT_CALL_SECONDS = 1.0    # stima iniziale senza storico: il rate limiter concede ~1 chiamata al secondo
+LATENCY_SMOOTHING = 0.2       # peso dell'ultima misura nella media mobile della latenza
+
+# budget del processo corrente (come ratelimit.STATS)
+BUDGET = {
+    "started": time.monotonic(), "calls_at_start": 0,
+    "max_seconds": RUN_MAX_SECONDS, "max_calls": RUN_MAX_CALLS,
+    "call_seconds": DEFAULT_CALL_SECONDS, "items": 0, "item_calls": 0, "item_seconds": 0.0,
+    "exhausted": None,
+}
+
+
+def start_budget(job, max_seconds=None, max_calls=None):
+    """Avvia il budget del run; la latenza iniziale viene dai run precedenti del job."""
+    from runhistory import recent_call_seconds
+
+    BUDGET.update({
+        "started": time.monotonic(), "calls_at_start": ratelimit.STATS["calls"],
+        "max_seconds": RUN_MAX_SECONDS if max_seconds is None else max_seconds,
+        "max_calls": RUN_MAX_CALLS if max_calls is None else max_calls,
+        "call_seconds": recent_call_seconds(job) or DEFAULT_CALL_SECONDS,
+        "items": 0, "item_calls": 0, "item_seconds": 0.0, "exhausted": None,
+    })
+
+
+def budget_left():
+    """(secondi, chiamate API) ancora disponibili."""
+    seconds = BUDGET["max_seconds"] - (time.monotonic() - BUDGET["started"])
+    calls = BUDGET["max_calls"] - (ratelimit.STATS["calls"] - BUDGET["calls_at_start"])
+    return seconds, calls
+
+
+def _item_cost():
+    """Costo stimato di un elemento: (chiamate, secondi)."""
+    if not BUDGET["items"]:
+        return 1.0, BUDGET["call_seconds"]
+    calls = BUDGET["item_calls"] / BUDGET["items"]
+    if calls:
+        return calls, calls * BUDGET["call_seconds"]
+    # finora nessuna chiamata (es. solo clienti invariati): conta solo il tempo medio
+    return 0.0, BUDGET["item_seconds"] / BUDGET["items"]
+
+
+def items_that_fit():
+    """Quanti elementi stanno nel budget rimasto secondo la latenza osservata (dimensione del prossimo batch)."""
+    seconds, calls = budget_left()
+    if seconds <= 0 or calls <= 0:
+        return 0
+    item_calls, item_seconds = _item_cost()
+    fit = [seconds / item_seconds] if item_seconds > 0 else []
+    if item_calls > 0:
+        fit.append(calls / item_calls)
+    return int(min(fit)) if fit else calls
+
+
+def budget_allows():
+    """True se il prossimo elemento sta nel budget; altrimenti registra il motivo dello stop."""
+    seconds, calls = budget_left()
+    item_calls, item_seconds = _item_cost()
+    if calls < max(1, round(item_calls)):
+        BUDGET["exhausted"] = "chiamate API"
+    elif seconds < item_seconds:
+        BUDGET["exhausted"] = "tempo"
+    else:
+        return True
+    return False
+
+
+@contextmanager
+def budget_item():
+    """Misura chiamate API e tempo di un elemento elaborato e aggiorna la latenza per chiamata."""
+    calls_before = ratelimit.STATS["calls"]
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - t0
+        calls = ratelimit.STATS["calls"] - calls_before
+        BUDGET["items"] += 1
+        BUDGET["item_calls"] += calls
+        BUDGET["item_seconds"] += seconds
+        if calls:
+            BUDGET["call_seconds"] += LATENCY_SMOOTHING * (seconds / calls - BUDGET["call_seconds"])
+
+
+def budget_summary():
+    seconds, calls = budget_left()
+    used_seconds = BUDGET["max_seconds"] - seconds
+    used_calls = BUDGET["max_calls"] - calls
+    text = (f"budget usato: {used_seconds:.0f}/{BUDGET['max_seconds']:.0f}s, {used_calls}/{BUDGET['max_calls']} chiamate, "
+            f"{BUDGET['items']} elementi, latenza {BUDGET['call_seconds']:.2f}s/chiamata")
+    if BUDGET["exhausted"]:
+        text += f"; fermato per esaurimento {BUDGET['exhausted']}"
+    return text
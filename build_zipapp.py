@@ -0,0 +1,83 @@
+"""
+Crea dist/fattureapp.pyz: un unico file eseguibile con il bytecode precompilato
+di tutti i moduli del progetto (niente compilazione al primo avvio del cron).
+
+Uso:
+  python build_zipapp.py
+  python dist/fattureapp.pyz createOrders3 [--backfill 2026-01 2026-03]
+  python dist/fattureapp.pyz syncAnagrafiche3
+
+Le dipendenze (SDK FIC, mysql-connector, python-dotenv) restano installate
+nell'ambiente. Il .pyc va generato con la stessa versione di Python del cron.
+"""
+import os
+import sys
+import shutil
+import zipapp
+import py_compile
+import tempfile
+
+DIST_DIR = "dist"
+TARGET = os.path.join(DIST_DIR, "fattureapp.pyz")
+
+# script eseguibili come `python fattureapp.pyz <nome> [argomenti]`
+ENTRY_POINTS = [
+    "createOrders3",
+    "syncAnagrafiche3",
+    "orderSingleCustomer",
+    "reconcileOrders",
+    "refreshCache",
+    "scheduler",
+    "runhistory",
+    "webhookReceiver",
+    "rollbackOrders",
+    "docnumbers",
+]
+
+# file di progetto da non includere nell'archivio
+EXCLUDE = {"build_zipapp.py", "bench_startup.py", "generatoken.py"}
+
+MAIN_TEMPLATE = '''import sys
+import runpy
+
+ENTRY_POINTS = {entry_points!r}
+
+if len(sys.argv) < 2 or sys.argv[1] not in ENTRY_POINTS:
+    print("Uso: python fattureapp.pyz <" + "|".join(ENTRY_POINTS) + "> [argomenti]")
+    raise SystemExit(2)
+
+name = sys.argv.pop(1)
+sys.argv[0] = name
+runpy.run_module(name, run_name="__main__", alter_sys=True)
+'''
+
+
+def project_modules():
+    here = os.path.dirname(os.path.abspath(__file__))
+    return sorted(
+        os.path.join(here, f) for f in os.listdir(here)
+        if f.endswith(".py") and f not in EXCLUDE
+    )
+
+
+def build():
+    staging = tempfile.mkdtemp(prefix="fattureapp-")
+    try:
+        for src in project_modules():
+            name = os.path.splitext(os.path.basename(src))[0]
+            # .pyc "sourceless" accanto al nome del modulo: zipimport lo carica direttamente
+            py_compile.compile(src, cfile=os.path.join(staging, name + ".pyc"), doraise=True)
+
+        with open(os.path.join(staging, "__main__.py"), "w", encoding="utf-8") as f:
+            f.write(MAIN_TEMPLATE.format(entry_points=ENTRY_POINTS))
+
+        os.makedirs(DIST_DIR, exist_ok=True)
+        zipapp.create_archive(staging, TARGET, interpreter="/usr/bin/env python3")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    print(f"Creato {TARGET} ({os.path.getsize(TARGET)} byte, Python {sys.version.split()[0]})")
+
+
+if __name__ == "__main__":
+    build()
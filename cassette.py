@@ -0,0 +1,245 @@
+"""
+Registrazione e replay del traffico HTTP verso Fatture in Cloud.
+
+  FIC_CASSETTE_RECORD=run.cassette.gz python createOrders3.py
+  FIC_CASSETTE_REPLAY=run.cassette.gz FIC_REPLAY_SPEED=10 python createOrders3.py
+
+In registrazione ogni richiesta/risposta viene salvata (JSON a righe, gzip) con
+tempi originali; i token vengono oscurati e i dati dei clienti (ragione
+sociale, P.IVA, codice fiscale, indirizzi, email, telefoni) pseudonimizzati.
+Lo pseudonimo dipende dal valore normalizzato (fieldnorm.py), quindi valori
+uguali per la sync restano uguali anche pseudonimizzati.
+
+In replay le risposte arrivano dalla cassetta senza chiamate di rete e senza
+rate limiter, ciascuna all'istante registrato rispetto alla prima richiesta
+(pause fra le chiamate e durate) diviso per FIC_REPLAY_SPEED (0 = nessuna
+attesa). Le query al DB vtiger non fanno parte della cassetta: in replay le
+loro righe passano per replay_scrub(), che applica gli stessi pseudonimi, così
+P.IVA e anagrafiche vtiger ritrovano i clienti FIC della cassetta.
+"""
+import os
+import re
+import gzip
+import hashlib
+import json
+import time
+import atexit
+import threading
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+CASSETTE_RECORD = os.getenv("FIC_CASSETTE_RECORD")
+CASSETTE_REPLAY = os.getenv("FIC_CASSETTE_REPLAY")
+REPLAY_SPEED = float(os.getenv("FIC_REPLAY_SPEED", "1"))
+
+# header di risposta utili al replay (gli altri non servono all'SDK)
+KEPT_HEADERS = ("Content-Type", "Retry-After", "X-RateLimit-Remaining")
+SECRET_QUERY_PARAMS = {"access_token", "client_secret", "code", "refresh_token"}
+SCRUB_PATTERNS = [
+    (re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}"), "scrubbed@example.invalid"),
+    (re.compile(r'("(?:phone|fax)"\s*:\s*")[^"]*(")'), r"\g<1>000000000\g<2>"),
+]
+
+
+def _scrub_url(url):
+    parts = urlsplit(url)
+    query = [(k, "SCRUBBED" if k in SECRET_QUERY_PARAMS else v) for k, v in parse_qsl(parts.query, keep_blank_values=True)]
+    return parts._replace(query=urlencode(query)).geturl()
+
+
+# campi con dati personali nei corpi JSON: sostituiti con uno pseudonimo stabile
+# (stesso valore -> stesso pseudonimo, così richieste e risposte restano coerenti)
+PII_FIELDS = {
+    "vat_number", "tax_code", "address_street", "address_postal_code", "address_zip", "address_city",
+    "address_province", "address_extra", "email", "certified_email", "phone", "fax", "bank_iban",
+}
+# "name" e simili sono dati personali solo negli oggetti cliente/entità
+# (non nei metodi di pagamento, nelle aliquote o nelle righe d'ordine)
+PII_NAME_FIELDS = {"name", "first_name", "last_name", "contact_person"}
+PII_OBJECT_MARKERS = {"vat_number", "tax_code", "address_street"}
+# il CAP è address_zip in vtiger e in cache, address_postal_code nel Client FIC: stesso pseudonimo
+PII_FIELD_ALIASES = {"address_postal_code": "address_zip"}
+
+
+def _pseudonym(field, value):
+    from fieldnorm import normalized
+
+    field = PII_FIELD_ALIASES.get(field, field)
+    value = normalized(field, value) or value
+    digest = hashlib.sha256(f"{field}:{value}".encode("utf-8")).hexdigest()
+    if field in ("vat_number", "tax_code") and value.isdigit():
+        # resta numerico e della stessa lunghezza (P.IVA 11 cifre)
+        return str(int(digest, 16))[:len(value)].zfill(len(value))
+    if field in ("email", "certified_email"):
+        return f"{digest[:10]}@example.invalid"
+    if field in ("phone", "fax"):
+        return "000000000"
+    return f"{field}-{digest[:8]}"
+
+
+def _scrub_json(value, pii_object=False):
+    if isinstance(value, dict):
+        pii_object = pii_object or any(k in value for k in PII_OBJECT_MARKERS)
+        scrubbed = {}
+        for k, v in value.items():
+            sensitive = k in PII_FIELDS or (pii_object and k in PII_NAME_FIELDS)
+            if sensitive and isinstance(v, str) and v:
+                scrubbed[k] = _pseudonym(k, v)
+            else:
+                # "entity" di un documento è sempre un cliente
+                scrubbed[k] = _scrub_json(v, k == "entity")
+        return scrubbed
+    if isinstance(value, list):
+        return [_scrub_json(v, pii_object) for v in value]
+    return value
+
+
+def scrub_record(record):
+    """Pseudonimizza un record con dati cliente (es. una riga vtiger) come i corpi della cassetta."""
+    return _scrub_json(dict(record), pii_object=True)
+
+
+def replay_scrub(rows):
+    """Righe vtiger da usare nel run corrente: pseudonimizzate in replay, invariate altrimenti."""
+    if not replay_active():
+        return rows
+    return [scrub_record(r) for r in rows]
+
+
+def _scrub_text(text):
+    if not text:
+        return text
+    try:
+        return json.dumps(_scrub_json(json.loads(text)), ensure_ascii=False)
+    except ValueError:
+        pass
+    # corpo non JSON: almeno email e telefoni
+    for pattern, replacement in SCRUB_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _match_key(method, url):
+    parts = urlsplit(_scrub_url(url))
+    return f"{method.upper()} {parts.path}?{parts.query}"
+
+
+class RecordingPoolManager:
+    """Avvolge il PoolManager urllib3 reale e registra ogni scambio."""
+
+    def __init__(self, pool_manager, path):
+        self._pool_manager = pool_manager
+        self._path = path
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._entries = []
+        atexit.register(self.save)
+
+    def __getattr__(self, name):
+        # pools, clear(), ecc. restano quelli del PoolManager reale
+        return getattr(self._pool_manager, name)
+
+    def request(self, method, url, body=None, **kwargs):
+        t0 = time.perf_counter()
+        resp = self._pool_manager.request(method, url, body=body, **kwargs)
+        data = resp.data  # legge e conserva il corpo: l'SDK lo ritrova in resp.data
+        elapsed = time.perf_counter() - t0
+        if isinstance(body, bytes):
+            body = body.decode("utf-8", "replace")
+        entry = {
+            "t": round(t0 - self._start, 4),
+            "d": round(elapsed, 4),
+            "m": method.upper(),
+            "u": _scrub_url(url),
+            "rq": _scrub_text(body) if isinstance(body, str) else None,
+            "s": resp.status,
+            "r": resp.reason,
+            "h": {h: resp.headers[h] for h in KEPT_HEADERS if h in resp.headers},
+            "b": _scrub_text(data.decode("utf-8", "replace")) if data else "",
+        }
+        with self._lock:
+            self._entries.append(entry)
+        return resp
+
+    def save(self):
+        with self._lock:
+            entries = list(self._entries)
+        with gzip.open(self._path, "wt", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+class ReplayResponse:
+    """Risposta minima compatibile con quello che l'SDK legge da urllib3."""
+
+    def __init__(self, entry):
+        self.status = entry["s"]
+        self.reason = entry.get("r") or ""
+        self.data = entry["b"].encode("utf-8")
+        self.headers = dict(entry.get("h") or {})
+
+    def getheaders(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, *args, **kwargs):
+        return self.data
+
+    def release_conn(self):
+        pass
+
+
+class ReplayPoolManager:
+    """Serve le risposte dalla cassetta, in ordine per metodo+URL, con i tempi registrati."""
+
+    def __init__(self, path, speed=REPLAY_SPEED):
+        self.speed = speed
+        self.pools = {}
+        self._lock = threading.Lock()
+        self._anchor = None   # istante del replay che corrisponde a t=0 della registrazione
+        self._queues = {}
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._queues.setdefault(_match_key(entry["m"], entry["u"]), []).append(entry)
+
+    def request(self, method, url, body=None, **kwargs):
+        key = _match_key(method, url)
+        with self._lock:
+            queue = self._queues.get(key)
+            if not queue:
+                raise LookupError(f"Cassetta: nessuna risposta registrata per {key}")
+            # l'ultima risposta resta disponibile per le richieste ripetute in più
+            entry = queue.pop(0) if len(queue) > 1 else queue[0]
+            repeated = entry.get("served", False)
+            entry["served"] = True
+            if self._anchor is None:
+                # la prima richiesta non aspetta l'avvio del run registrato (DB, cache, ...)
+                self._anchor = time.perf_counter() - entry["t"] / self.speed if self.speed > 0 else 0
+        if self.speed > 0:
+            if repeated:
+                delay = entry["d"] / self.speed
+            else:
+                # risposta all'istante registrato (t + d): riproduce pause, attese del limiter e durate
+                delay = self._anchor + (entry["t"] + entry["d"]) / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        return ReplayResponse(entry)
+
+    def clear(self):
+        pass
+
+
+def cassette_pool_manager(real_pool_manager):
+    """PoolManager da usare secondo le variabili d'ambiente, o None se non serve."""
+    if CASSETTE_REPLAY:
+        return ReplayPoolManager(CASSETTE_REPLAY)
+    if CASSETTE_RECORD:
+        return RecordingPoolManager(real_pool_manager, CASSETTE_RECORD)
+    return None
+
+
+def replay_active():
+    return bool(CASSETTE_REPLAY)
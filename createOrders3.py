@@ -1,54 +1,95 @@
 import os
-import json
 from dotenv import load_dotenv
-import fattureincloud_python_sdk
-from globalutils import log, load_all_fic_clients, end_of_month
-from fattureincloud_python_sdk.api import issued_documents_api
-from fattureincloud_python_sdk.models import (
-    Entity,
-    IssuedDocument,
-    IssuedDocumentType,
-    Currency,
-    Language,
-    IssuedDocumentItemsListItem,
-    CreateIssuedDocumentRequest,
-    GetNewIssuedDocumentTotalsRequest,
-    IssuedDocumentOptions,
-    IssuedDocumentPaymentsListItem,
-    VatType,   # <-- per impostare l'aliquota 22%
-)
-# aggiungi in alto tra gli import
-from fattureincloud_python_sdk.rest import ApiException
+from globalutils import log, load_all_fic_clients, end_of_month, normalize_vat, run_startup_tasks, fic_api_client, clients_cache_fingerprint
 from dbconn import getdbconn
+from cassette import replay_scrub
+from refcache import get_refdata, find_ref, name_to_id, vat_type_id, DEFAULT_VAT_ID
+from orderwal import wal_append, wal_load, wal_done_keys, order_key, recover_inflight
+from deadletter import dlq_add, dlq_due, dlq_resolve, dlq_summary
+from transport import log_transport_stats
+from filelocks import read_json_locked, locked_json, run_lock, JobAlreadyRunning
+from profiler import add_profile_argument, enable_profiling, phase, timed, write_profile_report
+from runhistory import add_counts, note_batch, record_run
+from docnumbers import allocate_many, seed_numbers, mark_used
+from orderplan import write_plan, read_plan_header, iter_plan, order_from_plan, plan_is_current
+from budget import BUDGET, start_budget, budget_allows, budget_item, items_that_fit, budget_summary
 import time
+import itertools
 from datetime import datetime, timedelta, date
 
 
-configuration = fattureincloud_python_sdk.Configuration(
-    host="https://api-v2.fattureincloud.it"
-)
-configuration.access_token = os.getenv("ACCESS_TOKEN")
 company_id = int(os.getenv("COMPANY_ID"))   # ID azienda su FIC
 log_filename = f"orders-{datetime.now().strftime('%Y%m%d')}.log"
 
 
+MESI_VTIGER = [
+    "GENNAIO", "FEBBRAIO", "MARZO", "APRILE", "MAGGIO", "GIUGNO",
+    "LUGLIO", "AGOSTO", "SETTEMBRE", "OTTOBRE", "NOVEMBRE", "DICEMBRE"
+]
+
+
+def mese_su_vtiger(d):
+    """Etichetta del mese usata in vtiger (socf.cf_1252), es. '03-MARZO'."""
+    return f"{d.month:02d}-{MESI_VTIGER[d.month - 1]}"
+
+
 def mese_corrente_su_vtiger():
-    mesi = [
-        "GENNAIO", "FEBBRAIO", "MARZO", "APRILE", "MAGGIO", "GIUGNO",
-        "LUGLIO", "AGOSTO", "SETTEMBRE", "OTTOBRE", "NOVEMBRE", "DICEMBRE"
-    ]
-    oggi = date.today()
-    numero_mese = oggi.month
-    return f"{numero_mese:02d}-{mesi[numero_mese - 1]}"
+    return mese_su_vtiger(date.today())
+
+
+def month_range(month_from, month_to):
+    """Lista di date (primo del mese) da 'YYYY-MM' a 'YYYY-MM' inclusi."""
+    start = datetime.strptime(month_from, "%Y-%m").date()
+    stop = datetime.strptime(month_to, "%Y-%m").date()
+    if stop < start:
+        raise ValueError(f"Intervallo mesi non valido: {month_from} > {month_to}")
+    months = []
+    d = start
+    while d <= stop:
+        months.append(d)
+        d = date(d.year + d.month // 12, d.month % 12 + 1, 1)
+    # l'etichetta vtiger non contiene l'anno: oltre 12 mesi sarebbe ambigua
+    if len(months) > 12:
+        raise ValueError("Il backfill supporta al massimo 12 mesi per esecuzione")
+    return months
+
+
+# FROM/WHERE comune all'estrazione delle righe e al checksum del mese (placeholders: un %s per mese)
+ORDERS_FROM_WHERE = """
+    FROM 
+    vtiger_account va LEFT JOIN vtiger_accountscf vacf ON (va.accountid=vacf.accountid)
+    LEFT JOIN vtiger_crmentity vce ON (vce.crmid=va.accountid)
+    LEFT JOIN vtiger_salesorder so ON (so.accountid=va.accountid)
+    LEFT JOIN vtiger_crmentity vce2 ON (vce2.crmid=so.salesorderid)
+    LEFT JOIN vtiger_inventoryproductrel ipr ON (so.salesorderid=ipr.id)
+    LEFT JOIN vtiger_salesordercf socf ON (socf.salesorderid=so.salesorderid)
+    LEFT JOIN vtiger_service vs ON (vs.serviceid=ipr.productid)
+    LEFT JOIN vtiger_invoice_recurring_info vir ON (vir.salesorderid=so.salesorderid)
+    WHERE
+    vce.deleted=0
+    AND vce2.deleted=0
+    AND vacf.cf_878 IS NOT NULL 
+    AND LENGTH(vacf.cf_878) = 11 
+    AND va.account_type IN ("Ag. princ.","Ag. princ. collegata","Sub-A","SUB-E")
+    and socf.cf_1252 IN ({placeholders}) AND socf.cf_1254='SI'
+    AND vir.start_period<=NOW()  and vir.end_period > %s
+"""
 
-def get_orders_of_the_month():
-    month = mese_corrente_su_vtiger()
+
+def get_orders_of_months(months):
+    """
+    Estrae con una sola query le righe ordine di più mesi (cf_1252 IN (...)).
+    Ogni riga ha in più la colonna vtiger_month con l'etichetta del mese.
+    """
+    labels = [mese_su_vtiger(m) for m in months]
     connection = getdbconn()
     cursor = connection.cursor(dictionary=True)
-    endoflastyear = date(date.today().year - 1, 12, 31).strftime("%Y-%m-%d")
+    endoflastyear = date(min(m.year for m in months) - 1, 12, 31).strftime("%Y-%m-%d")
+    placeholders = ",".join(["%s"] * len(labels))
 
-    query = """
+    query = f"""
     SELECT 
+    socf.cf_1252 AS vtiger_month,
     vacf.cf_878 AS vat_number,
     vacf.cf_1963 AS default_payment_method,
     so.salesorderid,
@@ -61,31 +102,48 @@ def get_orders_of_the_month():
     ipr.listprice,
     COALESCE(ipr.discount_percent,0) AS discount,
     ipr.quantity * ipr.listprice * (100 - COALESCE(ipr.discount_percent,0))/100 AS net_price
-    FROM 
-    vtiger_account va LEFT JOIN vtiger_accountscf vacf ON (va.accountid=vacf.accountid)
-    LEFT JOIN vtiger_crmentity vce ON (vce.crmid=va.accountid)
-    LEFT JOIN vtiger_salesorder so ON (so.accountid=va.accountid)
-    LEFT JOIN vtiger_crmentity vce2 ON (vce2.crmid=so.salesorderid)
-    LEFT JOIN vtiger_inventoryproductrel ipr ON (so.salesorderid=ipr.id)
-    LEFT JOIN vtiger_salesordercf socf ON (socf.salesorderid=so.salesorderid)
-    LEFT JOIN vtiger_service vs ON (vs.serviceid=ipr.productid)
-    LEFT JOIN vtiger_invoice_recurring_info vir ON (vir.salesorderid=so.salesorderid)
-    WHERE
-    vce.deleted=0
-    AND vce2.deleted=0
-    AND vacf.cf_878 IS NOT NULL 
-    AND LENGTH(vacf.cf_878) = 11 
-    AND va.account_type IN ("Ag. princ.","Ag. princ. collegata","Sub-A","SUB-E")
-    and socf.cf_1252=%s AND socf.cf_1254='SI'
-    AND vir.start_period<=NOW()  and vir.end_period > %s 
-    ORDER BY so.salesorderid ASC,vat_number ASC , ipr.sequence_no ASC
+    {ORDERS_FROM_WHERE.format(placeholders=placeholders)}
+    ORDER BY socf.cf_1252 ASC, so.salesorderid ASC,vat_number ASC , ipr.sequence_no ASC
     """
-    cursor.execute(query, (month,endoflastyear))
+    cursor.execute(query, (*labels, endoflastyear))
     results = cursor.fetchall()
     cursor.close()
     connection.close()
-    return results
-        
+    return replay_scrub(results)
+
+
+def get_orders_checksums(months):
+    """
+    Checksum delle righe ordine di ogni mese, calcolato da MySQL sulle stesse
+    righe di get_orders_of_months: ritorna {etichetta vtiger: "righe:somma crc"}.
+    Una riga sola per mese invece di tutte le righe: serve a capire se il piano
+    ordini salvato (orderplan.py) è ancora valido.
+    """
+    labels = [mese_su_vtiger(m) for m in months]
+    connection = getdbconn()
+    cursor = connection.cursor(dictionary=True)
+    endoflastyear = date(min(m.year for m in months) - 1, 12, 31).strftime("%Y-%m-%d")
+    placeholders = ",".join(["%s"] * len(labels))
+
+    query = f"""
+    SELECT
+    socf.cf_1252 AS vtiger_month,
+    COUNT(*) AS row_count,
+    SUM(CRC32(CONCAT_WS('|', so.salesorderid, vacf.cf_878, vacf.cf_1963, vs.service_no, ipr.sequence_no,
+        vs.servicename, ipr.`comment`, ipr.quantity, ipr.listprice, ipr.discount_percent))) AS row_crc
+    {ORDERS_FROM_WHERE.format(placeholders=placeholders)}
+    GROUP BY socf.cf_1252
+    """
+    cursor.execute(query, (*labels, endoflastyear))
+    results = cursor.fetchall()
+    cursor.close()
+    connection.close()
+    return {r["vtiger_month"]: f"{r['row_count']}:{int(r['row_crc'] or 0)}" for r in results}
+
+
+def get_orders_of_the_month():
+    return get_orders_of_months([date.today()])
+
 def get_orders_of_the_customer(vatid):
     month = mese_corrente_su_vtiger()
     connection = getdbconn()
@@ -130,27 +188,48 @@ def get_orders_of_the_customer(vatid):
     results = cursor.fetchall()
     cursor.close()
     connection.close()
-    return results
+    return replay_scrub(results)
 
         
 def  get_payment_method_id(api_client,company_id,payment_method):
-    info_api = fattureincloud_python_sdk.InfoApi(api_client)
+    # dalla cache dei dati di riferimento: nessuna chiamata API a cache calda
     try:
-        pm_resp = info_api.list_payment_methods(company_id)
+        items = get_refdata("payment_methods", api_client, company_id, log_filename)
     except Exception as e:
         log(f"Il metodo list_payment_methods non funziona dettagli: {e}",log_filename,"error")
+        return None
 
-    name_to_id = {m.name: m.id for m in pm_resp.data}
-    payment_method_id = name_to_id.get(payment_method)
-    
-    return payment_method_id 
+    item = find_ref("payment_methods", items, name=payment_method)
+    return item["id"] if item else None
 
 
 # --- CONFIG BATCH/STATE ---
-BATCH_SIZE = 30
+# la dimensione del batch non è più fissa: la decide il budget del run (budget.py)
 STATE_FILE = "orders_state.json"
 
-def _load_state():
+def _read_state_file():
+    try:
+        return read_json_locked(STATE_FILE, {}) or {}
+    except Exception:
+        return {}
+
+
+def _load_state(month=None, data=None):
+    """
+    Stato del run. Senza `month` è lo stato del mese corrente (campi top-level);
+    con `month` ('YYYY-MM') è lo stato di quel mese in modalità backfill.
+    `data` è il contenuto del file già letto (es. sotto lock in _save_state).
+    """
+    if data is None:
+        data = _read_state_file()
+
+    if month is not None:
+        data = data.get("months", {}).get(month, {})
+        return {
+            "next_index": int(data.get("next_index", 0)),
+            "completed_month": month if data.get("completed") else None
+        }
+
     env = os.getenv("START_INDEX")
     if env is not None:
         try:
@@ -161,16 +240,14 @@ def _load_state():
         except ValueError:
             pass
 
-    try:
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return {
-                    "next_index": int(data.get("next_index", 0)),
-                    "completed_month": data.get("completed_month")
-                }
-    except Exception:
-        pass
+    if data:
+        try:
+            return {
+                "next_index": int(data.get("next_index", 0)),
+                "completed_month": data.get("completed_month")
+            }
+        except Exception:
+            pass
 
     return {
         "next_index": 0,
@@ -178,200 +255,276 @@ def _load_state():
     }
 
 
-def _save_state(next_index=None, completed_month=None):
-    state = _load_state()
-
-    if next_index is not None:
-        state["next_index"] = int(next_index)
-
-    if completed_month is not None:
-        state["completed_month"] = completed_month
-
+def _save_state(next_index=None, completed_month=None, month=None):
+    # read-modify-write sotto lock esclusivo, riscrittura atomica del file
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f)
-    except Exception:
-        pass
-
-
-def _reset_state():
-    try:
-        if os.path.exists(STATE_FILE):
-            os.remove(STATE_FILE)
-    except Exception:
-        pass
-
-def _load_checkpoint():
-    # override da ENV al primo giro
-    env = os.getenv("START_INDEX")
-    if env is not None:
-        try:
-            return int(env)
-        except ValueError:
-            pass
-    # fallback: leggi dal file
-    try:
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return int(data.get("next_index", 0))
-    except Exception:
-        pass
-    return 0
+        with locked_json(STATE_FILE, {}) as data:
+            if month is not None:
+                month_state = data.setdefault("months", {}).setdefault(month, {"next_index": 0, "completed": False})
+                if next_index is not None:
+                    month_state["next_index"] = int(next_index)
+                if completed_month is not None:
+                    month_state["completed"] = True
+            else:
+                data.update(_load_state(data=data))
+                if next_index is not None:
+                    data["next_index"] = int(next_index)
+                if completed_month is not None:
+                    data["completed_month"] = completed_month
+    except Exception as e:
+        log(f"Impossibile salvare lo stato in {STATE_FILE}: {e}", log_filename, "error")
 
-def _save_checkpoint(next_index):
-    try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump({"next_index": int(next_index)}, f)
-    except Exception:
-        pass
 
-def _reset_checkpoint():
-    try:
-        if os.path.exists(STATE_FILE):
-            os.remove(STATE_FILE)
-    except Exception:
-        pass
+def order_groups(rows, fic_clients):
+    """
+    Chiavi di numerazione degli ordini nell'ordine in cui build_orders li crea:
+    un gruppo per ogni sequenza di righe della stessa P.IVA con cliente su FIC,
+    chiave "P.IVA#n" (n-esimo ordine della P.IVA nel mese).
+    """
+    keys = []
+    occurrences = {}
+    current_vat = None
+    for row in rows:
+        vat = (row["vat_number"] or "").strip()
+        if vat == current_vat:
+            continue
+        current_vat = vat
+        existing = fic_clients.get(normalize_vat(vat))
+        if isinstance(existing, dict) and existing.get("id"):
+            keys.append(_order_group_key(vat, occurrences))
+    return keys
+
+
+def _order_group_key(vat, occurrences):
+    nv = normalize_vat(vat)
+    occurrences[nv] = occurrences.get(nv, 0) + 1
+    return f"{nv}#{occurrences[nv]}"
+
+
+def reset_checkpoint_after_rebuild(month_key, backfill=False):
+    """
+    Dopo la ricostruzione del piano le posizioni possono essere cambiate (ordini
+    nuovi, clienti prima saltati): il checkpoint riparte da 0 e gli ordini già
+    inviati vengono saltati grazie al WAL (wal_done_keys), senza chiamate API.
+    """
+    state = _load_state(month_key) if backfill else _load_state()
+    if state.get("next_index"):
+        _save_state(next_index=0, month=month_key if backfill else None)
+        log(f"[{month_key}] Piano ricostruito: checkpoint {state['next_index']} azzerato, "
+            f"gli ordini già inviati li salta il WAL.", log_filename, "notice")
 
 
-if __name__ == "__main__":
-    results = get_orders_of_the_month()
-    current_month = date.today().strftime("%Y-%m")
-    state = _load_state()
+def skipped_vats(rows, fic_clients):
+    """P.IVA normalizzate delle righe senza cliente su FIC (saltate da build_orders)."""
+    skipped = set()
+    for row in rows:
+        existing = fic_clients.get(normalize_vat(row["vat_number"]))
+        if not (isinstance(existing, dict) and existing.get("id")):
+            skipped.add(normalize_vat(row["vat_number"]))
+    return skipped
 
-    if state.get("completed_month") == current_month:
-        print("Ordini del mese già generati. Esco.")
-        log("Ordini del mese già generati.", log_filename, "notice")
-        raise SystemExit(0)
 
-    if not results:
-        log("Nessun ordine trovato.", log_filename, "warning")
-        raise SystemExit(0)
+def wal_number_assignments(month_key):
+    """
+    Numeri già usati nel mese secondo il WAL, nel formato dell'allocatore:
+    ({chiave: numero}, chiavi inviate). Serve al primo passaggio all'allocatore a metà mese.
+    """
+    by_vat = {}
+    for r in wal_load(month_key).values():
+        by_vat.setdefault(normalize_vat(r.get("vat")), []).append(r)
+    assignments = {}
+    used = set()
+    for nv, records in by_vat.items():
+        for n, r in enumerate(sorted(records, key=lambda r: int(r["number"])), start=1):
+            key = f"{nv}#{n}"
+            assignments[key] = int(r["number"])
+            if r.get("status") == "ok":
+                used.add(key)
+    return assignments, used
+
+
+def build_orders(rows, fic_clients, payment_method_cache, order_date, due_eom, first_number, vat_id=DEFAULT_VAT_ID, numbers=None):
+    """
+    Raggruppa le righe vtiger (ordinate per salesorder/P.IVA) in IssuedDocument.
+    Con `numbers` ({chiave di order_groups: numero}, dall'allocatore docnumbers.py)
+    il numero viene da lì; senza, il progressivo parte da `first_number` e avanza
+    a ogni cambio di P.IVA, anche per i clienti saltati.
+    """
+    import fattureincloud_python_sdk
+    from fattureincloud_python_sdk.models import (
+        Entity,
+        IssuedDocument,
+        IssuedDocumentType,
+        Currency,
+        Language,
+        IssuedDocumentItemsListItem,
+        VatType,   # <-- per impostare l'aliquota 22%
+    )
 
     orders = []
+    progressivo = first_number
+    occurrences = {}
 
-    with fattureincloud_python_sdk.ApiClient(configuration) as api_client:
-        clients_api = fattureincloud_python_sdk.ClientsApi(api_client)
-        docs_api = issued_documents_api.IssuedDocumentsApi(api_client)
+    current_vat = None
+    order = None
+    skip_current_vat = False
+    existing = None
+    client_id = None
 
-        fic_clients = load_all_fic_clients(clients_api, log_filename, company_id)
+    for row in rows:
+        vat = (row["vat_number"] or "").strip()
 
-        # FIX 1: carica i metodi di pagamento UNA SOLA VOLTA, fuori dal loop
-        try:
-            info_api = fattureincloud_python_sdk.InfoApi(api_client)
-            pm_resp = info_api.list_payment_methods(company_id)
-            payment_method_cache = {m.name: m.id for m in pm_resp.data}
-            log(f"Metodi di pagamento caricati: {list(payment_method_cache.keys())}", log_filename, "notice")
-        except Exception as e:
-            log(f"Impossibile caricare metodi di pagamento: {e}", log_filename, "warning")
-            payment_method_cache = {}
-
-        progressivo = int(date.today().strftime("%m") + "001")
-        order_date = date.today().strftime("%Y-%m-%d")
-        due_eom = end_of_month(date.today()).strftime("%Y-%m-%d")
-
-        current_vat = None
-        order = None
-        skip_current_vat = False
-        existing = None
-        client_id = None
-
-        for row in results:
-            vat = (row["vat_number"] or "").strip()
-
-            if skip_current_vat and vat == current_vat:
-                continue
+        if skip_current_vat and vat == current_vat:
+            continue
 
-            if vat != current_vat:
-                if order:
-                    orders.append(order)
-                    order = None
+        if vat != current_vat:
+            if order:
+                orders.append(order)
+                order = None
 
-                current_vat = vat
-                skip_current_vat = False
-                progressivo += 1
+            current_vat = vat
+            skip_current_vat = False
+            progressivo += 1
 
-                existing = fic_clients.get(current_vat)
-                client_id = existing.get("id") if isinstance(existing, dict) else None
+            existing = fic_clients.get(normalize_vat(current_vat))
+            client_id = existing.get("id") if isinstance(existing, dict) else None
 
-                if not client_id:
-                    log(f"Cliente P.IVA {current_vat} non su FIC: salto.", log_filename, "warning")
-                    skip_current_vat = True
-                    order = None
-                    continue
+            if not client_id:
+                log(f"Cliente P.IVA {current_vat} non su FIC: salto.", log_filename, "warning")
+                skip_current_vat = True
+                order = None
+                continue
 
-            if order is None:
-                if not isinstance(existing, dict):
-                    log(f"Dati cliente non disponibili per P.IVA {current_vat}.", log_filename, "warning")
-                    skip_current_vat = True
-                    continue
+            if numbers is not None:
+                progressivo = numbers.get(_order_group_key(current_vat, occurrences))
 
-                ent = Entity(
-                    id=client_id,
-                    name=existing.get("name"),
-                    address_street=existing.get("address_street"),
-                    address_postal_code=existing.get("address_zip"),
-                    address_city=existing.get("address_city"),
-                    address_province=existing.get("address_province"),
-                    certified_email=existing.get("certified_email"),
-                    email=existing.get("email"),
-                    tax_code=existing.get("tax_code"),
-                    vat_number=existing.get("vat_number"),
-                )
+        if order is None:
+            if not isinstance(existing, dict):
+                log(f"Dati cliente non disponibili per P.IVA {current_vat}.", log_filename, "warning")
+                skip_current_vat = True
+                continue
 
-                # FIX 2: usa la cache, zero chiamate API aggiuntive
-                pm_id = payment_method_cache.get(row["default_payment_method"])
-
-                order = IssuedDocument(
-                    payment_method=(fattureincloud_python_sdk.PaymentMethod(id=pm_id) if pm_id else None),
-                    type=IssuedDocumentType("order"),
-                    entity=ent,
-                    date=order_date,
-                    due_date=due_eom,
-                    number=progressivo,
-                    currency=Currency(id="EUR"),
-                    language=Language(code="it", name="italiano"),
-                    items_list=[],
-                    show_payments=True,
-                    show_payment_method=True
-                )
-
-            if order:
-                order.items_list.append(
-                    IssuedDocumentItemsListItem(
-                        code=row["service_no"],
-                        name=row["servicename"],
-                        description=row["comment"],
-                        net_price=float(row["listprice"]),
-                        qty=float(row["quantity"]),
-                        discount=float(row["discount"]),
-                        vat=VatType(id=0)
-                    )
-                )
+            ent = Entity(
+                id=client_id,
+                name=existing.get("name"),
+                address_street=existing.get("address_street"),
+                address_postal_code=existing.get("address_zip"),
+                address_city=existing.get("address_city"),
+                address_province=existing.get("address_province"),
+                certified_email=existing.get("certified_email"),
+                email=existing.get("email"),
+                tax_code=existing.get("tax_code"),
+                vat_number=existing.get("vat_number"),
+            )
+
+            # FIX 2: usa la cache, zero chiamate API aggiuntive
+            pm_id = payment_method_cache.get(row["default_payment_method"])
+
+            order = IssuedDocument(
+                payment_method=(fattureincloud_python_sdk.PaymentMethod(id=pm_id) if pm_id else None),
+                type=IssuedDocumentType("order"),
+                entity=ent,
+                date=order_date,
+                due_date=due_eom,
+                number=progressivo,
+                currency=Currency(id="EUR"),
+                language=Language(code="it", name="italiano"),
+                items_list=[],
+                show_payments=True,
+                show_payment_method=True
+            )
 
         if order:
-            orders.append(order)
-
-        if not orders:
-            log("Nessun ordine costruito.", log_filename, "warning")
-            raise SystemExit(0)
-
-        total = len(orders)
-        start = int(state.get("next_index", 0))
-
-        if start >= total and state.get("completed_month") != current_month:
-            start = 0
+            order.items_list.append(
+                IssuedDocumentItemsListItem(
+                    code=row["service_no"],
+                    name=row["servicename"],
+                    description=row["comment"],
+                    net_price=float(row["listprice"]),
+                    qty=float(row["quantity"]),
+                    discount=float(row["discount"]),
+                    vat=VatType(id=vat_id)
+                )
+            )
 
-        end = min(start + BATCH_SIZE, total)
-        batch = orders[start:end]
+    if order:
+        orders.append(order)
 
-        log(f"Invio batch {start+1}-{end} su {total}", log_filename, "notice")
-        print(f"Invio batch {start+1}-{end} su {total}")
+    return orders
 
-        ok = 0
-        ko = 0
 
-        for i, od in enumerate(batch, start=start + 1):
+def send_orders(docs_api, month_key, state, order_date, due_eom, backfill=False):
+    """
+    Invia gli ordini del mese `month_key` a partire dal checkpoint in `state`,
+    leggendo dal piano ordini (orderplan.py) solo gli ordini che invia e i retry.
+    In modalità normale invia finché il budget del run lo permette (budget.py),
+    in backfill tutti.
+    Ritorna (ok, ko, già inviati).
+    """
+    from fattureincloud_python_sdk.models import (
+        CreateIssuedDocumentRequest,
+        IssuedDocumentOptions,
+        IssuedDocumentPaymentsListItem,
+    )
+    from fattureincloud_python_sdk.rest import ApiException
+
+    state_month = month_key if backfill else None
+    due_retries = [e for e in dlq_due("order") if e.get("payload", {}).get("month") == month_key]
+    month_completed = state.get("completed_month") == month_key
+
+    total = read_plan_header(month_key)["total"]
+    start = int(state.get("next_index", 0))
+
+    if start >= total and not month_completed:
+        start = 0
+
+    if month_completed:
+        # mese già completato: giro solo per i retry della dead-letter queue
+        start = end = total
+    else:
+        # niente batch fisso: la fine effettiva la decide il budget durante l'invio
+        end = total
+
+    # terne (posizione, ordine, è un retry): prima i retry già superati dal checkpoint,
+    # poi gli ordini dal checkpoint in avanti, letti dal piano solo quando servono
+    retries = [(i, order_from_plan(entry, order_date, due_eom), True)
+               for i, entry in iter_plan(month_key, 0, 0, {e["key"] for e in due_retries}) if i <= start]
+    if retries:
+        log(f"Dead-letter: {len(retries)} ordini da ritentare.", log_filename, "notice")
+    forward = ((i, order_from_plan(entry, order_date, due_eom), False) for i, entry in iter_plan(month_key, start, end))
+
+    # Recovery: riconcilio gli ordini rimasti "in volo" da un run interrotto
+    recovered, aborted = recover_inflight(docs_api, company_id, month_key, log_filename)
+    if recovered or aborted:
+        log(f"Recovery WAL: {recovered} ordini confermati, {aborted} da reinviare.", log_filename, "notice")
+    done_keys = wal_done_keys(month_key)
+
+    if start < end:
+        estimate = end if backfill else min(end, start + items_that_fit())
+        log(f"[{month_key}] Invio da {start+1} su {total}, nel budget circa fino a {estimate}", log_filename, "notice")
+        print(f"[{month_key}] Invio da {start+1} su {total}, nel budget circa fino a {estimate}")
+
+    ok = 0
+    ko = 0
+    already = 0
+    reached = start
+
+    for i, od, is_retry in itertools.chain(retries, forward):
+        if not backfill and not budget_allows():
+            # budget esaurito: il checkpoint riparte dal primo ordine non elaborato
+            end = reached
+            log(f"[{month_key}] Budget del run esaurito ({BUDGET['exhausted']}) alla posizione {reached}.", log_filename, "notice")
+            break
+        if not is_retry:
+            reached = i
+        vat = od.entity.vat_number
+        key = order_key(vat, od.number)
+        if key in done_keys:
+            already += 1
+            dlq_resolve("order", key)
+            continue
+        with budget_item():
+            wal_append(month_key, "intent", vat, od.number, date=order_date)
             try:
                 od.payments_list = [
                     IssuedDocumentPaymentsListItem(
@@ -388,25 +541,217 @@ if __name__ == "__main__":
                     )
                 )
                 ok += 1
+                wal_append(month_key, "ok", vat, od.number, date=order_date, doc_id=getattr(resp.data, 'id', None))
+                mark_used(company_id, month_key, od.number)
+                dlq_resolve("order", key)
+                if not is_retry:
+                    _save_state(next_index=i, month=state_month)
                 log(
                     f"[{i}/{total}] Ordine creato: id={getattr(resp.data, 'id', None)} "
                     f"numero={getattr(resp.data, 'number', None)}",
                     log_filename, "notice"
                 )
-                # FIX 3: pausa tra chiamate per non saturare il pool HTTP
-                time.sleep(0.15)
+                # il ritmo delle chiamate lo decide il rate limiter condiviso (ratelimit.py)
 
             except ApiException as e:
                 ko += 1
+                wal_append(month_key, "ko", vat, od.number, date=order_date, error=str(e.status))
                 log(f"[{i}/{total}] Errore creazione ordine: {e}", log_filename, "error")
+                entry = dlq_add("order", key, e, payload={"month": month_key, "vat": vat, "number": od.number})
+                if entry["quarantined"]:
+                    log(f"[{i}/{total}] Ordine {key} in quarantena ({entry['error_class']}, status={entry['status']}).", log_filename, "warning")
                 # backoff più generoso su errore
                 time.sleep(1.0)
 
-        print(f"Batch completato. OK={ok}  KO={ko}")
+    add_counts(ok=ok, ko=ko, already=already)
+    if end > start:
+        note_batch(start + 1, end, total, label=month_key)
+    if already:
+        log(f"{already} ordini già inviati secondo il WAL: saltati.", log_filename, "notice")
+    print(f"[{month_key}] Batch completato. OK={ok}  KO={ko}  GIÀ INVIATI={already}")
+
+    if end >= total:
+        _save_state(next_index=0, completed_month=month_key, month=state_month)
+        log(f"[{month_key}] Tutti gli ordini processati. Stato completato.", log_filename, "notice")
+    else:
+        _save_state(next_index=end, month=state_month)
+        log(f"[{month_key}] Checkpoint: prossimo indice={end}, rimangono {total - end}.", log_filename, "notice")
 
-        if end >= total:
-            _save_state(next_index=0, completed_month=current_month)
-            log("Tutti gli ordini processati. Stato completato.", log_filename, "notice")
-        else:
-            _save_state(next_index=end)
-            log(f"Checkpoint: prossimo indice={end}, rimangono {total - end}.", log_filename, "notice")
\ No newline at end of file
+    return ok, ko, already
+
+
+def load_reference_data(api_client):
+    """
+    Metodi di pagamento (nome -> id) e id dell'aliquota IVA ordinaria,
+    dalla cache dei dati di riferimento (refcache.py).
+    """
+    try:
+        payment_method_cache = name_to_id("payment_methods", get_refdata("payment_methods", api_client, company_id, log_filename))
+        log(f"Metodi di pagamento caricati: {list(payment_method_cache.keys())}", log_filename, "notice")
+    except Exception as e:
+        log(f"Impossibile caricare metodi di pagamento: {e}", log_filename, "warning")
+        payment_method_cache = {}
+    try:
+        vat_id = vat_type_id(get_refdata("vat_types", api_client, company_id, log_filename), log_filename=log_filename)
+    except Exception as e:
+        log(f"Impossibile caricare le aliquote IVA, uso l'aliquota predefinita: {e}", log_filename, "warning")
+        vat_id = DEFAULT_VAT_ID
+    return payment_method_cache, vat_id
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="Genera gli ordini del mese su Fatture in Cloud")
+    parser.add_argument(
+        "--backfill", nargs=2, metavar=("DA", "A"),
+        help="recupera i mesi da DA ad A inclusi (formato YYYY-MM), con una sola query"
+    )
+    parser.add_argument(
+        "--rebuild-plan", action="store_true",
+        help="ricostruisce il piano ordini del mese anche se il checksum vtiger non è cambiato"
+    )
+    add_profile_argument(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    backfill = args.backfill is not None
+    if args.profile is not None:
+        enable_profiling(args.profile)
+
+    if backfill:
+        try:
+            months = month_range(*args.backfill)
+        except ValueError as e:
+            print(e)
+            raise SystemExit(1)
+    else:
+        months = [date.today()]
+
+    # filtro i mesi già completati senza retry pendenti prima di toccare DB e API
+    pending_months = []
+    for m in months:
+        month_key = m.strftime("%Y-%m")
+        state = _load_state(month_key) if backfill else _load_state()
+        due_retries = [e for e in dlq_due("order") if e.get("payload", {}).get("month") == month_key]
+        if state.get("completed_month") == month_key and not due_retries:
+            log(f"Ordini del mese {month_key} già generati.", log_filename, "notice")
+            continue
+        pending_months.append(m)
+
+    if not pending_months:
+        print("Ordini del mese già generati. Esco.")
+        raise SystemExit(0)
+
+    # checksum dei dati vtiger (una riga per mese) e impronta della cache clienti FIC:
+    # decidono quali piani ordini vanno ricostruiti
+    with phase("extract"):
+        checksums = get_orders_checksums(pending_months)
+    clients_fingerprint = clients_cache_fingerprint()
+    plans = {m: read_plan_header(m.strftime("%Y-%m")) for m in pending_months}
+    stale = [m for m in pending_months
+             if args.rebuild_plan or not plan_is_current(plans[m], checksums.get(mese_su_vtiger(m)), clients_fingerprint)]
+
+    # mesi senza ordini con il piano vuoto ancora valido: niente da fare, nemmeno caricare l'SDK
+    for m in pending_months:
+        if m not in stale and not plans[m]["total"]:
+            log(f"[{m.strftime('%Y-%m')}] Nessun ordine nel mese (piano vuoto del {plans[m]['created']}).",
+                log_filename, "notice")
+    pending_months = [m for m in pending_months if m in stale or plans[m]["total"]]
+    if not pending_months:
+        print("Nessun ordine da inviare. Esco.")
+        raise SystemExit(0)
+
+    # budget aperto solo adesso: i tick a vuoto escono prima senza toccare lo storico dei run
+    start_budget("orders")
+
+    # l'SDK si carica solo adesso, dopo i controlli di uscita anticipata
+    import fattureincloud_python_sdk
+    from fattureincloud_python_sdk.api import issued_documents_api
+
+    with fic_api_client(workers=3) as api_client:
+        clients_api = fattureincloud_python_sdk.ClientsApi(api_client)
+        docs_api = issued_documents_api.IssuedDocumentsApi(api_client)
+
+        rows_by_label = {}
+        if stale:
+            # query vtiger, clienti FIC e metodi di pagamento sono indipendenti: li carico in parallelo
+            startup = run_startup_tasks({
+                "vtiger": timed("extract", lambda: get_orders_of_months(stale)),
+                "dati_riferimento": timed("refdata", lambda: load_reference_data(api_client)),
+                "clienti_fic": timed("cache_load", lambda: load_all_fic_clients(clients_api, log_filename, company_id)),
+            }, log_filename)
+            results = startup["vtiger"]
+            fic_clients = startup["clienti_fic"]
+            payment_method_cache, vat_id = startup["dati_riferimento"]
+            # impronta della cache da cui vengono le entità (il caricamento può averla riscaricata)
+            clients_fingerprint = clients_cache_fingerprint()
+
+            if not results:
+                log("Nessun ordine trovato.", log_filename, "warning")
+            for row in results:
+                rows_by_label.setdefault(row["vtiger_month"], []).append(row)
+
+        for m in pending_months:
+            month_key = m.strftime("%Y-%m")
+
+            # mese corrente: data di oggi; mesi arretrati: primo giorno del mese
+            order_day = date.today() if not backfill or m == date.today().replace(day=1) else m
+            order_date = order_day.strftime("%Y-%m-%d")
+            due_eom = end_of_month(m).strftime("%Y-%m-%d")
+
+            if m in stale:
+                rows = rows_by_label.get(mese_su_vtiger(m), [])
+                if not rows:
+                    log(f"[{month_key}] Nessun ordine trovato.", log_filename, "warning")
+                    # piano vuoto: i prossimi run non rifanno la query finché il checksum non cambia
+                    write_plan(month_key, checksums.get(mese_su_vtiger(m)), [], clients=clients_fingerprint)
+                    continue
+
+                # numerazione dall'allocatore persistente (docnumbers.py): stessi numeri a ogni
+                # ricostruzione, nessuna collisione fra invii concorrenti
+                with phase("build"):
+                    seeded = seed_numbers(company_id, month_key, *wal_number_assignments(month_key))
+                    if seeded:
+                        log(f"[{month_key}] Allocatore numeri inizializzato dal WAL ({seeded} numeri).", log_filename, "notice")
+                    numbers = allocate_many(company_id, month_key, order_groups(rows, fic_clients))
+                    orders = build_orders(rows, fic_clients, payment_method_cache,
+                                          order_date, due_eom, int(m.strftime("%m") + "001"), vat_id=vat_id, numbers=numbers)
+                    plan = write_plan(month_key, checksums.get(mese_su_vtiger(m)), orders,
+                                      skipped_vats(rows, fic_clients), clients=clients_fingerprint)
+                log(f"[{month_key}] Piano ordini ricostruito: {plan['total']} ordini.", log_filename, "notice")
+                reset_checkpoint_after_rebuild(month_key, backfill)
+            else:
+                plan = plans[m]
+                log(f"[{month_key}] Piano ordini del {plan['created']} ancora valido ({plan['total']} ordini): "
+                    f"nessuna ricostruzione.", log_filename, "notice")
+
+            if not plan["total"]:
+                log(f"[{month_key}] Nessun ordine costruito.", log_filename, "warning")
+                continue
+
+            state = _load_state(month_key) if backfill else _load_state()
+            with phase("send"):
+                send_orders(docs_api, month_key, state, order_date, due_eom, backfill=backfill)
+
+        pending, quarantined = dlq_summary()
+        if pending or quarantined:
+            log(f"Dead-letter: {pending} in attesa di retry, {quarantined} in quarantena.", log_filename, "notice")
+        if not backfill:
+            log(f"Run ordini: {budget_summary()}", log_filename, "notice")
+        log_transport_stats(api_client, log_filename)
+
+
+if __name__ == "__main__":
+    try:
+        with run_lock("orders"):
+            try:
+                main()
+            finally:
+                record_run("orders", log_filename)
+    except JobAlreadyRunning as e:
+        print(e)
+        log(str(e), log_filename, "warning")
+    finally:
+        write_profile_report("orders", log_filename)
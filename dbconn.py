@@ -1,4 +1,3 @@
-import mysql.connector
 import os
 from dotenv import load_dotenv
 
@@ -12,4 +11,6 @@ db_config = {
 }
 
 def getdbconn():
+    # import ritardato: i run che escono prima di interrogare il DB non caricano il driver
+    import mysql.connector
     return mysql.connector.connect(**db_config)
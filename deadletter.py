@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+from filelocks import read_json_locked, locked_json
+
+# Dead-letter queue persistente per clienti e ordini falliti.
+# Ogni voce tiene classe d'errore, tentativi e prossimo retry; gli errori 4xx
+# permanenti vengono messi in quarantena e non vengono più ritentati.
+DEADLETTER_FILE = "deadletter.json"
+RETRY_BASE_MINUTES = 15
+RETRY_MAX_HOURS = 24
+MAX_ATTEMPTS = 8
+
+# 4xx che hanno senso ritentare (timeout, conflitto, rate limit)
+TRANSIENT_4XX = {408, 409, 425, 429}
+
+DATE_FMT = "%Y-%m-%d %H:%M:%S"
+
+
+def _load():
+    return read_json_locked(DEADLETTER_FILE, {}) or {}
+
+
+def _entry_id(kind, key):
+    return f"{kind}:{key}"
+
+
+def classify_error(error):
+    """Ritorna (classe, status): 'permanent' per i 4xx non ritentabili, altrimenti 'transient'."""
+    status = getattr(error, "status", None)
+    if status is not None and 400 <= int(status) < 500 and int(status) not in TRANSIENT_4XX:
+        return "permanent", status
+    return "transient", status
+
+
+def next_retry_at(attempts, now=None):
+    now = now or datetime.now()
+    delay = timedelta(minutes=RETRY_BASE_MINUTES * (2 ** max(attempts - 1, 0)))
+    return now + min(delay, timedelta(hours=RETRY_MAX_HOURS))
+
+
+def dlq_add(kind, key, error, payload=None):
+    """Registra (o aggiorna) un fallimento. Ritorna la voce salvata."""
+    with locked_json(DEADLETTER_FILE, {}, indent=2) as entries:
+        return _add_entry(entries, kind, key, error, payload)
+
+
+def _add_entry(entries, kind, key, error, payload):
+    eid = _entry_id(kind, key)
+    entry = entries.get(eid, {"kind": kind, "key": key, "attempts": 0,
+                              "first_failure": datetime.now().strftime(DATE_FMT)})
+    error_class, status = classify_error(error)
+    entry["attempts"] += 1
+    entry["error_class"] = error_class
+    entry["status"] = status
+    entry["error"] = str(error)[:500]
+    entry["last_failure"] = datetime.now().strftime(DATE_FMT)
+    entry["quarantined"] = error_class == "permanent" or entry["attempts"] >= MAX_ATTEMPTS
+    entry["next_retry"] = None if entry["quarantined"] else next_retry_at(entry["attempts"]).strftime(DATE_FMT)
+    if payload is not None:
+        entry["payload"] = payload
+    entries[eid] = entry
+    return entry
+
+
+def dlq_resolve(kind, key):
+    """Rimuove la voce dopo un retry andato a buon fine."""
+    # lettura veloce senza lock esclusivo: nel caso comune la voce non c'è
+    if _entry_id(kind, key) not in _load():
+        return False
+    with locked_json(DEADLETTER_FILE, {}, indent=2) as entries:
+        return entries.pop(_entry_id(kind, key), None) is not None
+
+
+def dlq_keys(kind):
+    """Chiavi di tutte le voci del tipo indicato (anche in quarantena o non ancora scadute)."""
+    return {e["key"] for e in _load().values() if e.get("kind") == kind}
+
+
+def dlq_due(kind, now=None):
+    """Voci non in quarantena il cui retry è scaduto."""
+    now = now or datetime.now()
+    due = []
+    for entry in _load().values():
+        if entry.get("kind") != kind or entry.get("quarantined"):
+            continue
+        if entry.get("next_retry") and datetime.strptime(entry["next_retry"], DATE_FMT) <= now:
+            due.append(entry)
+    return due
+
+
+def dlq_summary():
+    entries = _load().values()
+    quarantined = sum(1 for e in entries if e.get("quarantined"))
+    return len(entries) - quarantined, quarantined
@@ -0,0 +1,236 @@
+"""
+Numerazione persistente dei documenti FIC per azienda, mese e tipo documento.
+
+  python docnumbers.py --month 2025-03                 # numeri assegnati e buchi
+  python docnumbers.py --month 2025-03 --reconcile     # allinea con gli ordini presenti su FIC
+
+Ogni numero viene riservato in modo atomico (transazione SQLite BEGIN IMMEDIATE)
+e legato a una chiave stabile (per gli ordini del mese "P.IVA#n", n-esimo ordine
+della P.IVA nel mese):
+ricostruire gli ordini dà sempre gli stessi numeri, e più processi che inviano
+in parallelo non usano mai lo stesso numero. I numeri riservati e mai usati, o
+annullati, restano registrati come buchi; la riconciliazione con FIC segna come
+"external" i numeri creati fuori dal job, che l'allocatore salta.
+"""
+import time
+import sqlite3
+import argparse
+
+NUMBERS_DB_FILE = "doc_numbers.sqlite"
+
+# stati di un numero
+RESERVED = "reserved"   # assegnato a una chiave, documento non ancora creato
+USED = "used"           # documento creato su FIC
+GAP = "gap"             # riservato e poi annullato / mai creato
+EXTERNAL = "external"   # presente su FIC ma non assegnato da qui (creato a mano)
+
+
+def _connect():
+    conn = sqlite3.connect(NUMBERS_DB_FILE, timeout=30, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS counters (company INTEGER, month TEXT, doctype TEXT, next_number INTEGER,"
+        " PRIMARY KEY (company, month, doctype))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS numbers (company INTEGER, month TEXT, doctype TEXT, number INTEGER,"
+        " key TEXT, status TEXT, updated REAL, note TEXT, PRIMARY KEY (company, month, doctype, number))"
+    )
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS numbers_key ON numbers (company, month, doctype, key)")
+    return conn
+
+
+def first_number(month):
+    """Primo numero del mese: MM002, come la numerazione storica di createOrders3 (base MM001 + 1)."""
+    return int(month[5:7] + "001") + 1
+
+
+def _counter(conn, scope):
+    row = conn.execute("SELECT next_number FROM counters WHERE company = ? AND month = ? AND doctype = ?", scope).fetchone()
+    return row[0] if row else first_number(scope[1])
+
+
+def _taken(conn, scope, number):
+    return conn.execute("SELECT 1 FROM numbers WHERE company = ? AND month = ? AND doctype = ? AND number = ?",
+                        (*scope, number)).fetchone() is not None
+
+
+def allocate_many(company, month, keys, doctype="order"):
+    """
+    Numeri per le chiavi indicate, in un'unica transazione: le chiavi già note
+    mantengono il loro numero, le nuove ricevono i successivi liberi, nell'ordine dato.
+    Ritorna {chiave: numero}.
+    """
+    scope = (company, month, doctype)
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        assigned = dict(conn.execute(
+            "SELECT key, number FROM numbers WHERE company = ? AND month = ? AND doctype = ? AND key IS NOT NULL", scope
+        ).fetchall())
+        result = {}
+        number = None
+        for key in keys:
+            if key in assigned:
+                result[key] = assigned[key]
+                continue
+            if number is None:
+                number = _counter(conn, scope)
+            # salto i numeri già occupati (es. "external" trovati in riconciliazione)
+            while _taken(conn, scope, number):
+                number += 1
+            conn.execute("INSERT INTO numbers (company, month, doctype, number, key, status, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (*scope, number, key, RESERVED, time.time()))
+            assigned[key] = result[key] = number
+            number += 1
+        if number is not None:
+            conn.execute("INSERT INTO counters (company, month, doctype, next_number) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT(company, month, doctype) DO UPDATE SET next_number = MAX(next_number, excluded.next_number)",
+                         (*scope, number))
+        conn.execute("COMMIT")
+        return result
+    finally:
+        # senza COMMIT la chiusura annulla la transazione
+        conn.close()
+
+
+def allocate(company, month, key, doctype="order"):
+    return allocate_many(company, month, [key], doctype)[key]
+
+
+def lookup_numbers(company, month, doctype="order"):
+    """Numeri già assegnati {chiave: numero}, senza assegnarne di nuovi (es. per la riconciliazione)."""
+    conn = _connect()
+    try:
+        return dict(conn.execute("SELECT key, number FROM numbers WHERE company = ? AND month = ? AND doctype = ?"
+                                 " AND key IS NOT NULL AND status != ?", (company, month, doctype, GAP)).fetchall())
+    finally:
+        conn.close()
+
+
+def _set_status(company, month, number, status, doctype, note=None):
+    conn = _connect()
+    try:
+        conn.execute("UPDATE numbers SET status = ?, updated = ?, note = COALESCE(?, note)"
+                     " WHERE company = ? AND month = ? AND doctype = ? AND number = ?",
+                     (status, time.time(), note, company, month, doctype, number))
+    finally:
+        conn.close()
+
+
+def mark_used(company, month, number, doctype="order"):
+    _set_status(company, month, number, USED, doctype)
+
+
+def mark_gap(company, month, number, doctype="order", note=None):
+    """Numero riservato che non verrà usato: resta registrato come buco e non viene riassegnato."""
+    _set_status(company, month, number, GAP, doctype, note)
+
+
+def seed_numbers(company, month, assignments, used=(), doctype="order"):
+    """
+    Importa numeri assegnati prima dell'allocatore (es. dal WAL del mese) se lo
+    scope è nuovo, così il passaggio a metà mese non rinumera gli ordini.
+    `assignments` è {chiave: numero}; le chiavi in `used` hanno già il documento
+    su FIC. Ritorna il numero di voci importate.
+    """
+    scope = (company, month, doctype)
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("SELECT 1 FROM counters WHERE company = ? AND month = ? AND doctype = ?", scope).fetchone():
+            conn.execute("COMMIT")
+            return 0
+        for key, number in assignments.items():
+            conn.execute("INSERT OR IGNORE INTO numbers (company, month, doctype, number, key, status, updated)"
+                         " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (*scope, int(number), key, USED if key in used else RESERVED, time.time()))
+        next_number = max([int(n) + 1 for n in assignments.values()] + [first_number(month)])
+        conn.execute("INSERT INTO counters (company, month, doctype, next_number) VALUES (?, ?, ?, ?)", (*scope, next_number))
+        conn.execute("COMMIT")
+        return len(assignments)
+    finally:
+        conn.close()
+
+
+def number_report(company, month, doctype="order"):
+    """Righe (numero, chiave, stato, nota) dello scope, in ordine di numero."""
+    conn = _connect()
+    try:
+        return conn.execute("SELECT number, key, status, note FROM numbers WHERE company = ? AND month = ? AND doctype = ?"
+                            " ORDER BY number", (company, month, doctype)).fetchall()
+    finally:
+        conn.close()
+
+
+def reconcile_numbers(company, month, fic_numbers, doctype="order"):
+    """
+    Allinea l'allocatore con i numeri presenti su FIC (`fic_numbers`):
+    riservati trovati su FIC -> used; numeri FIC sconosciuti -> external (saltati
+    dalle prossime assegnazioni); used non più su FIC -> gap.
+    Ritorna un dict con le liste di numeri cambiati per categoria.
+    """
+    fic_numbers = {int(n) for n in fic_numbers}
+    changes = {"used": [], "external": [], "gap": []}
+    scope = (company, month, doctype)
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        known = {n: status for n, status in conn.execute(
+            "SELECT number, status FROM numbers WHERE company = ? AND month = ? AND doctype = ?", scope).fetchall()}
+        now = time.time()
+        for number, status in known.items():
+            if status == RESERVED and number in fic_numbers:
+                conn.execute("UPDATE numbers SET status = ?, updated = ? WHERE company = ? AND month = ? AND doctype = ? AND number = ?",
+                             (USED, now, *scope, number))
+                changes["used"].append(number)
+            elif status == USED and number not in fic_numbers:
+                conn.execute("UPDATE numbers SET status = ?, updated = ?, note = ? WHERE company = ? AND month = ? AND doctype = ? AND number = ?",
+                             (GAP, now, "non presente su FIC", *scope, number))
+                changes["gap"].append(number)
+        for number in sorted(fic_numbers - set(known)):
+            conn.execute("INSERT INTO numbers (company, month, doctype, number, key, status, updated, note) VALUES (?, ?, ?, ?, NULL, ?, ?, ?)",
+                         (*scope, number, EXTERNAL, now, "creato fuori dall'allocatore"))
+            changes["external"].append(number)
+        conn.execute("COMMIT")
+        return changes
+    finally:
+        conn.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Numerazione persistente dei documenti FIC")
+    parser.add_argument("--month", required=True, help="mese (YYYY-MM)")
+    parser.add_argument("--doctype", default="order")
+    parser.add_argument("--reconcile", action="store_true", help="allinea con i documenti presenti su FIC")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import os
+    from datetime import datetime
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    args = parse_args()
+    company_id = int(os.getenv("COMPANY_ID"))
+
+    if args.reconcile:
+        from globalutils import fic_api_client
+        from reconcileOrders import load_fic_orders_of_month
+        from fattureincloud_python_sdk.api import issued_documents_api
+
+        with fic_api_client() as api_client:
+            docs_api = issued_documents_api.IssuedDocumentsApi(api_client)
+            fic_orders = load_fic_orders_of_month(docs_api, datetime.strptime(args.month, "%Y-%m").date(), refresh=True)
+        changes = reconcile_numbers(company_id, args.month, [d["number"] for d in fic_orders], args.doctype)
+        for category, numbers in changes.items():
+            print(f"{category:<9} {len(numbers):>5}  {', '.join(map(str, numbers[:20]))}")
+
+    rows = number_report(company_id, args.month, args.doctype)
+    for number, key, status, note in rows:
+        if status != USED:
+            print(f"{number:>8}  {status:<9} {key or '-':<24} {note or ''}")
+    counts = {}
+    for _, _, status, _ in rows:
+        counts[status] = counts.get(status, 0) + 1
+    print(f"{args.month} {args.doctype}: " + ", ".join(f"{n} {s}" for s, n in sorted(counts.items())))
@@ -0,0 +1,114 @@
+"""
+Normalizzazione per campo dei dati cliente prima del confronto CRM / FIC.
+
+Lo stesso valore arriva spesso scritto in modo diverso dai due lati: maiuscole,
+spazi doppi, telefono con o senza +39, provincia minuscola, CAP senza lo zero
+iniziale. Confrontati così com'erano contavano come modifiche e il cliente
+veniva reinviato a ogni ciclo. Qui ogni campo ha il suo normalizzatore,
+applicato a entrambi i lati; i normalizzatori sono memoizzati (lru_cache)
+perché su migliaia di clienti gli stessi valori (città, province, domini)
+si ripetono molto.
+"""
+import re
+from functools import lru_cache
+
+from globalutils import normalize_vat, normalize_tax_code
+
+NORMALIZER_CACHE_SIZE = 8192
+
+_SPACES_RE = re.compile(r"\s+")
+_PHONE_JUNK_RE = re.compile(r"[\s.\-/()]")
+_PROVINCE_RE = re.compile(r"[^A-Z]")
+
+# campo del confronto -> chiavi in cui cercarlo nel record FIC, in ordine
+# (il CAP nella cache è address_zip, nel Client dell'SDK address_postal_code)
+FIC_FIELD_KEYS = {
+    "address_zip": ("address_zip", "address_postal_code"),
+}
+
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def norm_text(value):
+    """Testo libero (ragione sociale, via, città): spazi compattati, senza maiuscole/minuscole."""
+    return _SPACES_RE.sub(" ", value).strip().casefold()
+
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def norm_email(value):
+    return value.strip().lower()
+
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def norm_phone(value):
+    """Telefono: senza spazi e separatori, senza prefisso internazionale italiano (+39 / 0039)."""
+    value = _PHONE_JUNK_RE.sub("", value)
+    for prefix in ("+39", "0039"):
+        if value.startswith(prefix):
+            return value[len(prefix):]
+    return value
+
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def norm_province(value):
+    """Sigla provincia: maiuscola, senza parentesi e punteggiatura ('(rm)' -> 'RM')."""
+    return _PROVINCE_RE.sub("", value.upper())
+
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def norm_zip(value):
+    """CAP: ripristina gli zeri iniziali persi nelle esportazioni numeriche ('118' -> '00118')."""
+    value = value.strip()
+    if value.isdigit() and len(value) < 5:
+        return value.zfill(5)
+    return value.upper()
+
+
+@lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def norm_code(value):
+    """Codici (SDI e simili): alfanumerici maiuscoli."""
+    return "".join(ch for ch in value if ch.isalnum()).upper()
+
+
+FIELD_NORMALIZERS = {
+    "name": norm_text,
+    "address_street": norm_text,
+    "address_city": norm_text,
+    "address_province": norm_province,
+    "address_zip": norm_zip,
+    "email": norm_email,
+    "certified_email": norm_email,
+    "phone": norm_phone,
+    "vat_number": lru_cache(maxsize=NORMALIZER_CACHE_SIZE)(normalize_vat),
+    "tax_code": lru_cache(maxsize=NORMALIZER_CACHE_SIZE)(normalize_tax_code),
+    "ei_code": norm_code,
+    "code": norm_code,
+    "contact_person": norm_text,
+}
+
+
+def normalized(field, value):
+    """Valore confrontabile del campo; i campi senza normalizzatore vengono solo ripuliti dagli spazi."""
+    value = str(value or "").strip()
+    if not value:
+        return ""
+    normalize = FIELD_NORMALIZERS.get(field)
+    return normalize(value) if normalize else value
+
+
+def fic_value(existing, field):
+    """Valore del campo nel record FIC, anche se salvato con un nome alternativo."""
+    for key in FIC_FIELD_KEYS.get(field, (field,)):
+        value = existing.get(key)
+        if value:
+            return value
+    return None
+
+
+def normalizer_cache_stats():
+    """(hit, miss) complessivi delle cache dei normalizzatori."""
+    hits = misses = 0
+    for normalize in set(FIELD_NORMALIZERS.values()):
+        info = normalize.cache_info()
+        hits += info.hits
+        misses += info.misses
+    return hits, misses
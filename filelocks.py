@@ -0,0 +1,170 @@
+import os
+import json
+import socket
+from contextlib import contextmanager
+from datetime import datetime
+
+# Scritture atomiche e lock consultivi per i file condivisi fra i job
+# (cache clienti, stato ordini, dead-letter, dati di riferimento, batch).
+# I lock stanno su un file "<nome>.lock" separato, così il rename atomico
+# del file dati non invalida il lock. Su sistemi senza fcntl (Windows, solo
+# sviluppo) i lock sono no-op e resta comunque la scrittura atomica.
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+RUN_LOCK_TEMPLATE = "{name}.run.lock"
+RUN_LOCK_MAX_HOURS = 6
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """Lock consultivo su `path`: condiviso per i lettori, esclusivo per chi scrive."""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def atomic_write_json(path, data, keep_mtime=False, **dump_kwargs):
+    """
+    Scrive `data` in un file temporaneo nella stessa cartella, fsync e rename:
+    i lettori vedono sempre il file vecchio o quello nuovo, mai uno troncato.
+    """
+    mtime = os.path.getmtime(path) if keep_mtime and os.path.exists(path) else None
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def read_json_locked(path, default=None):
+    """Legge un file JSON sotto lock condiviso; `default` se manca."""
+    with file_lock(path, shared=True):
+        if not os.path.exists(path):
+            return default
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+
+@contextmanager
+def locked_json(path, default=None, **dump_kwargs):
+    """
+    Read-modify-write sotto lock esclusivo:
+
+        with locked_json(STATE_FILE, {}) as data:
+            data["next_index"] = 10
+
+    Il file viene riscritto in modo atomico all'uscita dal blocco (se non ci sono eccezioni).
+    """
+    with file_lock(path):
+        data = default
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        yield data
+        atomic_write_json(path, data, **dump_kwargs)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def _is_stale(info, max_hours):
+    started = info.get("started")
+    try:
+        age_hours = (datetime.now() - datetime.strptime(started, "%Y-%m-%d %H:%M:%S")).total_seconds() / 3600
+    except (TypeError, ValueError):
+        return True
+    if age_hours > max_hours:
+        return True
+    # il pid è verificabile solo sullo stesso host
+    if info.get("host") == socket.gethostname():
+        return not _pid_alive(int(info.get("pid", 0)))
+    return False
+
+
+class JobAlreadyRunning(RuntimeError):
+    pass
+
+
+@contextmanager
+def run_lock(name, max_hours=RUN_LOCK_MAX_HOURS):
+    """
+    Impedisce due esecuzioni contemporanee dello stesso job. Un lock lasciato da
+    un processo morto (o più vecchio di `max_hours`) viene rimosso. Solleva
+    JobAlreadyRunning se il job è già in esecuzione.
+    """
+    path = RUN_LOCK_TEMPLATE.format(name=name)
+    info = {
+        "pid": os.getpid(),
+        "host": socket.gethostname(),
+        "started": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    # il lock nasce già completo: scrivo un file temporaneo e lo collego con link(),
+    # che fallisce in modo atomico se il lock esiste già
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    try:
+        for _ in range(2):
+            try:
+                os.link(tmp_file, path)
+                break
+            except FileExistsError:
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        holder = json.load(f)
+                except FileNotFoundError:
+                    continue
+                except (OSError, ValueError):
+                    holder = {}
+                if holder and not _is_stale(holder, max_hours):
+                    raise JobAlreadyRunning(f"Job '{name}' già in esecuzione (pid {holder.get('pid')} su {holder.get('host')} dal {holder.get('started')})")
+                # rimozione del lock scaduto sotto lock esclusivo, e solo se è ancora quello
+                # giudicato scaduto: se due processi lo trovano scaduto insieme, il secondo
+                # non deve cancellare il lock appena creato dal primo
+                with file_lock(path):
+                    try:
+                        with open(path, "r", encoding="utf-8") as f:
+                            current = json.load(f)
+                    except FileNotFoundError:
+                        continue
+                    except (OSError, ValueError):
+                        current = {}
+                    if current == holder:
+                        os.remove(path)
+        else:
+            raise JobAlreadyRunning(f"Impossibile acquisire il lock del job '{name}'")
+    finally:
+        os.remove(tmp_file)
+
+    try:
+        yield info
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,14 +1,19 @@
 import logging
 import json
 import os
-from fattureincloud_python_sdk.rest import ApiException
 import time
 from datetime import date,datetime, timedelta
 import calendar
+from filelocks import file_lock, atomic_write_json
+from ratelimit import non_preemptible
 
 
 CLIENTS_FILE = "fic_clients.json"
+# write-back dei singoli clienti fra un download e l'altro (una riga JSON per modifica),
+# uniti alla cache in lettura e riversati in CLIENTS_FILE da compact_clients_cache()
+CLIENTS_JOURNAL_FILE = "fic_clients.journal.jsonl"
 CACHE_DAYS = 5
+FIC_HOST = "https://api-v2.fattureincloud.it"
   # ID azienda su FIC
 
 
@@ -32,27 +37,211 @@ def log(msg,filename, level="notice"):
     else:
         logging.info(f"NOTICE: {msg}")
 
-def load_all_fic_clients(api_instance,log_filename,company_id):
-    # Controllo se esiste un file di cache valido
+def normalize_vat(vat):
+    """P.IVA normalizzata: senza spazi/punteggiatura, maiuscola, senza prefisso IT."""
+    value = "".join(ch for ch in str(vat or "") if ch.isalnum()).upper()
+    if value.startswith("IT") and value[2:].isdigit():
+        value = value[2:]
+    return value
+
+
+def normalize_tax_code(tax_code):
+    return "".join(ch for ch in str(tax_code or "") if ch.isalnum()).upper()
+
+
+def normalize_code(code):
+    return str(code or "").strip().upper()
+
+
+INDEX_KEYS = {
+    "vat": ("vat_number", normalize_vat),
+    "tax_code": ("tax_code", normalize_tax_code),
+    "code": ("code", normalize_code),
+}
+
+
+def build_client_index(clients):
+    """
+    Indice multi-chiave costruito in un solo passaggio sulla lista clienti FIC.
+    index[chiave][valore normalizzato] -> lista di id FIC; index["by_id"][id] -> record.
+    index["duplicates"] elenca i valori che puntano a più clienti.
+    """
+    index = {name: {} for name in INDEX_KEYS}
+    index["by_id"] = {}
+    for c in clients:
+        index["by_id"][c["id"]] = c
+        for name, (field, normalize) in INDEX_KEYS.items():
+            key = normalize(c.get(field))
+            if key:
+                index[name].setdefault(key, []).append(c["id"])
+    index["duplicates"] = {
+        f"{name}:{key}": ids
+        for name in INDEX_KEYS
+        for key, ids in index[name].items()
+        if len(ids) > 1
+    }
+    return index
+
+
+def find_client(index, vat=None, tax_code=None, code=None):
+    """Cerca il cliente per P.IVA, poi codice fiscale, poi codice CRM. Ritorna il record o None."""
+    for name, value in (("vat", vat), ("tax_code", tax_code), ("code", code)):
+        key = INDEX_KEYS[name][1](value)
+        ids = index[name].get(key) if key else None
+        if ids:
+            return index["by_id"][ids[0]]
+    return None
+
+
+def fic_configuration():
+    """
+    Configuration dell'SDK FIC. L'SDK è importato qui e non a livello di modulo:
+    i run che escono subito (mese già fatto, batch vuoto) non lo caricano mai.
+    """
+    import fattureincloud_python_sdk
+    configuration = fattureincloud_python_sdk.Configuration(host=FIC_HOST)
+    configuration.access_token = os.getenv("ACCESS_TOKEN")
+    return configuration
+
+
+def fic_client_record(c):
+    """Record di cache (dict serializzabile) da un Client dell'SDK."""
+    return {
+        "id": c.id,
+        "code": c.code or "",
+        "name": c.name,
+        "vat_number": c.vat_number or "",
+        'tax_code': c.tax_code or "",
+        "email": c.email or "",
+        "certified_email": c.certified_email or "",
+        "ei_code": c.ei_code or "",
+        "phone": c.phone or "",
+        "address_street": c.address_street or "",
+        'address_zip': c.address_postal_code  or "",
+        "address_city": c.address_city or "",
+        "address_province": c.address_province or "",
+        "contact_person": c.contact_person or "",
+        "notes": c.notes or "",
+        "default_payment_method": c.default_payment_method.id if c.default_payment_method else None,
+    }
+
+
+def _read_clients_file():
+    if not os.path.exists(CLIENTS_FILE):
+        return None
+    with open(CLIENTS_FILE, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    # vecchio formato: dizionario per P.IVA
+    clients = list(data.values()) if isinstance(data, dict) else data
+    return _apply_clients_journal(clients)
+
+
+def _read_clients_journal():
+    records = []
+    if not os.path.exists(CLIENTS_JOURNAL_FILE):
+        return records
+    with open(CLIENTS_JOURNAL_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # riga finale troncata
+    return records
+
+
+def _apply_clients_journal(clients):
+    """Applica alla lista del file i write-back registrati nel giornale, in ordine."""
+    journal = _read_clients_journal()
+    if not journal:
+        return clients
+    by_id = {c.get("id"): c for c in clients}
+    for entry in journal:
+        if entry.get("op") == "delete":
+            by_id.pop(entry["id"], None)
+        else:
+            record = entry["record"]
+            by_id[record["id"]] = {**by_id.get(record["id"], {}), **record}
+    return list(by_id.values())
+
+
+def _append_clients_journal(entry):
+    # chiamata sotto file_lock(CLIENTS_FILE): la compattazione non può troncare il giornale a metà
+    with open(CLIENTS_JOURNAL_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _fresh_clients_cache():
+    """Lista clienti dalla cache se non più vecchia di CACHE_DAYS, altrimenti None."""
     if os.path.exists(CLIENTS_FILE):
         file_age_days = (datetime.now() - datetime.fromtimestamp(os.path.getmtime(CLIENTS_FILE))).days
         if file_age_days <= CACHE_DAYS:
-            log(f"Carico i clienti da cache locale ({CLIENTS_FILE})",log_filename, "notice")
-            with open(CLIENTS_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        else:
+            return _read_clients_file()
+    return None
+
+
+def fic_api_client(workers=1, pool_manager=None):
+    """
+    ApiClient dell'SDK con trasporto configurato (transport.py: pool, timeout,
+    compressione) e rate limiter condiviso fra processi (ratelimit.py).
+    Con FIC_CASSETTE_RECORD / FIC_CASSETTE_REPLAY il traffico viene registrato
+    o servito da una cassetta (cassette.py); in replay il limiter non serve.
+    Da usare come context manager al posto di ApiClient(configuration).
+    """
+    import fattureincloud_python_sdk
+    from ratelimit import install_rate_limiter
+    from transport import configure_transport, install_transport
+    from cassette import cassette_pool_manager, replay_active
+
+    configuration = configure_transport(fic_configuration(), workers=workers)
+    api_client = fattureincloud_python_sdk.ApiClient(configuration)
+    pool_manager = cassette_pool_manager(pool_manager or api_client.rest_client.pool_manager) or pool_manager
+    install_transport(api_client, pool_manager=pool_manager)
+    if replay_active():
+        return api_client
+    return install_rate_limiter(api_client)
+
+
+def load_fic_clients_list(api_instance,log_filename,company_id):
+    # Controllo se esiste un file di cache valido (lock condiviso: più lettori insieme)
+    with file_lock(CLIENTS_FILE, shared=True):
+        cached = _fresh_clients_cache()
+    if cached is not None:
+        log(f"Carico i clienti da cache locale ({CLIENTS_FILE})",log_filename, "notice")
+        return cached
+
+    # Rigenerazione sotto lock esclusivo: un solo processo scarica, gli altri aspettano
+    with file_lock(CLIENTS_FILE):
+        cached = _fresh_clients_cache()
+        if cached is not None:
+            log(f"Cache clienti rigenerata da un altro processo, la uso ({CLIENTS_FILE})",log_filename, "notice")
+            return cached
+        if os.path.exists(CLIENTS_FILE):
             log(f"Cache obsoleta (>{CACHE_DAYS} giorni), rigenero da API",log_filename, "warning")
-            os.remove(CLIENTS_FILE)
+        # niente sospensione dello scheduler mentre tengo il lock esclusivo
+        with non_preemptible():
+            return _download_fic_clients(api_instance, log_filename, company_id)
+
+
+def refresh_fic_clients_cache(api_instance,log_filename,company_id):
+    """Riscarica la lista clienti da API indipendentemente dall'età della cache."""
+    with file_lock(CLIENTS_FILE), non_preemptible():
+        return _download_fic_clients(api_instance, log_filename, company_id)
+
+
+def _download_fic_clients(api_instance,log_filename,company_id):
+    from fattureincloud_python_sdk.rest import ApiException
 
     # Se arrivo qui → devo scaricare da API
-    all_clients = {}
+    all_clients = []
     page = 1
     while True:
         try:
             resp = api_instance.list_clients(
                 company_id,
                 fieldset="detailed",  # o "basic", come preferisci
-                fields="id,name,vat_number,tax_code,certified_email,ei_code,address_street,address_zip,address_city,address_province,email,phone",
+                fields="id,code,name,vat_number,tax_code,certified_email,ei_code,address_street,address_zip,address_city,address_province,email,phone,contact_person,notes,default_payment_method",
                 per_page=100,
                 page=page
             )
@@ -63,31 +252,147 @@ def load_all_fic_clients(api_instance,log_filename,company_id):
         if not resp.data or len(resp.data) == 0:
             break
 
-          
+        # Per JSON serializzo come dict (anche i clienti senza P.IVA)
         for c in resp.data:
-            if c.vat_number:
-                # Per JSON serializzo come dict
-                all_clients[c.vat_number] = {
-                    "id": c.id,
-                    "name": c.name,
-                    "vat_number": c.vat_number,
-                    'tax_code': c.tax_code or "",
-                    "email": c.email or "",
-                    "certified_email": c.certified_email or "",
-                    "ei_code": c.ei_code or "",
-                    "phone": c.phone or "",
-                    "address_street": c.address_street or "",
-                    'address_zip': c.address_postal_code  or "",
-                    "address_city": c.address_city or "",
-                    "address_province": c.address_province or "",
-                }
+            all_clients.append(fic_client_record(c))
 
         page += 1
 
-    # Salvo i risultati in cache
+    # Salvo i risultati in cache (scrittura atomica: i lettori non vedono mai un file troncato)
     if all_clients:
-        with open(CLIENTS_FILE, "w", encoding="utf-8") as f:
-            json.dump(all_clients, f, ensure_ascii=False, indent=2)
+        atomic_write_json(CLIENTS_FILE, all_clients, indent=2)
+        # il download completo contiene già tutti i write-back precedenti
+        if os.path.exists(CLIENTS_JOURNAL_FILE):
+            os.remove(CLIENTS_JOURNAL_FILE)
         log(f"Salvati {len(all_clients)} clienti in {CLIENTS_FILE}",log_filename, "notice")
 
     return all_clients
+
+
+def load_fic_client_index(api_instance,log_filename,company_id):
+    index = build_client_index(load_fic_clients_list(api_instance, log_filename, company_id))
+    if index["duplicates"]:
+        log(f"Clienti FIC duplicati: {len(index['duplicates'])} chiavi con più id ({', '.join(list(index['duplicates'])[:10])}...)",
+            log_filename, "warning")
+    return index
+
+
+def _index_remove(index, record):
+    for name, (field, normalize) in INDEX_KEYS.items():
+        key = normalize(record.get(field))
+        ids = index[name].get(key)
+        if ids and record["id"] in ids:
+            ids.remove(record["id"])
+            if not ids:
+                del index[name][key]
+
+
+def _index_add(index, record):
+    index["by_id"][record["id"]] = record
+    for name, (field, normalize) in INDEX_KEYS.items():
+        key = normalize(record.get(field))
+        if key:
+            index[name].setdefault(key, []).append(record["id"])
+
+
+def write_back_client(index, record):
+    """
+    Aggiorna (o aggiunge, se nuovo) il cliente nell'indice in memoria e nella
+    cache su disco dopo una modify/create andata a buon fine. Su disco il record
+    viene solo aggiunto al giornale (CLIENTS_JOURNAL_FILE), non si riscrive
+    tutta la cache per ogni cliente: chi legge la cache vede subito anche i
+    write-back, e compact_clients_cache() li riversa nel file a fine batch.
+    Con `index` None aggiorna solo il disco (es. eventi webhook).
+    """
+    if index is not None:
+        old = index["by_id"].get(record["id"])
+        if old is not None:
+            _index_remove(index, old)
+            record = {**old, **record}
+        _index_add(index, record)
+
+    with file_lock(CLIENTS_FILE):
+        _append_clients_journal({"op": "upsert", "record": record})
+    return record
+
+
+def remove_cached_client(index, client_id):
+    """Toglie un cliente eliminato su FIC dall'indice (se non None) e dalla cache su disco."""
+    if index is not None:
+        old = index["by_id"].pop(client_id, None)
+        if old is not None:
+            _index_remove(index, old)
+
+    with file_lock(CLIENTS_FILE):
+        clients = _read_clients_file()
+        if not clients or all(c.get("id") != client_id for c in clients):
+            return False
+        _append_clients_journal({"op": "delete", "id": client_id})
+        return True
+
+
+def clients_cache_fingerprint():
+    """Impronta (sha256) della cache clienti su disco, giornale dei write-back compreso; None senza cache."""
+    import hashlib
+
+    with file_lock(CLIENTS_FILE, shared=True):
+        if not os.path.exists(CLIENTS_FILE):
+            return None
+        digest = hashlib.sha256()
+        for path in (CLIENTS_FILE, CLIENTS_JOURNAL_FILE):
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+
+def compact_clients_cache():
+    """
+    Riversa il giornale dei write-back nella cache clienti con una sola
+    lettura-unione-scrittura sotto lock esclusivo (es. a fine batch della sync).
+    La data del file resta quella del download completo, così i write-back non
+    allungano la validità della cache (CACHE_DAYS). Ritorna le voci riversate.
+    """
+    with file_lock(CLIENTS_FILE):
+        journal = _read_clients_journal()
+        if not journal:
+            return 0
+        clients = _read_clients_file()
+        if clients is not None:
+            atomic_write_json(CLIENTS_FILE, clients, keep_mtime=True, indent=2)
+        os.remove(CLIENTS_JOURNAL_FILE)
+        return len(journal)
+
+
+def load_all_fic_clients(api_instance,log_filename,company_id):
+    """Dizionario P.IVA normalizzata -> cliente FIC (il primo, in caso di duplicati)."""
+    index = load_fic_client_index(api_instance, log_filename, company_id)
+    return {vat: index["by_id"][ids[0]] for vat, ids in index["vat"].items()}
+
+
+def run_startup_tasks(tasks, log_filename):
+    """
+    Esegue in parallelo le letture di avvio indipendenti (DB, cache clienti, API)
+    e attende tutti i risultati. `tasks` è un dict nome -> funzione senza argomenti.
+    Logga la durata di ogni fase e quella complessiva; le eccezioni vengono propagate.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    timings = {}
+
+    def timed(name, fn):
+        t0 = time.perf_counter()
+        try:
+            return fn()
+        finally:
+            timings[name] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {name: executor.submit(timed, name, fn) for name, fn in tasks.items()}
+        results = {name: future.result() for name, future in futures.items()}
+    elapsed = time.perf_counter() - t0
+
+    phases = ", ".join(f"{name}={timings[name]:.2f}s" for name in tasks)
+    log(f"Avvio completato in {elapsed:.2f}s ({phases})", log_filename, "notice")
+    return results
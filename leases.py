@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from filelocks import file_lock, atomic_write_json
+
+# Lease con heartbeat per dividere il lavoro fra più worker, anche su host
+# diversi che condividono la cartella (es. NFS). Un lease è un file JSON con
+# proprietario e ultimo heartbeat: finché il proprietario lo rinnova nessun
+# altro lo prende; se il worker muore, dopo LEASE_TTL secondi il lease scade e
+# un altro worker lo recupera. I tempi sono confrontati fra host diversi: gli
+# orologi vanno tenuti sincronizzati (NTP), LEASE_TTL copre piccoli scarti.
+LEASE_DIR = "leases"
+LEASE_TTL = 120.0
+HEARTBEAT_SECONDS = 30.0
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _lease_path(name):
+    return os.path.join(LEASE_DIR, f"{name}.lease")
+
+
+def _read(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def try_claim(name, owner, ttl=LEASE_TTL):
+    """
+    Prende il lease `name` se è libero, scaduto o già nostro. Ritorna il contenuto
+    del lease (con `reclaimed_from` se era di un worker scaduto) o None se è occupato.
+    """
+    os.makedirs(LEASE_DIR, exist_ok=True)
+    path = _lease_path(name)
+    with file_lock(path):
+        current = _read(path)
+        now = time.time()
+        if current and current.get("owner") != owner and now - current.get("heartbeat", 0) < ttl:
+            return None
+        lease = {
+            "owner": owner,
+            "heartbeat": now,
+            "claimed_at": now if not current or current.get("owner") != owner else current.get("claimed_at", now),
+            "reclaimed_from": current.get("owner") if current and current.get("owner") != owner else None,
+        }
+        atomic_write_json(path, lease)
+        return lease
+
+
+def renew(name, owner):
+    """Aggiorna l'heartbeat. Ritorna False se il lease è passato a un altro worker."""
+    path = _lease_path(name)
+    with file_lock(path):
+        current = _read(path)
+        if not current or current.get("owner") != owner:
+            return False
+        current["heartbeat"] = time.time()
+        atomic_write_json(path, current)
+        return True
+
+
+def release(name, owner):
+    path = _lease_path(name)
+    with file_lock(path):
+        current = _read(path)
+        if current and current.get("owner") == owner:
+            os.remove(path)
+
+
+@contextmanager
+def held_lease(name, owner, heartbeat_seconds=HEARTBEAT_SECONDS):
+    """
+    Tiene il lease `name` (già preso con try_claim) rinnovandolo in un thread.
+    L'evento restituito viene impostato se il lease viene perso: chi lavora
+    deve controllarlo e fermarsi al prossimo elemento.
+    """
+    lost = threading.Event()
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(heartbeat_seconds):
+            try:
+                still_ours = renew(name, owner)
+            except OSError:
+                # filesystem condiviso momentaneamente non raggiungibile: riprovo al giro dopo
+                continue
+            if not still_ours:
+                lost.set()
+                return
+
+    thread = threading.Thread(target=heartbeat, name=f"lease-{name}", daemon=True)
+    thread.start()
+    try:
+        yield lost
+    finally:
+        stop.set()
+        thread.join()
+        if not lost.is_set():
+            release(name, owner)
+
@@ -1,33 +1,17 @@
 import os
 import json
 from dotenv import load_dotenv
-import fattureincloud_python_sdk
-from globalutils import log, load_all_fic_clients, end_of_month
-from fattureincloud_python_sdk.api import issued_documents_api
-from fattureincloud_python_sdk.models import (
-    Entity,
-    IssuedDocument,
-    IssuedDocumentType,
-    Currency,
-    Language,
-    IssuedDocumentItemsListItem,
-    CreateIssuedDocumentRequest,
-    GetNewIssuedDocumentTotalsRequest,
-    IssuedDocumentOptions,
-    IssuedDocumentPaymentsListItem,
-    VatType,   # <-- per impostare l'aliquota 22%
-)
-# aggiungi in alto tra gli import
-from fattureincloud_python_sdk.rest import ApiException
+from globalutils import log, load_all_fic_clients, end_of_month, normalize_vat, fic_api_client
 from dbconn import getdbconn
+from cassette import replay_scrub
+from refcache import get_refdata, find_ref, name_to_id, vat_type_id, DEFAULT_VAT_ID
+from profiler import add_profile_argument, enable_profiling, phase, write_profile_report
+from runhistory import add_counts, note_batch, record_run
+from docnumbers import allocate, mark_used
 import time
 from datetime import datetime, timedelta, date
 
 
-configuration = fattureincloud_python_sdk.Configuration(
-    host="https://api-v2.fattureincloud.it"
-)
-configuration.access_token = os.getenv("ACCESS_TOKEN")
 company_id = int(os.getenv("COMPANY_ID"))   # ID azienda su FIC
 log_filename = f"orders-{datetime.now().strftime('%Y%m%d')}.log"
 
@@ -85,36 +69,53 @@ def get_orders_of_the_customer(vatid):
     results = cursor.fetchall()
     cursor.close()
     connection.close()
-    return results
+    return replay_scrub(results)
 
         
 def  get_payment_method_id(api_client,company_id,payment_method):
-    info_api = fattureincloud_python_sdk.InfoApi(api_client)
+    # dalla cache dei dati di riferimento: nessuna chiamata API a cache calda
     try:
-        pm_resp = info_api.list_payment_methods(company_id)
+        items = get_refdata("payment_methods", api_client, company_id, log_filename)
     except Exception as e:
         log(f"Il metodo list_payment_methods non funziona dettagli: {e}",log_filename,"error")
+        return None
+
+    item = find_ref("payment_methods", items, name=payment_method)
+    return item["id"] if item else None
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="Genera gli ordini del mese corrente per un singolo cliente")
+    add_profile_argument(parser)
+    return parser.parse_args()
 
-    name_to_id = {m.name: m.id for m in pm_resp.data}
-    payment_method_id = name_to_id.get(payment_method)
-    
-    return payment_method_id 
 
 # --- MAIN ---
-if __name__ == "__main__":
+def main():
+    args = parse_args()
+    if args.profile is not None:
+        enable_profiling(args.profile)
+
     vat_id_input = input("Inserisci VAT ID da usare per le righe: ").strip()
 
     if not vat_id_input:
         print("VAT ID non valido")
         raise SystemExit(1)
    
+    # senza progressivo il numero viene dall'allocatore persistente (docnumbers.py),
+    # così non si scontra con i numeri di createOrders3
+    progressivo_input = input("Inserisci numero progressivo iniziale (invio = automatico): ").strip()
     try:
-        progressivo = int(input("Inserisci numero progressivo iniziale: ").strip())
+        progressivo = int(progressivo_input) if progressivo_input else None
     except ValueError:
         print("Progressivo non valido")
         raise SystemExit(1) 
+    auto_number = progressivo is None
+    run_stamp = datetime.now().strftime("%Y%m%d%H%M%S")
     
-    results = get_orders_of_the_customer(vat_id_input)
+    with phase("extract"):
+        results = get_orders_of_the_customer(vat_id_input)
     current_month = date.today().strftime("%Y-%m")
     
     print("ATTENZIONE PER GLIORDINI ON DEMAND NON FACCIO CONTROLLI")
@@ -125,12 +126,37 @@ if __name__ == "__main__":
         log(f"Nessun ordine trovato dal gestionale per il mese corrente per {vat_id_input} - TERMINO", log_filename, "warning")
         raise SystemExit(0)
 
-    with fattureincloud_python_sdk.ApiClient(configuration) as api_client:
+    import fattureincloud_python_sdk
+    from fattureincloud_python_sdk.api import issued_documents_api
+    from fattureincloud_python_sdk.models import (
+        Entity,
+        IssuedDocument,
+        IssuedDocumentType,
+        Currency,
+        Language,
+        IssuedDocumentItemsListItem,
+        CreateIssuedDocumentRequest,
+        IssuedDocumentOptions,
+        IssuedDocumentPaymentsListItem,
+        VatType,   # <-- per impostare l'aliquota 22%
+    )
+    from fattureincloud_python_sdk.rest import ApiException
+
+    with fic_api_client() as api_client:
         clients_api = fattureincloud_python_sdk.ClientsApi(api_client)
         docs_api = issued_documents_api.IssuedDocumentsApi(api_client)
 
         # cache clienti FIC
-        fic_clients = load_all_fic_clients(clients_api, log_filename, company_id)
+        with phase("cache_load"):
+            fic_clients = load_all_fic_clients(clients_api, log_filename, company_id)
+
+        # aliquota IVA ordinaria dalla cache dei dati di riferimento
+        with phase("refdata"):
+            try:
+                vat_id = vat_type_id(get_refdata("vat_types", api_client, company_id, log_filename), log_filename=log_filename)
+            except Exception as e:
+                log(f"Impossibile caricare le aliquote IVA, uso l'aliquota predefinita: {e}", log_filename, "warning")
+                vat_id = DEFAULT_VAT_ID
 
         # numerazione e date documento
         order_date = date.today().strftime("%Y-%m-%d")
@@ -142,87 +168,93 @@ if __name__ == "__main__":
         existing = None
         client_id = None
         # COSTRUZIONE ORDINI (come già facevi)
-        for row in results:
-            vat = (row["vat_number"] or "").strip()
-            if skip_current_vat and vat == current_vat:
-                continue
+        with phase("build"):
+            for row in results:
+                vat = (row["vat_number"] or "").strip()
+                if skip_current_vat and vat == current_vat:
+                    continue
 
-            # cambio cliente -> chiudi ordine precedente
-            if vat != current_vat:
-                if order:
-                    orders.append(order)
-                    order = None
+                # cambio cliente -> chiudi ordine precedente
+                if vat != current_vat:
+                    if order:
+                        orders.append(order)
+                        order = None
 
-                current_vat = vat
-                skip_current_vat = False
-                progressivo += 1
+                    current_vat = vat
+                    skip_current_vat = False
+                    if not auto_number:
+                        progressivo += 1
 
-                existing = fic_clients.get(current_vat)
-                client_id = existing.get("id") if isinstance(existing, dict) else None
+                    existing = fic_clients.get(normalize_vat(current_vat))
+                    client_id = existing.get("id") if isinstance(existing, dict) else None
 
                
-                if not client_id:
-                    log(f"Cliente P.IVA {current_vat} non presente su FIC: salto tutte le righe.", log_filename, "warning")
-                    skip_current_vat = True
-                    order = None
-                    continue
+                    if not client_id:
+                        log(f"Cliente P.IVA {current_vat} non presente su FIC: salto tutte le righe.", log_filename, "warning")
+                        skip_current_vat = True
+                        order = None
+                        continue
+
+                    if auto_number:
+                        # chiave unica per run: gli ordini on demand si aggiungono a quelli del mese
+                        progressivo = allocate(company_id, current_month,
+                                               f"single:{normalize_vat(current_vat)}:{run_stamp}:{len(orders) + 1}")
+
+                if order is None:
+                    if not isinstance(existing, dict):
+                        log(f"ANCORA!!! Cliente P.IVA {current_vat}: dati cliente non disponibili (existing={type(existing)}). Salto.", log_filename, "warning")
+                        skip_current_vat = True
+                        continue
+                    ent = Entity(
+                        id=client_id,
+                        name=existing.get("name"),
+                        address_street=existing.get("address_street"),
+                        address_postal_code=existing.get("address_zip"),
+                        address_city=existing.get("address_city"),
+                        address_province=existing.get("address_province"),
+                        certified_email=existing.get("certified_email"),
+                        email=existing.get("email"),
+                        tax_code=existing.get("tax_code"),
+                        vat_number=existing.get("vat_number"),
+                    )
 
-            if order is None:
-                if not isinstance(existing, dict):
-                    log(f"ANCORA!!! Cliente P.IVA {current_vat}: dati cliente non disponibili (existing={type(existing)}). Salto.", log_filename, "warning")
-                    skip_current_vat = True
-                    continue
-                ent = Entity(
-                    id=client_id,
-                    name=existing.get("name"),
-                    address_street=existing.get("address_street"),
-                    address_postal_code=existing.get("address_zip"),
-                    address_city=existing.get("address_city"),
-                    address_province=existing.get("address_province"),
-                    certified_email=existing.get("certified_email"),
-                    email=existing.get("email"),
-                    tax_code=existing.get("tax_code"),
-                    vat_number=existing.get("vat_number"),
-                )
-
-                # opzionale: mappa metodo pagamento dal nome all'id se vuoi impostarlo sul documento
-                pm_id = None
-                try:
-                    pm_id = get_payment_method_id(api_client, company_id, row["default_payment_method"])
-                except Exception:
+                    # opzionale: mappa metodo pagamento dal nome all'id se vuoi impostarlo sul documento
                     pm_id = None
+                    try:
+                        pm_id = get_payment_method_id(api_client, company_id, row["default_payment_method"])
+                    except Exception:
+                        pm_id = None
+
+                    order = IssuedDocument(
+                        payment_method=(fattureincloud_python_sdk.PaymentMethod(id=pm_id) if pm_id else None),
+                        type=IssuedDocumentType("order"),
+                        entity=ent,
+                        date=order_date,
+                        due_date=due_eom,
+                        number=progressivo,
+                        currency=Currency(id="EUR"),
+                        language=Language(code="it", name="italiano"),
+                        items_list=[],
+                        show_payments=True,
+                        show_payment_method=True
+                    )
 
-                order = IssuedDocument(
-                    payment_method=(fattureincloud_python_sdk.PaymentMethod(id=pm_id) if pm_id else None),
-                    type=IssuedDocumentType("order"),
-                    entity=ent,
-                    date=order_date,
-                    due_date=due_eom,
-                    number=progressivo,
-                    currency=Currency(id="EUR"),
-                    language=Language(code="it", name="italiano"),
-                    items_list=[],
-                    show_payments=True,
-                    show_payment_method=True
-                )
-
-            # aggiungi riga
-            if order:
-                order.items_list.append(
-                    IssuedDocumentItemsListItem(
-                        code=row["service_no"],
-                        name=row["servicename"],
-                        description=row["comment"],
-                        net_price=float(row["listprice"]),
-                        qty=float(row["quantity"]),
-                        discount=float(row["discount"]),
-                        # TODO: imposta l'IVA corretta qui (VatType(id=...))
-                        vat=VatType(id=0)  # placeholder: sostituisci col tuo vat.id valido
+                # aggiungi riga
+                if order:
+                    order.items_list.append(
+                        IssuedDocumentItemsListItem(
+                            code=row["service_no"],
+                            name=row["servicename"],
+                            description=row["comment"],
+                            net_price=float(row["listprice"]),
+                            qty=float(row["quantity"]),
+                            discount=float(row["discount"]),
+                            vat=VatType(id=vat_id)
+                        )
                     )
-                )
 
-        if order:
-            orders.append(order)
+            if order:
+                orders.append(order)
 
         if not orders:
             log("Nessun ordine costruito (tutti i clienti mancanti o nessuna riga valida).", log_filename, "warning")
@@ -242,35 +274,50 @@ if __name__ == "__main__":
         ok = 0
         ko = 0
 
-        for i, od in enumerate(batch, start=start+1):
-            try:
-                # pagamento placeholder (l’API adegua l’ultimo con fix_payments=True)
-                od.payments_list = [
-                    IssuedDocumentPaymentsListItem(
-                        amount=0.0,
-                        due_date=due_eom,
-                        status="not_paid"
-                    )
-                ]
-
-                resp = docs_api.create_issued_document(
-                    company_id,
-                    create_issued_document_request=CreateIssuedDocumentRequest(
-                        data=od,
-                        options=IssuedDocumentOptions(fix_payments=True)
+        with phase("send"):
+            for i, od in enumerate(batch, start=start+1):
+                try:
+                    # pagamento placeholder (l’API adegua l’ultimo con fix_payments=True)
+                    od.payments_list = [
+                        IssuedDocumentPaymentsListItem(
+                            amount=0.0,
+                            due_date=due_eom,
+                            status="not_paid"
+                        )
+                    ]
+
+                    resp = docs_api.create_issued_document(
+                        company_id,
+                        create_issued_document_request=CreateIssuedDocumentRequest(
+                            data=od,
+                            options=IssuedDocumentOptions(fix_payments=True)
+                        )
                     )
-                )
-                ok += 1
-                log(f"[{i}/{total}] Ordine creato: id={getattr(resp.data, 'id', None)} "
-                    f"numero={getattr(resp.data, 'number', None)}", log_filename, "notice")
-                # (opzionale) breve pausa per essere gentili con l'API/DB
-                # time.sleep(0.05)
-
-            except ApiException as e:
-                ko += 1
-                log(f"[{i}/{total}] Errore creazione ordine: {e}", log_filename, "error")
-                # (opzionale) backoff leggero se ricevi errori di tipo "troppi collegamenti"
-                # time.sleep(0.5)
+                    ok += 1
+                    if auto_number:
+                        mark_used(company_id, current_month, od.number)
+                    log(f"[{i}/{total}] Ordine creato: id={getattr(resp.data, 'id', None)} "
+                        f"numero={getattr(resp.data, 'number', None)}", log_filename, "notice")
+                    # (opzionale) breve pausa per essere gentili con l'API/DB
+                    # time.sleep(0.05)
+
+                except ApiException as e:
+                    ko += 1
+                    log(f"[{i}/{total}] Errore creazione ordine: {e}", log_filename, "error")
+                    # (opzionale) backoff leggero se ricevi errori di tipo "troppi collegamenti"
+                    # time.sleep(0.5)
 
         print(f"Batch completato. OK={ok}  KO={ko}")
+        add_counts(ok=ok, ko=ko)
+        note_batch(start + 1, end, total)
 
+
+if __name__ == "__main__":
+    # storico e profilo anche per i run che escono prima (SystemExit, errori)
+    try:
+        try:
+            main()
+        finally:
+            record_run("order-single", log_filename)
+    finally:
+        write_profile_report("order-single", log_filename)
@@ -0,0 +1,156 @@
+"""
+Piano ordini del mese materializzato su file (order_plan-YYYY-MM.jsonl).
+
+Il primo run del mese costruisce tutti gli IssuedDocument una volta sola e li
+scrive in forma compatta, una riga per ordine, preceduti da un'intestazione
+con versione del formato, checksum dei dati vtiger e numero di ordini. I run
+successivi leggono dal file solo la loro fetta (e gli ordini da ritentare
+della dead-letter queue), senza rifare la query completa, ricaricare i
+clienti e ricostruire il mese: il costo di un batch è proporzionale al batch.
+
+Il piano viene ricostruito quando il checksum dei dati vtiger cambia, quando
+cambia PLAN_VERSION o quando cambia la cache dei clienti FIC da cui vengono
+le entità degli ordini (cliente nuovo, modificato o eliminato: impronta
+"clients" nell'intestazione). Un mese senza ordini ha un piano vuoto, valido
+finché non cambia il checksum. La data dell'ordine non è nel piano: viene
+decisa al momento dell'invio, come prima.
+"""
+import os
+import json
+from datetime import datetime
+
+PLAN_VERSION = 2
+PLAN_FILE_TEMPLATE = "order_plan-{month}.jsonl"
+
+ENTITY_FIELDS = (
+    "id", "name", "address_street", "address_postal_code", "address_city",
+    "address_province", "certified_email", "email", "tax_code", "vat_number",
+)
+
+
+def plan_filename(month):
+    return PLAN_FILE_TEMPLATE.format(month=month)
+
+
+def compact_order(od):
+    """Riga di piano da un IssuedDocument costruito da build_orders."""
+    entity = {f: getattr(od.entity, f, None) for f in ENTITY_FIELDS}
+    payment_method = getattr(od, "payment_method", None)
+    return {
+        "vat": od.entity.vat_number,
+        "n": od.number,
+        "e": {f: v for f, v in entity.items() if v is not None},
+        "pm": payment_method.id if payment_method else None,
+        # code, name, description, net_price, qty, discount, id aliquota
+        "items": [[it.code, it.name, getattr(it, "description", None), it.net_price, it.qty, it.discount, it.vat.id]
+                  for it in od.items_list],
+    }
+
+
+def order_from_plan(entry, order_date, due_eom):
+    """IssuedDocument da una riga di piano, con data e scadenza del run corrente."""
+    import fattureincloud_python_sdk
+    from fattureincloud_python_sdk.models import (
+        Entity,
+        IssuedDocument,
+        IssuedDocumentType,
+        Currency,
+        Language,
+        IssuedDocumentItemsListItem,
+        VatType,
+    )
+
+    return IssuedDocument(
+        payment_method=(fattureincloud_python_sdk.PaymentMethod(id=entry["pm"]) if entry.get("pm") else None),
+        type=IssuedDocumentType("order"),
+        entity=Entity(**entry["e"]),
+        date=order_date,
+        due_date=due_eom,
+        number=entry["n"],
+        currency=Currency(id="EUR"),
+        language=Language(code="it", name="italiano"),
+        items_list=[
+            IssuedDocumentItemsListItem(code=code, name=name, description=description, net_price=net_price,
+                                        qty=qty, discount=discount, vat=VatType(id=vat_id))
+            for code, name, description, net_price, qty, discount, vat_id in entry["items"]
+        ],
+        show_payments=True,
+        show_payment_method=True
+    )
+
+
+def write_plan(month, checksum, orders, skipped=(), clients=None):
+    """
+    Scrive il piano del mese (scrittura atomica: file temporaneo + rename).
+    `orders` sono IssuedDocument, `skipped` le P.IVA saltate perché senza cliente FIC,
+    `clients` l'impronta della cache clienti usata per costruirli.
+    Ritorna l'intestazione scritta.
+    """
+    filename = plan_filename(month)
+    header = {
+        "version": PLAN_VERSION,
+        "month": month,
+        "checksum": checksum,
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "total": len(orders),
+        "skipped": sorted(set(skipped)),
+        "clients": clients,
+    }
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for od in orders:
+            f.write(json.dumps(compact_order(od), ensure_ascii=False, separators=(",", ":")) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+    return header
+
+
+def read_plan_header(month):
+    """Intestazione del piano del mese, o None se manca, è illeggibile o di un'altra versione."""
+    try:
+        with open(plan_filename(month), "r", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+    if header.get("version") != PLAN_VERSION or header.get("month") != month:
+        return None
+    return header
+
+
+def plan_is_current(header, checksum, clients):
+    """True se il piano salvato vale ancora per i dati vtiger (`checksum`) e per la cache clienti (`clients`)."""
+    if header is None or header["checksum"] != checksum:
+        return False
+    if not header["total"] and not header["skipped"]:
+        # mese senza righe vtiger: non dipende dai clienti FIC
+        return True
+    return header.get("clients") == clients
+
+
+def iter_plan(month, start, end, keys=()):
+    """
+    Righe di piano in posizione start+1..end (1-based) più quelle con chiave
+    ordine (orderwal.order_key) in `keys`, come coppie (posizione, riga).
+    Il file viene letto in streaming e la lettura si ferma appena non resta
+    niente da cercare.
+    """
+    from orderwal import order_key
+
+    wanted = set(keys)
+    with open(plan_filename(month), "r", encoding="utf-8") as f:
+        f.readline()  # intestazione
+        for i, line in enumerate(f, start=1):
+            if i > end and not wanted:
+                break
+            if start < i <= end:
+                entry = json.loads(line)
+                wanted.discard(order_key(entry["vat"], entry["n"]))
+                yield i, entry
+            elif wanted:
+                entry = json.loads(line)
+                key = order_key(entry["vat"], entry["n"])
+                if key in wanted:
+                    wanted.discard(key)
+                    yield i, entry
@@ -0,0 +1,114 @@
+import os
+import json
+from datetime import datetime
+from globalutils import log
+
+# Write-ahead log degli ordini: un file JSONL per mese, un record per evento.
+# Prima dell'invio scrivo "intent", dopo la risposta "ok" oppure "ko".
+# Un ordine con "intent" senza esito è "in volo" (crash/kill durante l'invio).
+WAL_FILE_TEMPLATE = "orders-wal-{month}.jsonl"
+
+# identificativo del run che scrive i record, per selezionare gli ordini di un run (rollbackOrders.py)
+RUN_ID = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+
+def wal_filename(month):
+    return WAL_FILE_TEMPLATE.format(month=month)
+
+
+def order_key(vat, number):
+    return f"{vat}/{number}"
+
+
+def wal_append(month, status, vat, number, **extra):
+    """Aggiunge un record al WAL del mese e forza la scrittura su disco (fsync)."""
+    record = {
+        "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "status": status,
+        "vat": vat,
+        "number": number,
+        "run": RUN_ID,
+    }
+    record.update(extra)
+    with open(wal_filename(month), "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    return record
+
+
+def wal_load(month):
+    """
+    Rilegge il WAL del mese e ritorna {chiave ordine: ultimo record}.
+    Una riga finale troncata (crash a metà scrittura) viene ignorata.
+    """
+    last = {}
+    filename = wal_filename(month)
+    if not os.path.exists(filename):
+        return last
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            last[order_key(record.get("vat"), record.get("number"))] = record
+    return last
+
+
+def wal_done_keys(month):
+    return {k for k, r in wal_load(month).items() if r.get("status") == "ok"}
+
+
+def wal_sent(month):
+    """Ordini del mese presenti su FIC secondo il WAL (ultimo stato "ok" con id documento)."""
+    return [r for r in wal_load(month).values() if r.get("status") == "ok" and r.get("doc_id")]
+
+
+def wal_inflight(month):
+    return [r for r in wal_load(month).values() if r.get("status") == "intent"]
+
+
+def recover_inflight(docs_api, company_id, month, log_filename):
+    """
+    Riconcilia gli ordini rimasti "in volo": cerco su FIC un ordine con stesso
+    numero e data; se esiste e la P.IVA coincide lo segno "ok", altrimenti
+    lo segno "aborted" così verrà reinviato.
+    """
+    from fattureincloud_python_sdk.rest import ApiException
+
+    recovered = 0
+    aborted = 0
+    for r in wal_inflight(month):
+        vat, number, order_date = r.get("vat"), r.get("number"), r.get("date")
+        try:
+            resp = docs_api.list_issued_documents(
+                company_id,
+                type="order",
+                fields="id,number,date,entity",
+                q=f"number = {int(number)} and date = '{order_date}'",
+            )
+        except ApiException as e:
+            log(f"Recupero ordine in volo {vat}/{number} fallito: {e}", log_filename, "error")
+            continue
+
+        match = None
+        for doc in (resp.data or []):
+            entity = getattr(doc, "entity", None)
+            if entity is not None and (getattr(entity, "vat_number", None) or "").strip() == vat:
+                match = doc
+                break
+
+        if match is not None:
+            wal_append(month, "ok", vat, number, date=order_date, doc_id=match.id, recovered=True, run=r.get("run", RUN_ID))
+            log(f"Ordine in volo {vat}/{number} trovato su FIC (id={match.id}): segnato come inviato.", log_filename, "notice")
+            recovered += 1
+        else:
+            wal_append(month, "aborted", vat, number, date=order_date)
+            log(f"Ordine in volo {vat}/{number} non presente su FIC: verrà reinviato.", log_filename, "warning")
+            aborted += 1
+
+    return recovered, aborted
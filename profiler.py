@@ -0,0 +1,217 @@
+"""
+Profilazione per fasi degli entry point (--profile).
+
+Ogni fase (extract, cache_load, refdata, build, diff, send) viene cronometrata
+sempre, con il numero di chiamate API fatte nel frattempo; con --profile cpu
+si aggiunge un profilo cProfile per fase, con --profile mem le misure
+tracemalloc (memoria netta, picco, allocazioni principali). Il report JSON
+profile-<job>-YYYYmmdd-HHMMSS.json si confronta fra due run con:
+
+  python profiler.py profile-sync-A.json profile-sync-B.json
+
+Le fasi di avvio girano in parallelo (run_startup_tasks): le chiamate API e la
+memoria di fasi sovrapposte non sono separabili e vanno lette come indicative.
+"""
+import os
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import ratelimit
+
+PROFILE_DIR = "profiles"
+PROFILE_OPTIONS = ("cpu", "mem")
+TOP_ALLOCATIONS = 15
+SNAPSHOT_INTERVAL = 1.0   # secondi minimi fra due snapshot della stessa fase (fasi ripetute nei cicli)
+
+PHASES = {}
+_options = set()
+_lock = threading.Lock()
+_cpu_profiles = {}
+_snapshots = {}
+_mem_baseline = None
+_started = time.perf_counter()
+
+
+def add_profile_argument(parser):
+    parser.add_argument(
+        "--profile", nargs="*", choices=PROFILE_OPTIONS, metavar="OPZ",
+        help="scrive un report con i tempi per fase; 'cpu' aggiunge cProfile, 'mem' tracemalloc"
+    )
+
+
+def enable_profiling(options=()):
+    """Attiva il report di profilazione con le opzioni indicate (sottoinsieme di PROFILE_OPTIONS)."""
+    global _mem_baseline
+    _options.clear()
+    _options.update(options)
+    _options.add("time")
+    if "mem" in _options:
+        import tracemalloc
+        tracemalloc.start()
+        _mem_baseline = tracemalloc.take_snapshot()
+
+
+def profiling_enabled():
+    return bool(_options)
+
+
+def _phase_entry(name):
+    return PHASES.setdefault(name, {"seconds": 0.0, "count": 0, "api_calls": 0})
+
+
+@contextmanager
+def phase(name):
+    """Cronometra la fase `name`; le fasi ripetute (es. in un ciclo) si sommano."""
+    cpu = None
+    if "cpu" in _options:
+        import cProfile
+        with _lock:
+            cpu = _cpu_profiles.setdefault(name, cProfile.Profile())
+        try:
+            cpu.enable()
+        except ValueError:
+            # un altro profiler è già attivo (fase parallela): questa resta senza profilo CPU
+            cpu = None
+    mem_before = None
+    if "mem" in _options:
+        import tracemalloc
+        mem_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    calls_before = ratelimit.STATS["calls"]
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        if cpu is not None:
+            cpu.disable()
+        with _lock:
+            entry = _phase_entry(name)
+            entry["seconds"] += elapsed
+            entry["count"] += 1
+            entry["api_calls"] += ratelimit.STATS["calls"] - calls_before
+        if mem_before is not None:
+            _record_memory(name, mem_before)
+
+
+def _record_memory(name, mem_before):
+    import tracemalloc
+
+    current, peak = tracemalloc.get_traced_memory()
+    now = time.perf_counter()
+    with _lock:
+        entry = _phase_entry(name)
+        entry["mem_net_kb"] = entry.get("mem_net_kb", 0) + (current - mem_before) // 1024
+        entry["mem_peak_kb"] = max(entry.get("mem_peak_kb", 0), peak // 1024)
+        last = _snapshots.get(name)
+        take = last is None or now - last[0] >= SNAPSHOT_INTERVAL
+    if take:
+        snapshot = tracemalloc.take_snapshot()
+        with _lock:
+            _snapshots[name] = (now, snapshot)
+
+
+def timed(name, fn):
+    """Versione di `fn` (senza argomenti) eseguita dentro phase(name), per run_startup_tasks."""
+    def run():
+        with phase(name):
+            return fn()
+    return run
+
+
+def phase_timings():
+    """Secondi per fase del run corrente."""
+    with _lock:
+        return {name: round(entry["seconds"], 3) for name, entry in PHASES.items()}
+
+
+def _top_allocations(snapshot):
+    stats = snapshot.compare_to(_mem_baseline, "lineno") if _mem_baseline is not None else snapshot.statistics("lineno")
+    return [
+        {"where": str(stat.traceback), "size_kb": stat.size // 1024,
+         "diff_kb": getattr(stat, "size_diff", 0) // 1024, "count": stat.count}
+        for stat in stats[:TOP_ALLOCATIONS]
+    ]
+
+
+def write_profile_report(job, log_filename=None):
+    """Scrive il report del run in PROFILE_DIR e ritorna il percorso (None se la profilazione è spenta)."""
+    if not _options:
+        return None
+
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"profile-{job}-{stamp}")
+
+    with _lock:
+        phases = {name: dict(entry) for name, entry in PHASES.items()}
+    report = {
+        "job": job,
+        "started_at": stamp,
+        "wall_seconds": round(time.perf_counter() - _started, 3),
+        "options": sorted(_options),
+        "api": dict(ratelimit.STATS),
+        "phases": phases,
+    }
+
+    for name, cpu in _cpu_profiles.items():
+        import pstats
+        prof_file = f"{base}-{name}.prof"
+        cpu.dump_stats(prof_file)
+        phases[name]["cpu_profile"] = prof_file
+        phases[name]["cpu_top"] = _cpu_top(pstats.Stats(cpu))
+
+    if "mem" in _options:
+        import tracemalloc
+        report["mem_peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        for name, (_, snapshot) in _snapshots.items():
+            phases[name]["top_allocations"] = _top_allocations(snapshot)
+
+    for entry in phases.values():
+        entry["seconds"] = round(entry["seconds"], 3)
+
+    with open(f"{base}.json", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    if log_filename:
+        from globalutils import log
+        log(f"Report di profilazione scritto in {base}.json", log_filename, "notice")
+    return f"{base}.json"
+
+
+def _cpu_top(stats, limit=TOP_ALLOCATIONS):
+    """Le funzioni con più tempo cumulativo, in forma serializzabile."""
+    rows = []
+    for (filename, lineno, func), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({"function": f"{os.path.basename(filename)}:{lineno}({func})",
+                     "calls": ncalls, "tottime": round(tottime, 4), "cumtime": round(cumtime, 4)})
+    rows.sort(key=lambda r: r["cumtime"], reverse=True)
+    return rows[:limit]
+
+
+def compare_reports(path_a, path_b):
+    with open(path_a, encoding="utf-8") as f:
+        a = json.load(f)
+    with open(path_b, encoding="utf-8") as f:
+        b = json.load(f)
+
+    print(f"{'fase':<14} {'A (s)':>9} {'B (s)':>9} {'delta':>8} {'API A':>7} {'API B':>7}")
+    for name in list(dict.fromkeys(list(a["phases"]) + list(b["phases"]))):
+        pa = a["phases"].get(name, {})
+        pb = b["phases"].get(name, {})
+        sa, sb = pa.get("seconds", 0.0), pb.get("seconds", 0.0)
+        delta = f"{(sb - sa) * 100 / sa:+.0f}%" if sa else "-"
+        print(f"{name:<14} {sa:>9.2f} {sb:>9.2f} {delta:>8} {pa.get('api_calls', 0):>7} {pb.get('api_calls', 0):>7}")
+    print(f"{'totale':<14} {a['wall_seconds']:>9.2f} {b['wall_seconds']:>9.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Confronta due report di profilazione")
+    parser.add_argument("report_a")
+    parser.add_argument("report_b")
+    args = parser.parse_args()
+    compare_reports(args.report_a, args.report_b)
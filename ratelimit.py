@@ -0,0 +1,184 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Rate limiter condiviso fra processi sulla stessa macchina: syncAnagrafiche3,
+# createOrders3 e orderSingleCustomer consultano lo stesso file SQLite prima di
+# ogni chiamata API, così insieme restano sotto la quota FIC dell'azienda.
+# Finestra scorrevole: al massimo RATE_LIMIT_CALLS chiamate ogni RATE_LIMIT_WINDOW
+# secondi, con un intervallo minimo fra due chiamate consecutive.
+RATE_DB_FILE = "fic_ratelimit.sqlite"
+# Il database vale per una sola macchina: con la sync distribuita su più host
+# (syncAnagrafiche3 --shards) ogni host va configurato con la sua parte di quota.
+RATE_LIMIT_CALLS = int(os.getenv("FIC_RATE_LIMIT_CALLS", "280"))   # quota FIC 300 richieste / 5 minuti, con margine
+RATE_LIMIT_WINDOW = 300.0
+MIN_INTERVAL = 0.1
+THROTTLE_PAUSE = 30.0         # pausa comune dopo un 429 senza Retry-After
+
+# Priorità del job corrente, impostata da scheduler.py per i processi che lancia.
+# Un job con priorità viene sospeso (prima della chiamata API successiva) finché
+# è attivo un job registrato con priorità più alta. I run lanciati a mano o da
+# cron senza scheduler non hanno priorità e non vengono mai sospesi.
+JOB_PRIORITY = int(os.getenv("FIC_JOB_PRIORITY")) if os.getenv("FIC_JOB_PRIORITY") else None
+JOB_HEARTBEAT_TIMEOUT = 60.0
+PREEMPT_POLL = 1.0
+
+_critical = threading.local()
+
+# contatori del processo corrente (per log e statistiche dei run)
+STATS = {"calls": 0, "waited": 0.0, "throttled": 0}
+
+
+def _connect():
+    conn = sqlite3.connect(RATE_DB_FILE, timeout=30, isolation_level=None)
+    conn.execute("CREATE TABLE IF NOT EXISTS calls (ts REAL NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS calls_ts ON calls (ts)")
+    conn.execute("CREATE TABLE IF NOT EXISTS pause (id INTEGER PRIMARY KEY CHECK (id = 1), until REAL NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS jobs (pid INTEGER PRIMARY KEY, name TEXT, priority INTEGER, heartbeat REAL)")
+    return conn
+
+
+@contextmanager
+def non_preemptible():
+    """
+    Sezione in cui il job non va sospeso, ad esempio mentre tiene un lock che
+    anche i job più prioritari aspettano (download della cache clienti).
+    """
+    _critical.depth = getattr(_critical, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _critical.depth -= 1
+
+
+def _preemptible():
+    return JOB_PRIORITY is not None and getattr(_critical, "depth", 0) == 0
+
+
+def register_job(pid, name, priority):
+    conn = _connect()
+    try:
+        conn.execute("INSERT OR REPLACE INTO jobs (pid, name, priority, heartbeat) VALUES (?, ?, ?, ?)",
+                     (pid, name, priority, time.time()))
+    finally:
+        conn.close()
+
+
+def heartbeat_jobs(pids):
+    conn = _connect()
+    try:
+        conn.executemany("UPDATE jobs SET heartbeat = ? WHERE pid = ?", [(time.time(), pid) for pid in pids])
+    finally:
+        conn.close()
+
+
+def unregister_job(pid):
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM jobs WHERE pid = ?", (pid,))
+    finally:
+        conn.close()
+
+
+def acquire(limit=RATE_LIMIT_CALLS, window=RATE_LIMIT_WINDOW, min_interval=MIN_INTERVAL):
+    """
+    Blocca finché una nuova chiamata rientra nella quota condivisa, poi la registra.
+    Ritorna i secondi di attesa.
+    """
+    waited = 0.0
+    while True:
+        conn = _connect()
+        try:
+            # BEGIN IMMEDIATE: un solo processo alla volta legge e registra
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            conn.execute("DELETE FROM calls WHERE ts <= ?", (now - window,))
+            row = conn.execute("SELECT until FROM pause WHERE id = 1").fetchone()
+            pause_until = row[0] if row else 0.0
+            count, oldest, newest = conn.execute("SELECT COUNT(*), MIN(ts), MAX(ts) FROM calls").fetchone()
+
+            top_priority = None
+            if _preemptible():
+                top_priority = conn.execute("SELECT MAX(priority) FROM jobs WHERE heartbeat > ?",
+                                            (now - JOB_HEARTBEAT_TIMEOUT,)).fetchone()[0]
+
+            if top_priority is not None and top_priority > JOB_PRIORITY:
+                # sospeso: un job più prioritario sta usando la quota
+                wait = PREEMPT_POLL
+            elif pause_until > now:
+                wait = pause_until - now
+            elif count >= limit:
+                wait = oldest + window - now
+            elif newest is not None and now - newest < min_interval:
+                wait = min_interval - (now - newest)
+            else:
+                wait = 0.0
+
+            if wait <= 0:
+                conn.execute("INSERT INTO calls (ts) VALUES (?)", (now,))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        if wait <= 0:
+            STATS["calls"] += 1
+            STATS["waited"] += waited
+            return waited
+        time.sleep(wait)
+        waited += wait
+
+
+def report_throttled(retry_after=None):
+    """Dopo un 429 mette in pausa tutti i processi per `retry_after` secondi."""
+    STATS["throttled"] += 1
+    until = time.time() + (retry_after if retry_after else THROTTLE_PAUSE)
+    conn = _connect()
+    try:
+        conn.execute("INSERT INTO pause (id, until) VALUES (1, ?) "
+                     "ON CONFLICT(id) DO UPDATE SET until = MAX(until, excluded.until)", (until,))
+    finally:
+        conn.close()
+
+
+def _retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def install_rate_limiter(api_client):
+    """
+    Aggancia il limiter all'ApiClient dell'SDK: ogni richiesta passa da acquire()
+    e ogni 429 attiva la pausa condivisa. Ritorna lo stesso api_client.
+    """
+    call_api = api_client.call_api
+
+    def limited_call_api(*args, **kwargs):
+        acquire()
+        try:
+            return call_api(*args, **kwargs)
+        except Exception as e:
+            if getattr(e, "status", None) == 429:
+                report_throttled(_retry_after(e))
+            raise
+
+    api_client.call_api = limited_call_api
+
+    # nelle versioni recenti dell'SDK gli errori HTTP vengono sollevati in fase di deserializzazione
+    deserialize = getattr(api_client, "response_deserialize", None)
+    if deserialize is not None:
+        def checked_deserialize(*args, **kwargs):
+            try:
+                return deserialize(*args, **kwargs)
+            except Exception as e:
+                if getattr(e, "status", None) == 429:
+                    report_throttled(_retry_after(e))
+                raise
+
+        api_client.response_deserialize = checked_deserialize
+
+    return api_client
@@ -0,0 +1,170 @@
+import os
+import json
+import argparse
+from globalutils import log, load_all_fic_clients, end_of_month, fic_api_client
+from filelocks import atomic_write_json
+from docnumbers import lookup_numbers
+from createOrders3 import (
+    company_id,
+    get_orders_of_months,
+    mese_su_vtiger,
+    build_orders,
+)
+from datetime import datetime, date
+
+log_filename = f"reconcile-{datetime.now().strftime('%Y%m%d')}.log"
+
+FIC_ORDERS_CACHE_TEMPLATE = "fic_orders-{month}.json"
+REPORT_TEMPLATE = "reconcile-{month}.json"
+CACHE_MINUTES = 60
+AMOUNT_TOLERANCE = 0.01
+
+
+def load_fic_orders_of_month(docs_api, month_day, refresh=False):
+    """
+    Scarica (paginando) gli ordini emessi nel mese e li salva in cache locale.
+    Ritorna una lista di dict {id, number, date, vat_number, amount_net}.
+    """
+    from fattureincloud_python_sdk.rest import ApiException
+
+    month_key = month_day.strftime("%Y-%m")
+    cache_file = FIC_ORDERS_CACHE_TEMPLATE.format(month=month_key)
+    if not refresh and os.path.exists(cache_file):
+        age_minutes = (datetime.now() - datetime.fromtimestamp(os.path.getmtime(cache_file))).total_seconds() / 60
+        if age_minutes <= CACHE_MINUTES:
+            log(f"Carico gli ordini FIC da cache locale ({cache_file})", log_filename, "notice")
+            with open(cache_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+
+    first = month_day.replace(day=1).strftime("%Y-%m-%d")
+    last = end_of_month(month_day).strftime("%Y-%m-%d")
+
+    fic_orders = []
+    page = 1
+    while True:
+        try:
+            resp = docs_api.list_issued_documents(
+                company_id,
+                type="order",
+                fields="id,number,date,entity,amount_net",
+                q=f"date >= '{first}' and date <= '{last}'",
+                per_page=100,
+                page=page,
+            )
+        except ApiException as e:
+            log(f"Errore caricamento ordini FIC: {e}", log_filename, "error")
+            raise
+
+        if not resp.data:
+            break
+
+        for d in resp.data:
+            entity = getattr(d, "entity", None)
+            fic_orders.append({
+                "id": d.id,
+                "number": d.number,
+                "date": str(d.date),
+                "vat_number": ((getattr(entity, "vat_number", None) or "") if entity else "").strip(),
+                "amount_net": float(d.amount_net or 0),
+            })
+
+        if resp.last_page is None or page >= resp.last_page:
+            break
+        page += 1
+
+    atomic_write_json(cache_file, fic_orders, indent=2)
+    log(f"Salvati {len(fic_orders)} ordini FIC in {cache_file}", log_filename, "notice")
+    return fic_orders
+
+
+def order_net_amount(order):
+    return round(sum(
+        (it.qty or 0) * (it.net_price or 0) * (100 - (it.discount or 0)) / 100
+        for it in order.items_list
+    ), 2)
+
+
+def reconcile(planned, fic_orders):
+    """
+    Confronta il piano CRM con gli ordini FIC, per (P.IVA, numero).
+    Ritorna un dict con missing, duplicates, amount_mismatch, unexpected.
+    """
+    fic_by_key = {}
+    for d in fic_orders:
+        fic_by_key.setdefault((d["vat_number"], int(d["number"])), []).append(d)
+
+    report = {"missing": [], "duplicates": [], "amount_mismatch": [], "unexpected": []}
+    plan_keys = set()
+
+    for p in planned:
+        if p["number"] is None:
+            report["missing"].append(p)
+            continue
+        key = (p["vat_number"], int(p["number"]))
+        plan_keys.add(key)
+        found = fic_by_key.get(key, [])
+        if not found:
+            report["missing"].append(p)
+            continue
+        if len(found) > 1:
+            report["duplicates"].append({**p, "fic_ids": [d["id"] for d in found]})
+        if abs(found[0]["amount_net"] - p["amount_net"]) > AMOUNT_TOLERANCE:
+            report["amount_mismatch"].append({**p, "fic_id": found[0]["id"], "fic_amount_net": found[0]["amount_net"]})
+
+    for key, docs in fic_by_key.items():
+        if key not in plan_keys:
+            report["unexpected"].extend(docs)
+
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Riconcilia gli ordini FIC del mese con il piano del CRM")
+    parser.add_argument("--month", default=date.today().strftime("%Y-%m"), help="mese da riconciliare (YYYY-MM)")
+    parser.add_argument("--refresh", action="store_true", help="ignora la cache locale degli ordini FIC")
+    return parser.parse_args()
+
+
+# --- MAIN ---
+if __name__ == "__main__":
+    args = parse_args()
+    month_day = datetime.strptime(args.month, "%Y-%m").date()
+    month_key = month_day.strftime("%Y-%m")
+
+    rows = [r for r in get_orders_of_months([month_day]) if r["vtiger_month"] == mese_su_vtiger(month_day)]
+
+    import fattureincloud_python_sdk
+    from fattureincloud_python_sdk.api import issued_documents_api
+
+    with fic_api_client() as api_client:
+        clients_api = fattureincloud_python_sdk.ClientsApi(api_client)
+        docs_api = issued_documents_api.IssuedDocumentsApi(api_client)
+
+        fic_clients = load_all_fic_clients(clients_api, log_filename, company_id)
+        fic_orders = load_fic_orders_of_month(docs_api, month_day, refresh=args.refresh)
+
+    # il piano usa i numeri assegnati dall'allocatore di createOrders3 (None se non ancora
+    # assegnati, quindi mancanti); data e pagamento non servono al confronto
+    due_eom = end_of_month(month_day).strftime("%Y-%m-%d")
+    orders = build_orders(rows, fic_clients, {}, month_day.strftime("%Y-%m-%d"), due_eom,
+                          int(month_day.strftime("%m") + "001"), numbers=lookup_numbers(company_id, month_key))
+    planned = [
+        {"vat_number": od.entity.vat_number, "number": od.number, "amount_net": order_net_amount(od)}
+        for od in orders
+    ]
+
+    report = reconcile(planned, fic_orders)
+    report_file = REPORT_TEMPLATE.format(month=month_key)
+    with open(report_file, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    summary = (
+        f"Riconciliazione {month_key}: {len(planned)} attesi, {len(fic_orders)} su FIC, "
+        f"{len(report['missing'])} mancanti, {len(report['duplicates'])} duplicati, "
+        f"{len(report['amount_mismatch'])} importi diversi, {len(report['unexpected'])} non previsti. "
+        f"Dettaglio in {report_file}"
+    )
+    print(summary)
+    log(summary, log_filename, "notice")
+    for p in report["missing"]:
+        print(f"  MANCANTE: P.IVA {p['vat_number']} numero {p['number']} (netto {p['amount_net']:.2f})")
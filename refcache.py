@@ -0,0 +1,135 @@
+import argparse
+from datetime import datetime, timedelta
+from globalutils import log
+from filelocks import read_json_locked, locked_json
+
+# Cache unica dei dati di riferimento FIC (metodi di pagamento, aliquote IVA,
+# conti di pagamento) con scadenza. A cache calda nessuna chiamata API.
+REFDATA_FILE = "refdata_cache.json"
+REFDATA_TTL_HOURS = 24
+
+DATE_FMT = "%Y-%m-%d %H:%M:%S"
+
+# tipo -> (metodo di InfoApi, campi da salvare, campo usato come "nome")
+REFDATA_KINDS = {
+    "payment_methods": ("list_payment_methods", ("id", "name"), "name"),
+    "vat_types": ("list_vat_types", ("id", "value", "description", "is_disabled"), "description"),
+    "payment_accounts": ("list_payment_accounts", ("id", "name", "type"), "name"),
+}
+
+# aliquota ordinaria; id 0 è l'aliquota predefinita su FIC
+DEFAULT_VAT_VALUE = 22
+DEFAULT_VAT_ID = 0
+
+
+def _load_file():
+    try:
+        return read_json_locked(REFDATA_FILE, {}) or {}
+    except ValueError:
+        return {}
+
+
+def _is_fresh(entry, max_age_hours):
+    try:
+        fetched_at = datetime.strptime(entry["fetched_at"], DATE_FMT)
+    except (KeyError, TypeError, ValueError):
+        return False
+    return datetime.now() - fetched_at <= timedelta(hours=max_age_hours)
+
+
+def _serialize(obj, fields):
+    item = {}
+    for field in fields:
+        value = getattr(obj, field, None)
+        # gli enum dell'SDK (es. type del conto) diventano stringhe
+        item[field] = getattr(value, "value", value)
+    return item
+
+
+def get_refdata(kind, api_client, company_id, log_filename, max_age_hours=REFDATA_TTL_HOURS):
+    """
+    Ritorna la lista dei dati di riferimento `kind` (vedi REFDATA_KINDS).
+    Usa la cache se più recente di `max_age_hours`, altrimenti la ricarica da API.
+    """
+    data = _load_file()
+    entry = data.get(kind)
+    if entry and _is_fresh(entry, max_age_hours):
+        return entry["items"]
+
+    import fattureincloud_python_sdk
+
+    method, fields, _ = REFDATA_KINDS[kind]
+    info_api = fattureincloud_python_sdk.InfoApi(api_client)
+    resp = getattr(info_api, method)(company_id)
+    items = [_serialize(obj, fields) for obj in (resp.data or [])]
+
+    with locked_json(REFDATA_FILE, {}, indent=2) as data:
+        data[kind] = {"fetched_at": datetime.now().strftime(DATE_FMT), "items": items}
+    log(f"Dati di riferimento '{kind}' aggiornati da API ({len(items)} voci)", log_filename, "notice")
+    return items
+
+
+def invalidate_refdata(kinds=None):
+    """Invalida i tipi indicati (tutti se None): il prossimo accesso ricarica da API."""
+    with locked_json(REFDATA_FILE, {}, indent=2) as data:
+        for kind in (kinds or list(data)):
+            data.pop(kind, None)
+
+
+def name_to_id(kind, items):
+    name_field = REFDATA_KINDS[kind][2]
+    return {item[name_field]: item["id"] for item in items if item.get(name_field)}
+
+
+def find_ref(kind, items, name=None, id=None):
+    """Cerca una voce per id o per nome; ritorna il dict della voce o None."""
+    name_field = REFDATA_KINDS[kind][2]
+    for item in items:
+        if id is not None and item["id"] == id:
+            return item
+        if name is not None and item.get(name_field) == name:
+            return item
+    return None
+
+
+def vat_type_id(items, value=DEFAULT_VAT_VALUE, log_filename=None):
+    """
+    Id dell'aliquota IVA attiva con il valore indicato. Se l'aliquota predefinita
+    FIC (DEFAULT_VAT_ID, usata da sempre dagli ordini) ha quel valore vince lei:
+    con lo stesso valore possono esistere aliquote speciali (split payment,
+    reverse charge...) che non vanno scelte solo perché vengono prima in lista.
+    Fallback: DEFAULT_VAT_ID.
+    """
+    def matches(item):
+        return not item.get("is_disabled") and item.get("value") is not None and float(item["value"]) == float(value)
+
+    default = find_ref("vat_types", items, id=DEFAULT_VAT_ID)
+    if default is not None and matches(default):
+        chosen, reason = default, "aliquota predefinita"
+    else:
+        chosen = next((item for item in items if matches(item)), None)
+        reason = "prima aliquota attiva con il valore" if chosen else "nessuna aliquota trovata, uso la predefinita"
+    vat_id = chosen["id"] if chosen else DEFAULT_VAT_ID
+    if log_filename:
+        description = chosen.get("description") if chosen else None
+        log(f"Aliquota IVA {value}%: id={vat_id} ({reason}{f', {description}' if description else ''})",
+            log_filename, "notice")
+    return vat_id
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Gestione della cache dei dati di riferimento FIC")
+    parser.add_argument("--invalidate", nargs="*", choices=list(REFDATA_KINDS), metavar="TIPO",
+                        help="invalida i tipi indicati (tutti se nessuno)")
+    parser.add_argument("--show", action="store_true", help="mostra età e numero di voci in cache")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.invalidate is not None:
+        invalidate_refdata(args.invalidate or None)
+        print(f"Cache invalidata: {', '.join(args.invalidate) or 'tutto'}")
+    if args.show:
+        for kind, entry in _load_file().items():
+            print(f"{kind:<18} {entry.get('fetched_at')}  {len(entry.get('items', []))} voci")
@@ -0,0 +1,25 @@
+import os
+from dotenv import load_dotenv
+from globalutils import log, refresh_fic_clients_cache, fic_api_client
+from refcache import invalidate_refdata, get_refdata, REFDATA_KINDS
+from datetime import datetime
+
+load_dotenv()
+
+log_filename = f"cache-{datetime.now().strftime('%Y%m%d')}.log"
+company_id = int(os.getenv("COMPANY_ID"))
+
+
+# --- MAIN ---
+if __name__ == "__main__":
+    import fattureincloud_python_sdk
+
+    with fic_api_client() as api_client:
+        clients_api = fattureincloud_python_sdk.ClientsApi(api_client)
+        clients = refresh_fic_clients_cache(clients_api, log_filename, company_id)
+
+        invalidate_refdata()
+        for kind in REFDATA_KINDS:
+            get_refdata(kind, api_client, company_id, log_filename)
+
+    log(f"Cache rigenerate: {len(clients)} clienti, dati di riferimento {', '.join(REFDATA_KINDS)}.", log_filename, "notice")
@@ -0,0 +1,151 @@
+"""
+Rollback degli ordini creati da createOrders3, letti dal WAL del mese.
+
+  python rollbackOrders.py --month 2025-03 --dry-run
+  python rollbackOrders.py --month 2025-03 --numbers 3001 3120
+  python rollbackOrders.py --month 2025-03 --run 20250301-060001-4242
+  python rollbackOrders.py --month 2025-03 --list-runs
+
+Gli ordini selezionati vengono eliminati da FIC in parallelo, con il rate
+limiter condiviso. Ogni eliminazione riuscita viene scritta nel WAL come
+"deleted": rilanciando il comando dopo un'interruzione riparte dagli ordini
+non ancora eliminati. Il checkpoint di createOrders3 non viene toccato: per
+rigenerare gli ordini eliminati va azzerato lo stato del mese.
+"""
+import os
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from dotenv import load_dotenv
+from globalutils import log, fic_api_client
+from orderwal import wal_append, wal_load, wal_sent
+from filelocks import run_lock, JobAlreadyRunning
+
+load_dotenv()
+
+log_filename = f"rollback-{datetime.now().strftime('%Y%m%d')}.log"
+
+company_id = int(os.getenv("COMPANY_ID"))
+
+ROLLBACK_WORKERS = 4
+FIC_ORDERS_CACHE_TEMPLATE = "fic_orders-{month}.json"
+
+_wal_lock = threading.Lock()
+
+
+def select_orders(month, numbers=None, run=None):
+    """Ordini del mese ancora presenti su FIC secondo il WAL, filtrati per intervallo di numeri e/o run."""
+    selected = []
+    for r in wal_sent(month):
+        if numbers is not None and not numbers[0] <= int(r["number"]) <= numbers[1]:
+            continue
+        if run is not None and r.get("run") != run:
+            continue
+        selected.append(r)
+    return sorted(selected, key=lambda r: int(r["number"]))
+
+
+def runs_of_month(month):
+    """run id -> numero di ordini ancora presenti su FIC creati da quel run."""
+    runs = {}
+    for r in wal_sent(month):
+        runs[r.get("run") or "?"] = runs.get(r.get("run") or "?", 0) + 1
+    return runs
+
+
+def delete_order(docs_api, month, record):
+    """Elimina un ordine; ritorna (record, errore). Un 404 vale come già eliminato."""
+    from fattureincloud_python_sdk.rest import ApiException
+
+    try:
+        docs_api.delete_issued_document(company_id, record["doc_id"])
+    except ApiException as e:
+        if e.status != 404:
+            return record, e
+    with _wal_lock:
+        wal_append(month, "deleted", record["vat"], record["number"], date=record.get("date"),
+                   doc_id=record["doc_id"], run=record.get("run"))
+    return record, None
+
+
+def rollback(month, orders, workers=ROLLBACK_WORKERS):
+    from fattureincloud_python_sdk.api import issued_documents_api
+
+    deleted = 0
+    failed = 0
+    with fic_api_client(workers=workers) as api_client:
+        docs_api = issued_documents_api.IssuedDocumentsApi(api_client)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(delete_order, docs_api, month, r) for r in orders]
+            for i, future in enumerate(as_completed(futures), start=1):
+                record, error = future.result()
+                if error is None:
+                    deleted += 1
+                    log(f"[{i}/{len(orders)}] Ordine {record['number']} ({record['vat']}) eliminato, id={record['doc_id']}",
+                        log_filename, "notice")
+                else:
+                    failed += 1
+                    log(f"[{i}/{len(orders)}] Eliminazione ordine {record['number']} fallita: {error}", log_filename, "error")
+
+    # la cache degli ordini FIC di reconcileOrders non è più valida
+    cache_file = FIC_ORDERS_CACHE_TEMPLATE.format(month=month)
+    if deleted and os.path.exists(cache_file):
+        os.remove(cache_file)
+    return deleted, failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Elimina da FIC gli ordini di un mese creati da createOrders3")
+    parser.add_argument("--month", required=True, help="mese degli ordini (YYYY-MM)")
+    parser.add_argument("--numbers", nargs=2, type=int, metavar=("DA", "A"), help="solo i numeri da DA ad A inclusi")
+    parser.add_argument("--run", help="solo gli ordini creati dal run indicato (vedi --list-runs)")
+    parser.add_argument("--dry-run", action="store_true", help="mostra gli ordini selezionati senza eliminarli")
+    parser.add_argument("--list-runs", action="store_true", help="elenca i run del mese con il numero di ordini")
+    parser.add_argument("--workers", type=int, default=ROLLBACK_WORKERS, help="eliminazioni in parallelo")
+    return parser.parse_args()
+
+
+def _select(args):
+    orders = select_orders(args.month, args.numbers, args.run)
+    already = sum(1 for r in wal_load(args.month).values() if r.get("status") == "deleted")
+    if not orders:
+        print(f"Nessun ordine da eliminare per {args.month} ({already} già eliminati).")
+    return orders, already
+
+
+def main():
+    args = parse_args()
+    month = args.month
+
+    # --list-runs e --dry-run leggono solo il WAL: niente lock, non bloccano e non vengono bloccati
+    if args.list_runs:
+        for run, count in sorted(runs_of_month(month).items()):
+            print(f"{run:<28} {count} ordini")
+        return
+
+    if args.dry_run:
+        orders, already = _select(args)
+        for r in orders:
+            print(f"{r['number']:>8}  {r['vat']:<13} id={r['doc_id']:<12} {r.get('date', '')}  run={r.get('run', '?')}")
+        if orders:
+            print(f"{len(orders)} ordini verrebbero eliminati ({already} già eliminati in precedenza).")
+        return
+
+    # stesso lock di createOrders3: niente rollback mentre il job crea ordini
+    with run_lock("orders"):
+        orders, _ = _select(args)
+        if not orders:
+            return
+        log(f"Rollback {month}: {len(orders)} ordini da eliminare con {args.workers} worker.", log_filename, "notice")
+        deleted, failed = rollback(month, orders, args.workers)
+    print(f"Rollback {month} completato. Eliminati={deleted}  Falliti={failed}")
+    log(f"Rollback {month} completato: {deleted} eliminati, {failed} falliti.", log_filename, "notice")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except JobAlreadyRunning as e:
+        print(e)
+        log(str(e), log_filename, "warning")
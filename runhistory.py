@@ -0,0 +1,274 @@
+"""
+Storico dei run dei job FIC e report di andamento.
+
+Ogni run di createOrders3, syncAnagrafiche3 e orderSingleCustomer aggiunge un
+record a run_history.sqlite: job, intervallo del batch, conteggi, chiamate API,
+429, tempi per fase (profiler.py) e picco di memoria del processo.
+
+  python runhistory.py                       # report testuale ultimi 30 giorni
+  python runhistory.py --days 90 --job sync
+  python runhistory.py --html trend.html     # report HTML statico
+"""
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from datetime import datetime
+
+import ratelimit
+
+HISTORY_DB_FILE = "run_history.sqlite"
+REPORT_DAYS = 30
+
+# run corrente: riempito dagli script durante l'esecuzione (come ratelimit.STATS)
+RUN = {"counts": {}, "batches": [], "backlog": None}
+_run_started = time.time()
+
+
+def _connect():
+    conn = sqlite3.connect(HISTORY_DB_FILE, timeout=30, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS runs ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, job TEXT NOT NULL, started REAL NOT NULL,"
+        " duration REAL, status TEXT, batch_from INTEGER, batch_to INTEGER, backlog INTEGER,"
+        " counts TEXT, api_calls INTEGER, throttled INTEGER, api_wait REAL,"
+        " phases TEXT, peak_mem_kb INTEGER)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS runs_job_started ON runs (job, started)")
+    return conn
+
+
+def add_counts(**counts):
+    """Somma i conteggi del run corrente (es. ok=3, ko=1)."""
+    for name, value in counts.items():
+        RUN["counts"][name] = RUN["counts"].get(name, 0) + int(value)
+
+
+def note_batch(first, last, total, label=None):
+    """Registra un batch elaborato (posizioni 1-based incluse) e l'arretrato rimasto."""
+    RUN["batches"].append({"label": label, "from": first, "to": last, "total": total})
+    RUN["backlog"] = (RUN["backlog"] or 0) + max(total - last, 0)
+
+
+def _peak_mem_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # su Linux ru_maxrss è in KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _exit_status():
+    # chiamata da un blocco finally: sys.exc_info() è l'eccezione in uscita, se c'è
+    error = sys.exc_info()[1]
+    if error is None:
+        return "ok"
+    if isinstance(error, SystemExit):
+        return "ok" if error.code in (None, 0) else "exit"
+    return "error"
+
+
+def record_run(job, log_filename=None):
+    """
+    Salva il record del run corrente. I run che non hanno fatto nulla (nessun
+    conteggio e nessuna chiamata API, es. mese già completato) non vengono salvati.
+    """
+    from profiler import phase_timings
+
+    if not RUN["counts"] and not RUN["batches"] and not ratelimit.STATS["calls"]:
+        return None
+
+    batches = RUN["batches"]
+    row = (
+        job, _run_started, round(time.time() - _run_started, 3), _exit_status(),
+        batches[0]["from"] if batches else None, batches[-1]["to"] if batches else None, RUN["backlog"],
+        json.dumps(RUN["counts"]), ratelimit.STATS["calls"], ratelimit.STATS["throttled"],
+        round(ratelimit.STATS["waited"], 3), json.dumps(phase_timings()), _peak_mem_kb(),
+    )
+    try:
+        conn = _connect()
+        try:
+            cur = conn.execute(
+                "INSERT INTO runs (job, started, duration, status, batch_from, batch_to, backlog, counts,"
+                " api_calls, throttled, api_wait, phases, peak_mem_kb) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                row,
+            )
+            return cur.lastrowid
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        # lo storico non deve mai far fallire il job
+        if log_filename:
+            from globalutils import log
+            log(f"Impossibile salvare lo storico del run: {e}", log_filename, "warning")
+        return None
+
+
+def load_runs(days=REPORT_DAYS, job=None):
+    since = time.time() - days * 86400
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    try:
+        query = "SELECT * FROM runs WHERE started >= ?"
+        params = [since]
+        if job:
+            query += " AND job = ?"
+            params.append(job)
+        rows = conn.execute(query + " ORDER BY started", params).fetchall()
+    finally:
+        conn.close()
+
+    runs = []
+    for r in rows:
+        run = dict(r)
+        run["counts"] = json.loads(run["counts"] or "{}")
+        run["phases"] = json.loads(run["phases"] or "{}")
+        runs.append(run)
+    return runs
+
+
+def items_per_minute(run):
+    """Ordini creati (o clienti sincronizzati) al minuto; sulla fase send se misurata."""
+    counts = run["counts"]
+    items = counts.get("ok", 0) + counts.get("updated", 0) + counts.get("created", 0)
+    seconds = run["phases"].get("send") or run["duration"]
+    if not items or not seconds:
+        return 0.0
+    return items * 60 / seconds
+
+
+def recent_call_seconds(job, runs=10):
+    """Secondi per chiamata API nella fase send degli ultimi run del job (None senza storico)."""
+    try:
+        conn = _connect()
+        try:
+            rows = conn.execute(
+                "SELECT api_calls, phases FROM runs WHERE job = ? AND api_calls > 0 ORDER BY started DESC LIMIT ?",
+                (job, runs)).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    calls = 0
+    seconds = 0.0
+    for api_calls, phases in rows:
+        send = json.loads(phases or "{}").get("send")
+        if send:
+            calls += api_calls
+            seconds += send
+    return seconds / calls if calls else None
+
+
+def daily_trend(runs):
+    """Aggregato per (giorno, job): run, elementi, durata media, elementi/min, 429, picco memoria, arretrato."""
+    days = {}
+    for run in runs:
+        day = datetime.fromtimestamp(run["started"]).strftime("%Y-%m-%d")
+        d = days.setdefault((day, run["job"]), {"runs": 0, "items": 0, "duration": 0.0, "rates": [],
+                                                "api_calls": 0, "throttled": 0, "peak_mem_kb": 0,
+                                                "backlog": None, "errors": 0})
+        counts = run["counts"]
+        d["runs"] += 1
+        d["items"] += counts.get("ok", 0) + counts.get("updated", 0) + counts.get("created", 0)
+        d["errors"] += counts.get("ko", 0) + counts.get("errors", 0)
+        d["duration"] += run["duration"] or 0.0
+        d["rates"].append(items_per_minute(run))
+        d["api_calls"] += run["api_calls"] or 0
+        d["throttled"] += run["throttled"] or 0
+        d["peak_mem_kb"] = max(d["peak_mem_kb"], run["peak_mem_kb"] or 0)
+        if run["backlog"] is not None:
+            d["backlog"] = run["backlog"]   # ultimo valore del giorno
+    trend = []
+    for (day, job), d in sorted(days.items()):
+        rates = [r for r in d["rates"] if r]
+        trend.append({
+            "day": day, "job": job, "runs": d["runs"], "items": d["items"], "errors": d["errors"],
+            "avg_duration": d["duration"] / d["runs"],
+            "items_per_min": sum(rates) / len(rates) if rates else 0.0,
+            "api_calls": d["api_calls"], "throttled": d["throttled"],
+            "peak_mem_mb": d["peak_mem_kb"] / 1024, "backlog": d["backlog"],
+        })
+    return trend
+
+
+COLUMNS = [
+    ("day", "giorno", "{}"), ("job", "job", "{}"), ("runs", "run", "{}"), ("items", "elementi", "{}"),
+    ("errors", "errori", "{}"), ("avg_duration", "durata media (s)", "{:.1f}"),
+    ("items_per_min", "elementi/min", "{:.1f}"), ("api_calls", "chiamate API", "{}"),
+    ("throttled", "429", "{}"), ("peak_mem_mb", "picco MB", "{:.0f}"), ("backlog", "arretrato", "{}"),
+]
+
+
+def _fmt(fmt, value):
+    return "-" if value is None else fmt.format(value)
+
+
+def render_text(trend):
+    widths = [max(len(title), 10) for _, title, _ in COLUMNS]
+    lines = ["  ".join(title.rjust(w) for (_, title, _), w in zip(COLUMNS, widths))]
+    for t in trend:
+        lines.append("  ".join(_fmt(fmt, t[key]).rjust(w) for (key, _, fmt), w in zip(COLUMNS, widths)))
+    return "\n".join(lines)
+
+
+def _sparkline_svg(values, width=600, height=80):
+    points = [v or 0 for v in values]
+    if len(points) < 2:
+        return ""
+    top = max(points) or 1
+    step = width / (len(points) - 1)
+    coords = " ".join(f"{i * step:.1f},{height - v * (height - 4) / top - 2:.1f}" for i, v in enumerate(points))
+    return (f'<svg width="{width}" height="{height}"><polyline fill="none" stroke="#2a6ebb" '
+            f'stroke-width="2" points="{coords}"/></svg>')
+
+
+def render_html(trend, days):
+    from html import escape
+
+    sections = []
+    for job in sorted({t["job"] for t in trend}):
+        rows = [t for t in trend if t["job"] == job]
+        sections.append(f"<h2>{escape(job)}</h2>")
+        sections.append(f"<p>Elementi/min (max {max(r['items_per_min'] for r in rows):.1f})</p>")
+        sections.append(_sparkline_svg([r["items_per_min"] for r in rows]))
+        if any(r["backlog"] is not None for r in rows):
+            sections.append("<p>Arretrato</p>")
+            sections.append(_sparkline_svg([r["backlog"] for r in rows]))
+
+    header = "".join(f"<th>{escape(title)}</th>" for _, title, _ in COLUMNS)
+    body = "".join(
+        "<tr>" + "".join(f"<td>{escape(_fmt(fmt, t[key]))}</td>" for key, _, fmt in COLUMNS) + "</tr>"
+        for t in trend
+    )
+    generated = datetime.now().strftime("%Y-%m-%d %H:%M")
+    return (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'><title>Andamento job FIC</title>"
+        "<style>body{font-family:sans-serif}table{border-collapse:collapse}"
+        "td,th{border:1px solid #ccc;padding:2px 8px;text-align:right}</style></head><body>"
+        f"<h1>Andamento job FIC - ultimi {days} giorni</h1><p>Generato il {generated}</p>"
+        + "".join(sections)
+        + f"<h2>Dettaglio giornaliero</h2><table><tr>{header}</tr>{body}</table></body></html>"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Report di andamento dei run dei job FIC")
+    parser.add_argument("--days", type=int, default=REPORT_DAYS)
+    parser.add_argument("--job", help="solo il job indicato (orders, sync, order-single)")
+    parser.add_argument("--html", metavar="FILE", help="scrive il report HTML nel file indicato")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    trend = daily_trend(load_runs(args.days, args.job))
+    if not trend:
+        print(f"Nessun run registrato negli ultimi {args.days} giorni.")
+    elif args.html:
+        with open(args.html, "w", encoding="utf-8") as f:
+            f.write(render_html(trend, args.days))
+        print(f"Report scritto in {args.html}")
+    else:
+        print(render_text(trend))
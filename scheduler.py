@@ -0,0 +1,147 @@
+"""
+Scheduler unico dei job FIC, con coda a priorità e quota API condivisa.
+
+  python scheduler.py run              # ciclo principale (da avviare come servizio)
+  python scheduler.py submit orders    # accoda un job subito
+  python scheduler.py status
+
+I job sono gli script esistenti, lanciati come processi figli. La quota è quella
+del rate limiter condiviso (ratelimit.py): un job con priorità più alta sospende
+i job meno prioritari alla loro prossima chiamata API, che riprendono da dove
+erano quando il job prioritario termina. Ogni script mantiene i propri checkpoint.
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import subprocess
+from datetime import datetime
+from globalutils import log
+from ratelimit import register_job, heartbeat_jobs, unregister_job
+
+log_filename = f"scheduler-{datetime.now().strftime('%Y%m%d')}.log"
+
+SCHEDULER_DB_FILE = "scheduler.sqlite"
+POLL_SECONDS = 5
+# job a bassa priorità in esecuzione contemporanea; un job più prioritario parte sempre
+MAX_RUNNING = 2
+
+# nome -> comando, priorità (più alta = più urgente), intervallo di accodamento automatico
+JOBS = {
+    "orders": {"cmd": ["createOrders3.py"], "priority": 30, "every_minutes": 10},
+    "sync": {"cmd": ["syncAnagrafiche3.py"], "priority": 10, "every_minutes": 60},
+    "refresh_cache": {"cmd": ["refreshCache.py"], "priority": 5, "every_minutes": 24 * 60},
+}
+
+
+def _connect():
+    conn = sqlite3.connect(SCHEDULER_DB_FILE, timeout=30, isolation_level=None)
+    conn.execute("CREATE TABLE IF NOT EXISTS queue (job TEXT PRIMARY KEY, priority INTEGER, enqueued REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS last_run (job TEXT PRIMARY KEY, started REAL, exit_code INTEGER)")
+    return conn
+
+
+def submit(job):
+    """Accoda un job (se non è già in coda)."""
+    conn = _connect()
+    try:
+        conn.execute("INSERT OR IGNORE INTO queue (job, priority, enqueued) VALUES (?, ?, ?)",
+                     (job, JOBS[job]["priority"], time.time()))
+    finally:
+        conn.close()
+
+
+def _enqueue_due(conn, running):
+    now = time.time()
+    last = dict(conn.execute("SELECT job, started FROM last_run").fetchall())
+    for job, spec in JOBS.items():
+        if job in running:
+            continue
+        if now - last.get(job, 0) >= spec["every_minutes"] * 60:
+            conn.execute("INSERT OR IGNORE INTO queue (job, priority, enqueued) VALUES (?, ?, ?)",
+                         (job, spec["priority"], now))
+
+
+def _launch(conn, job):
+    spec = JOBS[job]
+    env = dict(os.environ, FIC_JOB_NAME=job, FIC_JOB_PRIORITY=str(spec["priority"]))
+    proc = subprocess.Popen([sys.executable] + spec["cmd"], env=env)
+    register_job(proc.pid, job, spec["priority"])
+    conn.execute("DELETE FROM queue WHERE job = ?", (job,))
+    conn.execute("INSERT OR REPLACE INTO last_run (job, started, exit_code) VALUES (?, ?, NULL)", (job, time.time()))
+    log(f"Avviato job '{job}' (pid {proc.pid}, priorità {spec['priority']})", log_filename, "notice")
+    return proc
+
+
+def run():
+    running = {}   # job -> Popen
+    log("Scheduler avviato.", log_filename, "notice")
+    try:
+        while True:
+            conn = _connect()
+            try:
+                # job terminati
+                for job, proc in list(running.items()):
+                    code = proc.poll()
+                    if code is None:
+                        continue
+                    unregister_job(proc.pid)
+                    conn.execute("UPDATE last_run SET exit_code = ? WHERE job = ?", (code, job))
+                    log(f"Job '{job}' terminato (exit {code})", log_filename, "notice" if code == 0 else "error")
+                    del running[job]
+
+                heartbeat_jobs([p.pid for p in running.values()])
+                _enqueue_due(conn, running)
+
+                # coda per priorità: un job più prioritario di tutti quelli attivi parte subito
+                queued = conn.execute("SELECT job, priority FROM queue ORDER BY priority DESC, enqueued ASC").fetchall()
+                for job, priority in queued:
+                    if job in running or job not in JOBS:
+                        continue
+                    top_running = max((JOBS[j]["priority"] for j in running), default=None)
+                    if len(running) < MAX_RUNNING or (top_running is not None and priority > top_running):
+                        running[job] = _launch(conn, job)
+            finally:
+                conn.close()
+            time.sleep(POLL_SECONDS)
+    except KeyboardInterrupt:
+        log("Scheduler fermato: attendo la fine dei job in corso.", log_filename, "warning")
+        for proc in running.values():
+            proc.wait()
+            unregister_job(proc.pid)
+
+
+def status():
+    conn = _connect()
+    try:
+        print("In coda:")
+        for job, priority, enqueued in conn.execute("SELECT job, priority, enqueued FROM queue ORDER BY priority DESC"):
+            print(f"  {job:<15} priorità {priority:<4} dal {datetime.fromtimestamp(enqueued):%Y-%m-%d %H:%M:%S}")
+        print("Ultimi avvii:")
+        for job, started, exit_code in conn.execute("SELECT job, started, exit_code FROM last_run ORDER BY job"):
+            state = "in corso" if exit_code is None else f"exit {exit_code}"
+            print(f"  {job:<15} {datetime.fromtimestamp(started):%Y-%m-%d %H:%M:%S}  {state}")
+    finally:
+        conn.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scheduler dei job FIC con priorità e quota condivisa")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("run", help="avvia il ciclo dello scheduler")
+    submit_parser = sub.add_parser("submit", help="accoda un job")
+    submit_parser.add_argument("job", choices=list(JOBS))
+    sub.add_parser("status", help="mostra coda e ultimi avvii")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "run":
+        run()
+    elif args.command == "submit":
+        submit(args.job)
+        print(f"Job '{args.job}' accodato.")
+    else:
+        status()
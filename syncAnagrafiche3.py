@@ -1,10 +1,20 @@
 import os
 import json
+import zlib
 from dotenv import load_dotenv
-from globalutils import log, load_all_fic_clients
-import fattureincloud_python_sdk
+from globalutils import log, normalize_vat, load_fic_client_index, find_client, run_startup_tasks, fic_api_client, fic_client_record, write_back_client, compact_clients_cache
+from deadletter import dlq_add, dlq_due, dlq_resolve, dlq_summary, dlq_keys
+from validators import validate_clients, write_rejects_report
+from refcache import get_refdata, name_to_id
+from transport import log_transport_stats
+from filelocks import atomic_write_json, file_lock, run_lock, JobAlreadyRunning
+from leases import worker_id, try_claim, held_lease
+from profiler import add_profile_argument, enable_profiling, phase, timed, write_profile_report
+from runhistory import add_counts, note_batch, record_run
+from fieldnorm import normalized, fic_value, normalizer_cache_stats
+from budget import BUDGET, start_budget, budget_allows, budget_item, items_that_fit, budget_summary
 from dbconn import getdbconn
-from fattureincloud_python_sdk.rest import ApiException
+from cassette import replay_scrub
 import time
 from datetime import datetime
 
@@ -12,24 +22,30 @@ load_dotenv()
 
 log_filename = f"sync-{datetime.now().strftime('%Y%m%d')}.log"
 
-configuration = fattureincloud_python_sdk.Configuration(
-    host="https://api-v2.fattureincloud.it"
-)
-configuration.access_token = os.getenv("ACCESS_TOKEN")
 company_id = int(os.getenv("COMPANY_ID"))
 
 BATCH_FILE = "clients_batch.json"
-BATCH_SIZE = 500
+# lock dell'estrazione comune a tutti gli shard (un solo worker alla volta la esegue)
+SHARD_EXTRACT_LOCK = "clients_batch-shards"
+# quanti clienti per run non è più fisso: lo decide il budget del run (budget.py)
 
-PM_CACHE_FILE = "payment_methods_cache.json"
-
-# Campi usati per il confronto modifiche
+# Campi usati per il confronto modifiche (tutti quelli che la sync scrive su FIC)
 COMPARE_FIELDS = [
     "name", "address_street", "address_city", "address_province",
     "address_zip", "email", "certified_email", "phone",
     "vat_number", "tax_code", "ei_code",
+    "code", "contact_person", "notes", "default_payment_method",
 ]
 
+# campi entrati nella cache clienti dopo gli altri: nei record scaricati prima mancano
+# e vengono confrontati solo dal prossimo download completo (niente modifiche a tappeto)
+LATE_CACHE_FIELDS = {"contact_person", "notes", "default_payment_method"}
+
+# campo confrontato -> attributi del Client FIC da inviare nella modifica parziale
+# (il CAP in cache è address_zip, nel Client dell'SDK address_postal_code)
+PATCH_FIELDS = {field: (field,) for field in COMPARE_FIELDS}
+PATCH_FIELDS["address_zip"] = ("address_postal_code",)
+
 def get_clients_from_db():
     from dbconn import getdbconn
     connection = getdbconn()
@@ -65,39 +81,106 @@ def get_clients_from_db():
     results = cursor.fetchall()
     cursor.close()
     connection.close()
-    return results
+    return replay_scrub(results)
 
 
-def load_payment_methods_cached(info_api, company_id):
-    """Carica i metodi di pagamento da cache locale (non cambiano mai)."""
-    if os.path.exists(PM_CACHE_FILE):
-        with open(PM_CACHE_FILE, "r", encoding="utf-8") as f:
-            log(f"Metodi di pagamento caricati da cache ({PM_CACHE_FILE})", log_filename, "notice")
-            return json.load(f)
+def load_payment_methods_cached(api_client, company_id):
+    """
+    Nome -> id dei metodi di pagamento dalla cache dei dati di riferimento (con scadenza).
+    None se l'SDK non ha list_payment_methods: l'AttributeError viene gestito solo
+    qui, così quelli degli altri task di avvio non vengono scambiati per questo caso.
+    """
+    try:
+        return name_to_id("payment_methods", get_refdata("payment_methods", api_client, company_id, log_filename))
+    except AttributeError:
+        log("Il metodo list_payment_methods non esiste.", log_filename, "error")
+        return None
+
 
-    pm_resp = info_api.list_payment_methods(company_id)
-    data = {m.name: m.id for m in pm_resp.data}
-    with open(PM_CACHE_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    log(f"Metodi di pagamento salvati in cache ({len(data)} voci)", log_filename, "notice")
-    return data
+def crm_value(client, field):
+    """Valore del campo CRM da confrontare o salvare in cache (il metodo di pagamento come id FIC)."""
+    value = client.get(field)
+    if field == "default_payment_method":
+        return getattr(value, "id", value)
+    return value
 
 
-def client_needs_update(existing: dict, new_data: dict) -> bool:
+def client_changes(existing: dict, new_data: dict) -> list:
     """
-    Confronta i campi rilevanti tra il cliente in FIC (cache) e quello del DB.
-    Ritorna True se c'è almeno una differenza → serve la chiamata API.
+    Confronta i campi rilevanti tra il cliente in FIC (cache) e quello del DB,
+    entrambi normalizzati per campo (fieldnorm.py): maiuscole, spazi, formato
+    del telefono o della provincia non sono modifiche.
+    Ritorna i campi diversi, nell'ordine di COMPARE_FIELDS (vuota se identici).
     """
+    changes = []
+    for field in COMPARE_FIELDS:
+        if field in LATE_CACHE_FIELDS and field not in existing:
+            continue
+        new_value = crm_value(new_data, field)
+        if field == "default_payment_method" and new_value is None:
+            # metodo assente o sconosciuto nel CRM: su FIC resta quello impostato (come nella modifica completa)
+            continue
+        if normalized(field, fic_value(existing, field)) != normalized(field, new_value):
+            changes.append(field)
+    return changes
+
+
+def literal_changes(existing: dict, new_data: dict) -> list:
+    """Confronto letterale (solo strip), quello usato prima della normalizzazione: misura le chiamate risparmiate."""
+    changes = []
     for field in COMPARE_FIELDS:
+        if field in LATE_CACHE_FIELDS and field not in existing:
+            continue
         val_fic = str(existing.get(field) or "").strip()
-        val_db  = str(new_data.get(field) or "").strip()
+        val_db  = str(crm_value(new_data, field) or "").strip()
         if val_fic != val_db:
-            return True
-    return False
+            changes.append(field)
+    return changes
+
+
+def client_needs_update(existing: dict, new_data: dict) -> bool:
+    """True se c'è almeno una differenza → serve la chiamata API."""
+    return bool(client_changes(existing, new_data))
+
+
+def client_patch(client, changes):
+    """
+    Dati della modifica parziale: solo gli attributi dei campi cambiati.
+    Un campo svuotato nel CRM va inviato come stringa vuota: i valori None
+    vengono omessi dall'SDK e su FIC resterebbe il valore vecchio.
+    """
+    patch = {}
+    for field in changes:
+        value = crm_value(client, field)
+        if field != "default_payment_method":
+            value = "" if value is None else str(value).strip()
+        for attr in PATCH_FIELDS[field]:
+            patch[attr] = value
+    return patch
+
+
+def patch_client_data(patch):
+    """
+    Client dell'SDK con i soli campi di `patch`. I campi con un valore di default
+    nel modello (es. default_payment_terms_type = standard) verrebbero serializzati
+    comunque e sovrascriverebbero su FIC i valori modificati a mano: li azzero.
+    Il metodo di pagamento (id nel patch) diventa un riferimento con il solo id.
+    """
+    import fattureincloud_python_sdk
 
+    if patch.get("default_payment_method") is not None:
+        patch = {**patch, "default_payment_method": fattureincloud_python_sdk.PaymentMethod(
+            id=patch["default_payment_method"], type=None)}
+    defaults = {name: None for name, field in fattureincloud_python_sdk.Client.model_fields.items()
+                if field.default is not None and name not in patch}
+    return fattureincloud_python_sdk.Client(**patch, **defaults)
 
-def sync_client(api_instance, existing, client, max_retries=4):
-    client_data = fattureincloud_python_sdk.Client(
+
+def full_client_data(client):
+    """Client dell'SDK con tutti i campi del CRM (creazione, o modifica senza elenco dei cambi)."""
+    import fattureincloud_python_sdk
+
+    return fattureincloud_python_sdk.Client(
         name=client["name"],
         address_street=client.get("address_street"),
         address_city=client.get("address_city"),
@@ -118,22 +201,49 @@ def sync_client(api_instance, existing, client, max_retries=4):
         default_payment_method=client.get("default_payment_method"),
     )
 
+
+def sync_client(api_instance, existing, client, changes=None, max_retries=4):
+    """
+    Ritorna (record, errore): in caso di successo il record di cache del cliente
+    aggiornato/creato (con l'id FIC) e None, altrimenti None e l'ultima ApiException.
+    Con `changes` (campi da client_changes) la modifica invia solo quei campi;
+    la creazione invia sempre il cliente completo.
+    """
+    import fattureincloud_python_sdk
+    from fattureincloud_python_sdk.rest import ApiException
+
+    if existing and changes:
+        client_data = patch_client_data(client_patch(client, changes))
+    else:
+        client_data = full_client_data(client)
+
     for attempt in range(max_retries):
         try:
             if existing:
                 client_id = existing["id"] if isinstance(existing, dict) else existing.id
-                api_instance.modify_client(
+                resp = api_instance.modify_client(
                     company_id,
                     client_id,
                     fattureincloud_python_sdk.ModifyClientRequest(data=client_data)
                 )
             else:
-                api_instance.create_client(
+                client_id = None
+                resp = api_instance.create_client(
                     company_id,
                     fattureincloud_python_sdk.CreateClientRequest(data=client_data)
                 )
                 log(f"Creato nuovo cliente: {client['name']} ({client['vat_number']})", log_filename, "notice")
-            return  # successo → esci
+
+            # record per il write-back in cache: dalla risposta se completa, altrimenti dai dati inviati
+            data = getattr(resp, "data", None)
+            if data is not None and getattr(data, "id", None):
+                return fic_client_record(data), None
+            if client_id is None:
+                return None, None
+            # modifica parziale: write_back_client unisce i campi cambiati al record in cache
+            record = {field: crm_value(client, field) or "" for field in (changes or COMPARE_FIELDS)}
+            record["id"] = client_id
+            return record, None  # successo → esci
 
         except ApiException as e:
             if e.status == 429 and attempt < max_retries - 1:
@@ -142,82 +252,329 @@ def sync_client(api_instance, existing, client, max_retries=4):
                 time.sleep(wait)
             else:
                 log(f"Errore sync cliente {client['name']}: {e}", log_filename, "error")
-                return
+                return None, e
 
 
-# --- MAIN ---
-if __name__ == "__main__":
+def shard_of(vat, shards):
+    """Shard (0..shards-1) di una P.IVA: hash stabile fra processi e host (non hash() di Python)."""
+    return zlib.crc32(normalize_vat(vat).encode("utf-8")) % shards
 
-    if not os.path.exists(BATCH_FILE):
-        db_clients = get_clients_from_db()
-        with open(BATCH_FILE, "w", encoding="utf-8") as f:
-            json.dump(db_clients, f, ensure_ascii=False, indent=2)
 
-    with open(BATCH_FILE, "r", encoding="utf-8") as f:
-        clients = json.load(f)
+def shard_batch_file(shard, shards):
+    return f"clients_batch-{shard + 1}of{shards}.json"
+
+
+def extract_valid_clients():
+    """Estrae le anagrafiche dal gestionale e le valida; gli scarti finiscono nel report del giorno."""
+    db_clients = get_clients_from_db()
+
+    # validazione locale una sola volta sull'intera estrazione: gli scarti non consumano quota API
+    db_clients, rejects = validate_clients(db_clients)
+    if rejects:
+        rejects_file = write_rejects_report(rejects)
+        log(f"{len(rejects)} anagrafiche non valide escluse dalla sync (dettaglio in {rejects_file}).", log_filename, "warning")
+    return db_clients
+
+
+def extract_clients_batch(batch_file=BATCH_FILE):
+    """Estrae e valida le anagrafiche e scrive il file di batch."""
+    db_clients = extract_valid_clients()
+    atomic_write_json(batch_file, db_clients, indent=2)
+    return db_clients
+
 
+def extract_shard_batches(shards):
+    """
+    Un'unica estrazione e validazione per tutti gli shard: i clienti vengono
+    divisi per shard e scritti nei file di batch degli shard che non ne hanno
+    uno in corso (quelli a metà restano intatti). Sotto lock: se un altro
+    worker ha appena estratto, non si ripete. Ritorna gli shard riempiti.
+    """
+    with file_lock(SHARD_EXTRACT_LOCK):
+        missing = [s for s in range(shards) if not os.path.exists(shard_batch_file(s, shards))]
+        if not missing:
+            return []
+        batches = {s: [] for s in missing}
+        for c in extract_valid_clients():
+            shard = shard_of(c.get("vat_number"), shards)
+            if shard in batches:
+                batches[shard].append(c)
+        for shard, clients in batches.items():
+            atomic_write_json(shard_batch_file(shard, shards), clients, indent=2)
+        log(f"Estrazione per {len(missing)} shard su {shards}: "
+            f"{sum(len(c) for c in batches.values())} clienti.", log_filename, "notice")
+        return missing
+
+
+def load_batch_file(batch_file):
+    """Batch rimasto dal run precedente; None se non c'è, lista vuota (e file rimosso) se è finito."""
+    if not os.path.exists(batch_file):
+        return None
+    with phase("extract"), open(batch_file, "r", encoding="utf-8") as f:
+        clients = json.load(f)
     if not clients:
-        os.remove(BATCH_FILE)
-        exit()
+        os.remove(batch_file)
+    return clients
 
-    current_batch = clients[:BATCH_SIZE]
-    remaining = clients[BATCH_SIZE:]
 
-    with fattureincloud_python_sdk.ApiClient(configuration) as api_client:
-        info_api = fattureincloud_python_sdk.InfoApi(api_client)
-        try:
-            name_to_id = load_payment_methods_cached(info_api, company_id)
-        except AttributeError:
-            log("Il metodo list_payment_methods non esiste.", log_filename, "error")
-            quit()
+def sync_batch(api_instance, name_to_id, fic_index, clients, batch_file=BATCH_FILE, shard=None, shards=None, lost=None):
+    """
+    Sincronizza i clienti (prima i retry della dead-letter queue) finché il
+    budget del run lo permette e riscrive nel file di batch quelli rimasti.
+    In modalità shard prende solo i retry del proprio shard; `lost` è l'evento
+    del lease: se viene impostato il worker si ferma e rimette in coda i
+    clienti non ancora elaborati.
+    """
+    import fattureincloud_python_sdk
+
+    current_batch = clients
+    remaining = []
+
+    # Retry dalla dead-letter queue: i clienti scaduti passano davanti al batch
+    batch_vats = {c.get("vat_number") for c in current_batch}
+    retries = [e["payload"] for e in dlq_due("client")
+               if e.get("payload") and e["key"] not in batch_vats
+               and (shard is None or shard_of(e["key"], shards) == shard)]
+    if retries:
+        log(f"Dead-letter: {len(retries)} clienti da ritentare.", log_filename, "notice")
+        current_batch = retries + current_batch
+    # voci in dead-letter da chiudere anche se il cliente risulta ormai identico su FIC
+    dead_letters = dlq_keys("client")
+
+    log(f"{len(current_batch)} clienti in coda, nel budget ne stanno circa {items_that_fit()} con modifiche.",
+        log_filename, "notice")
+
+    skipped = 0
+    updated = 0
+    created = 0
+    errors  = 0
+    saved = 0
+    processed = 0
+
+    try:
+        for c in current_batch:
+            if lost is not None and lost.is_set():
+                log(f"Lease dello shard {shard + 1}/{shards} perso: mi fermo.", log_filename, "warning")
+                break
+            if not budget_allows():
+                log(f"Budget del run esaurito ({BUDGET['exhausted']}) dopo {processed} clienti.", log_filename, "notice")
+                break
+            processed += 1
+            with budget_item():
+                vat = c.get("vat_number")
+                if not vat:
+                    log(f"Cliente {c.get('name')} senza P.IVA, ignorato.", log_filename, "warning")
+                    continue
+
+                # copia serializzabile per la dead-letter queue (prima della mappatura SDK)
+                raw_client = dict(c)
+
+                # Mappa metodo di pagamento → oggetto SDK
+                method_name = c.get("default_payment_method")
+                method_id = name_to_id.get(method_name) if isinstance(method_name, str) else None
+                if method_id:
+                    c["default_payment_method"] = fattureincloud_python_sdk.PaymentMethod(id=method_id)
+                else:
+                    c["default_payment_method"] = None
+                    if method_name:
+                        log(f"Metodo di pagamento '{method_name}' non trovato per {c['name']}.", log_filename, "warning")
+
+                with phase("diff"):
+                    # lookup su P.IVA normalizzata, poi codice fiscale e codice CRM: evita duplicati su FIC
+                    existing = find_client(fic_index, vat=vat, tax_code=c.get("tax_code"), code=c.get("code"))
+
+                    # ← PUNTO CHIAVE: salta se i dati sono identici
+                    changes = client_changes(existing, c) if existing else None
+                    unchanged = existing and not changes
+                if unchanged:
+                    skipped += 1
+                    if vat in dead_letters:
+                        # allineato nel frattempo (es. corretto a mano su FIC): niente più retry
+                        dlq_resolve("client", vat)
+                    if literal_changes(existing, c):
+                        # diverso solo nella forma: senza normalizzazione sarebbe stata una modify_client
+                        saved += 1
+                    continue
+
+                if existing:
+                    updated += 1
+                else:
+                    created += 1
+
+                with phase("send"):
+                    if changes:
+                        log(f"Cliente {vat}: modifico {', '.join(changes)}.", log_filename, "notice")
+                    record, error = sync_client(api_instance, existing, c, changes)
+                    if error is None:
+                        dlq_resolve("client", vat)
+                        # write-back: la cache vede subito il cliente nuovo/aggiornato
+                        if record is not None:
+                            write_back_client(fic_index, record)
+                    else:
+                        errors += 1
+                        entry = dlq_add("client", vat, error, payload=raw_client)
+                        if entry["quarantined"]:
+                            log(f"Cliente {vat} in quarantena ({entry['error_class']}, status={entry['status']}).", log_filename, "warning")
+    finally:
+        # un'unica riscrittura della cache per batch con tutti i write-back del giornale
+        compact_clients_cache()
+
+    if processed < len(current_batch):
+        # budget esaurito o lease perso: i clienti non elaborati (retry esclusi, restano in dead-letter) tornano in coda
+        remaining = current_batch[max(processed, len(retries)):]
+
+    add_counts(updated=updated, created=created, skipped=skipped, errors=errors, retries=len(retries), normalized=saved)
+    note_batch(1, processed, len(current_batch), label=None if shard is None else f"shard {shard + 1}/{shards}")
+    prefix = "" if shard is None else f"[shard {shard + 1}/{shards}] "
+    log(
+        f"{prefix}Batch completato: {updated} aggiornati, {created} creati, "
+        f"{skipped} saltati (invariati; {saved} chiamate API risparmiate dalla normalizzazione), {errors} errori "
+        f"su {processed} clienti processati.",
+        log_filename, "notice"
+    )
+
+    if remaining:
+        atomic_write_json(batch_file, remaining, indent=2)
+    else:
+        os.remove(batch_file)
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="Sincronizza le anagrafiche vtiger su Fatture in Cloud")
+    parser.add_argument(
+        "--shards", type=int, metavar="N",
+        help="modalità distribuita: clienti divisi in N shard per hash della P.IVA; "
+             "ogni worker (anche su host diversi con la cartella condivisa) prende gli shard liberi"
+    )
+    add_profile_argument(parser)
+    return parser.parse_args()
+
+
+def log_run_summary(api_client):
+    pending, quarantined = dlq_summary()
+    if pending or quarantined:
+        log(f"Dead-letter: {pending} in attesa di retry, {quarantined} in quarantena.", log_filename, "notice")
+    log(f"Run sync: {budget_summary()}", log_filename, "notice")
+    hits, misses = normalizer_cache_stats()
+    if hits or misses:
+        log(f"Normalizzatori: {hits} valori dalla cache, {misses} calcolati.", log_filename, "notice")
+    log_transport_stats(api_client, log_filename)
+
 
+# --- MAIN ---
+def main():
+
+    clients = load_batch_file(BATCH_FILE)
+    if clients == []:
+        exit()
+    # budget aperto solo quando c'è lavoro: il batch finito esce prima
+    start_budget("sync")
+
+    # l'SDK si carica solo adesso, dopo l'uscita anticipata sul batch vuoto
+    import fattureincloud_python_sdk
+
+    with fic_api_client(workers=3) as api_client:
         api_instance = fattureincloud_python_sdk.ClientsApi(api_client)
-        fic_clients = load_all_fic_clients(api_instance, log_filename, company_id)
 
-        skipped = 0
-        updated = 0
-        created = 0
-        errors  = 0
+        # estrazione vtiger, metodi di pagamento e clienti FIC sono indipendenti: li carico in parallelo
+        tasks = {
+            "metodi_pagamento": timed("refdata", lambda: load_payment_methods_cached(api_client, company_id)),
+            "clienti_fic": timed("cache_load", lambda: load_fic_client_index(api_instance, log_filename, company_id)),
+        }
+        if clients is None:
+            tasks["vtiger"] = timed("extract", extract_clients_batch)
+        startup = run_startup_tasks(tasks, log_filename)
+
+        name_to_id = startup["metodi_pagamento"]
+        if name_to_id is None:
+            quit()
+        fic_index = startup["clienti_fic"]
+        if clients is None:
+            clients = startup["vtiger"]
+            if not clients:
+                os.remove(BATCH_FILE)
+                exit()
 
-        for c in current_batch:
-            vat = c.get("vat_number")
-            if not vat:
-                log(f"Cliente {c.get('name')} senza P.IVA, ignorato.", log_filename, "warning")
-                continue
+        sync_batch(api_instance, name_to_id, fic_index, clients)
+        log_run_summary(api_client)
 
-            # Mappa metodo di pagamento → oggetto SDK
-            method_name = c.get("default_payment_method")
-            method_id = name_to_id.get(method_name) if isinstance(method_name, str) else None
-            if method_id:
-                c["default_payment_method"] = fattureincloud_python_sdk.PaymentMethod(id=method_id)
-            else:
-                c["default_payment_method"] = None
-                if method_name:
-                    log(f"Metodo di pagamento '{method_name}' non trovato per {c['name']}.", log_filename, "warning")
 
-            existing = fic_clients.get(vat)
+def main_sharded(shards):
+    """
+    Worker della sync distribuita: visita una volta ciascuno shard, prende il
+    lease di quelli liberi (o scaduti, lasciati da un worker morto) e ne
+    sincronizza un batch. Ogni shard ha il proprio file di batch, riempito
+    dall'estrazione comune (extract_shard_batches).
+    Non va eseguito insieme alla sync normale (clients_batch.json).
+    """
+    import fattureincloud_python_sdk
 
-            # ← PUNTO CHIAVE: salta se i dati sono identici
-            if existing and not client_needs_update(existing, c):
-                skipped += 1
+    start_budget("sync")
+    owner = worker_id()
+    with fic_api_client(workers=3) as api_client:
+        api_instance = fattureincloud_python_sdk.ClientsApi(api_client)
+        startup = run_startup_tasks({
+            "metodi_pagamento": timed("refdata", lambda: load_payment_methods_cached(api_client, company_id)),
+            "clienti_fic": timed("cache_load", lambda: load_fic_client_index(api_instance, log_filename, company_id)),
+        }, log_filename)
+        if startup["metodi_pagamento"] is None:
+            return
+
+        extracted = False
+        # ordine di visita ruotato sul pid: worker diversi partono da shard diversi
+        first = os.getpid() % shards
+        for shard in [(first + k) % shards for k in range(shards)]:
+            if not budget_allows():
+                # budget del run esaurito: gli shard rimasti li prende il prossimo run (o un altro worker)
+                break
+            lease_name = f"sync-shard-{shard + 1}of{shards}"
+            lease = try_claim(lease_name, owner)
+            if lease is None:
                 continue
-
-            if existing:
-                updated += 1
+            fic_index = startup["clienti_fic"]
+            if lease["reclaimed_from"]:
+                # il worker morto può aver creato clienti dopo il nostro avvio: rileggo la cache
+                # (con i suoi write-back) per non crearli una seconda volta
+                log(f"Worker {owner}: recupero lo shard {shard + 1}/{shards} da {lease['reclaimed_from']}.", log_filename, "warning")
+                fic_index = load_fic_client_index(api_instance, log_filename, company_id)
             else:
-                created += 1
+                log(f"Worker {owner}: preso lo shard {shard + 1}/{shards}.", log_filename, "notice")
+            with held_lease(lease_name, owner) as lost:
+                batch_file = shard_batch_file(shard, shards)
+                clients = load_batch_file(batch_file)
+                if clients is None and not extracted:
+                    # al massimo un'estrazione per run: riempie anche gli altri shard senza batch
+                    with phase("extract"):
+                        extract_shard_batches(shards)
+                    extracted = True
+                    clients = load_batch_file(batch_file)
+                if clients:
+                    sync_batch(api_instance, startup["metodi_pagamento"], fic_index, clients,
+                               batch_file, shard, shards, lost)
+
+        log_run_summary(api_client)
 
-            sync_client(api_instance, existing, c)
 
-        log(
-            f"Batch completato: {updated} aggiornati, {created} creati, "
-            f"{skipped} saltati (invariati), {errors} errori "
-            f"su {len(current_batch)} clienti processati.",
-            log_filename, "notice"
-        )
-
-    if remaining:
-        with open(BATCH_FILE, "w", encoding="utf-8") as f:
-            json.dump(remaining, f, ensure_ascii=False, indent=2)
-    else:
-        os.remove(BATCH_FILE)
\ No newline at end of file
+if __name__ == "__main__":
+    args = parse_args()
+    if args.profile is not None:
+        enable_profiling(args.profile)
+    try:
+        if args.shards:
+            # i worker si coordinano con i lease degli shard, non con il lock del job
+            try:
+                main_sharded(args.shards)
+            finally:
+                record_run("sync", log_filename)
+        else:
+            with run_lock("sync"):
+                try:
+                    main()
+                finally:
+                    record_run("sync", log_filename)
+    except JobAlreadyRunning as e:
+        print(e)
+        log(str(e), log_filename, "warning")
+    finally:
+        write_profile_report("sync", log_filename)
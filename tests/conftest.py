@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# gli script leggono COMPANY_ID all'import
+os.environ.setdefault("COMPANY_ID", "1")
+os.environ.pop("START_INDEX", None)
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Ogni test lavora in una cartella vuota: file di stato, WAL e SQLite sono relativi alla cwd."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,71 @@
+import gzip
+import json
+import time
+
+from cassette import ReplayPoolManager, _scrub_text, replay_scrub, scrub_record
+
+
+def test_client_fields_are_pseudonymised_consistently():
+    body = json.dumps({"data": [
+        {"id": 1, "name": "Mario Rossi srl", "vat_number": "01234567890", "tax_code": "RSSMRA80A01H501U",
+         "address_street": "Via Roma 1", "address_city": "Roma", "email": "mario@rossi.it", "phone": "+39 06 123"},
+    ]})
+    request = json.dumps({"data": {"entity": {"id": 1, "name": "Mario Rossi srl"},
+                                   "items_list": [{"name": "Servizio"}], "payment_method": {"name": "Bonifico"}}})
+
+    client = json.loads(_scrub_text(body))["data"][0]
+    order = json.loads(_scrub_text(request))["data"]
+
+    text = json.dumps(client) + json.dumps(order)
+    for secret in ("Mario", "Rossi", "01234567890", "RSSMRA", "Via Roma", "mario@rossi.it", "123"):
+        assert secret not in text
+    assert client["id"] == 1
+    assert len(client["vat_number"]) == 11 and client["vat_number"].isdigit()
+    assert order["entity"]["name"] == client["name"]
+    # i nomi di servizi e metodi di pagamento servono al replay e non sono dati personali
+    assert order["items_list"][0]["name"] == "Servizio"
+    assert order["payment_method"]["name"] == "Bonifico"
+
+
+def test_non_json_body_still_scrubs_emails():
+    assert "mario@rossi.it" not in _scrub_text("errore per mario@rossi.it")
+
+
+def test_vtiger_rows_get_the_same_pseudonyms_as_the_cassette():
+    fic = json.loads(_scrub_text(json.dumps({"data": [
+        {"id": 7, "name": "ACME  SRL", "vat_number": "IT01234567897", "address_postal_code": "00118",
+         "address_city": "ROMA", "email": "Info@Acme.it"},
+    ]})))["data"][0]
+    row = scrub_record({"code": "ACC1", "name": "Acme srl", "vat_number": "01234567897", "address_zip": "118",
+                        "address_city": "Roma", "email": "info@acme.it", "default_payment_method": "Bonifico"})
+
+    for fic_field, row_field in (("name", "name"), ("vat_number", "vat_number"), ("address_postal_code", "address_zip"),
+                                 ("address_city", "address_city"), ("email", "email")):
+        assert fic[fic_field] == row[row_field]
+    assert row["code"] == "ACC1" and row["default_payment_method"] == "Bonifico"
+
+
+def test_replay_scrub_leaves_rows_alone_outside_replay():
+    rows = [{"vat_number": "01234567897"}]
+    assert replay_scrub(rows) is rows
+
+
+def test_replay_honours_the_recorded_gaps(tmp_path):
+    path = tmp_path / "run.cassette.gz"
+    entries = [
+        {"t": 5.0, "d": 0.0, "m": "GET", "u": "https://api/c/1/clients?page=1", "s": 200, "b": "{}"},
+        {"t": 6.0, "d": 0.5, "m": "GET", "u": "https://api/c/1/clients?page=2", "s": 200, "b": "{}"},
+    ]
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write("\n".join(json.dumps(e) for e in entries))
+    replay = ReplayPoolManager(str(path), speed=10)
+
+    t0 = time.perf_counter()
+    replay.request("GET", "https://api/c/1/clients?page=1")
+    first = time.perf_counter() - t0
+    replay.request("GET", "https://api/c/1/clients?page=2")
+    second = time.perf_counter() - t0
+
+    # la prima risposta non aspetta l'avvio registrato (t=5 s), la seconda arriva 1.5 s / 10 dopo
+    assert first < 0.1
+    assert 0.14 <= second < 0.4
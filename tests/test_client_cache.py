@@ -0,0 +1,49 @@
+import os
+import json
+
+from globalutils import (CLIENTS_FILE, CLIENTS_JOURNAL_FILE, _read_clients_file, build_client_index,
+                         compact_clients_cache, find_client, remove_cached_client, write_back_client)
+
+CLIENTS = [
+    {"id": 1, "code": "A1", "name": "Alfa srl", "vat_number": "01234567897", "tax_code": "", "address_city": "Roma"},
+    {"id": 2, "code": "B2", "name": "Beta srl", "vat_number": "09876543210", "tax_code": "", "address_city": "Milano"},
+]
+
+
+def _write_cache():
+    with open(CLIENTS_FILE, "w", encoding="utf-8") as f:
+        json.dump(CLIENTS, f)
+    os.utime(CLIENTS_FILE, (1_700_000_000, 1_700_000_000))
+
+
+def test_write_back_appends_to_the_journal_without_rewriting_the_cache():
+    _write_cache()
+    index = build_client_index(_read_clients_file())
+
+    write_back_client(index, {"id": 1, "address_city": "Napoli"})
+    write_back_client(index, {"id": 3, "code": "C3", "name": "Gamma srl", "vat_number": "11111111111"})
+    assert remove_cached_client(index, 2)
+    assert not remove_cached_client(None, 99)
+
+    # indice in memoria aggiornato subito, file della cache intatto
+    assert find_client(index, vat="01234567897")["address_city"] == "Napoli"
+    assert find_client(index, vat="11111111111")["id"] == 3
+    assert find_client(index, vat="09876543210") is None
+    assert json.load(open(CLIENTS_FILE, encoding="utf-8")) == CLIENTS
+    # chi rilegge la cache vede anche i write-back del giornale
+    by_id = {c["id"]: c for c in _read_clients_file()}
+    assert sorted(by_id) == [1, 3]
+    assert by_id[1] == {**CLIENTS[0], "address_city": "Napoli"}
+
+
+def test_compaction_merges_the_journal_once_and_keeps_the_cache_date():
+    _write_cache()
+    write_back_client(None, {"id": 1, "address_city": "Napoli"})
+    remove_cached_client(None, 2)
+
+    assert compact_clients_cache() == 2
+
+    assert not os.path.exists(CLIENTS_JOURNAL_FILE)
+    assert json.load(open(CLIENTS_FILE, encoding="utf-8")) == [{**CLIENTS[0], "address_city": "Napoli"}]
+    assert os.path.getmtime(CLIENTS_FILE) == 1_700_000_000
+    assert compact_clients_cache() == 0
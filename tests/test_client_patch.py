@@ -0,0 +1,50 @@
+import fattureincloud_python_sdk
+
+from syncAnagrafiche3 import client_changes, client_patch, patch_client_data
+
+
+def _body(patch):
+    request = fattureincloud_python_sdk.ModifyClientRequest(data=patch_client_data(patch))
+    return fattureincloud_python_sdk.ApiClient().sanitize_for_serialization(request)
+
+
+def test_patch_body_contains_only_changed_fields():
+    existing = {"id": 1, "name": "Acme srl", "phone": "061234567", "email": "info@acme.it"}
+    crm = {"name": "Acme srl", "phone": "067654321", "email": "info@acme.it"}
+    changes = client_changes(existing, crm)
+    assert changes == ["phone"]
+    assert _body(client_patch(crm, changes)) == {"data": {"phone": "067654321"}}
+
+
+def test_cleared_field_is_sent_as_empty_string():
+    existing = {"id": 1, "name": "Acme srl", "email": "info@acme.it"}
+    crm = {"name": "Acme srl", "email": None}
+    changes = client_changes(existing, crm)
+    assert changes == ["email"]
+    assert _body(client_patch(crm, changes)) == {"data": {"email": ""}}
+
+
+def test_postal_code_maps_to_sdk_field():
+    existing = {"id": 1, "name": "Acme srl", "address_zip": "00100"}
+    crm = {"name": "Acme srl", "address_zip": "20121"}
+    changes = client_changes(existing, crm)
+    assert _body(client_patch(crm, changes)) == {"data": {"address_postal_code": "20121"}}
+
+
+def test_crm_only_fields_are_compared_and_patched():
+    existing = {"id": 1, "name": "Acme srl", "code": "ACC1", "contact_person": "Mario Rossi", "notes": "",
+                "default_payment_method": 5}
+    crm = {"name": "Acme srl", "code": "ACC2", "contact_person": "mario  rossi", "notes": "Pagamento anticipato",
+           "default_payment_method": fattureincloud_python_sdk.PaymentMethod(id=7)}
+    changes = client_changes(existing, crm)
+    assert changes == ["code", "notes", "default_payment_method"]
+    assert _body(client_patch(crm, changes)) == {"data": {
+        "code": "ACC2", "notes": "Pagamento anticipato", "default_payment_method": {"id": 7}}}
+
+
+def test_unknown_payment_method_and_old_cache_records_are_not_changes():
+    crm = {"name": "Acme srl", "contact_person": "Mario Rossi", "notes": "nota", "default_payment_method": None}
+    # record scaricato prima che la cache contenesse referente, note e metodo di pagamento
+    assert client_changes({"id": 1, "name": "Acme srl"}, crm) == []
+    assert client_changes({"id": 1, "name": "Acme srl", "contact_person": "Mario Rossi", "notes": "nota",
+                           "default_payment_method": 5}, crm) == []
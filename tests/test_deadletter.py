@@ -0,0 +1,58 @@
+import json
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import deadletter
+from deadletter import dlq_add, dlq_due, dlq_resolve, dlq_summary, next_retry_at
+from globalutils import build_client_index
+
+
+def _error(status):
+    return SimpleNamespace(status=status)
+
+
+def test_backoff_doubles_and_is_capped():
+    now = datetime(2026, 10, 1, 12, 0)
+    assert next_retry_at(1, now) - now == timedelta(minutes=15)
+    assert next_retry_at(3, now) - now == timedelta(minutes=60)
+    assert next_retry_at(20, now) - now == timedelta(hours=deadletter.RETRY_MAX_HOURS)
+
+
+def test_transient_error_is_retried_after_backoff():
+    entry = dlq_add("client", "01234567890", _error(503), payload={"vat_number": "01234567890"})
+    assert not entry["quarantined"]
+    assert dlq_due("client") == []
+    later = datetime.now() + timedelta(minutes=deadletter.RETRY_BASE_MINUTES + 1)
+    assert [e["key"] for e in dlq_due("client", now=later)] == ["01234567890"]
+    assert dlq_due("order", now=later) == []
+
+
+def test_permanent_error_and_max_attempts_quarantine():
+    assert dlq_add("client", "A", _error(422))["quarantined"]
+    for _ in range(deadletter.MAX_ATTEMPTS - 1):
+        entry = dlq_add("client", "B", _error(500))
+    assert not entry["quarantined"]
+    assert dlq_add("client", "B", _error(500))["quarantined"]
+    assert dlq_summary() == (0, 2)
+
+
+def test_resolve_removes_entry():
+    dlq_add("order", "01234567890/10002", _error(500))
+    assert dlq_resolve("order", "01234567890/10002")
+    assert not dlq_resolve("order", "01234567890/10002")
+    assert dlq_summary() == (0, 0)
+
+
+def test_unchanged_client_resolves_its_dead_letter():
+    import syncAnagrafiche3
+
+    vat = "01234567890"
+    client = {"name": "Acme srl", "vat_number": vat, "email": "info@acme.it"}
+    dlq_add("client", vat, _error(500), payload=client)
+    fic_index = build_client_index([{"id": 7, **client}])
+    with open("batch.json", "w", encoding="utf-8") as f:
+        json.dump([dict(client)], f)
+
+    syncAnagrafiche3.sync_batch(None, {}, fic_index, [dict(client)], batch_file="batch.json")
+
+    assert dlq_summary() == (0, 0)
@@ -0,0 +1,64 @@
+import threading
+
+from docnumbers import (allocate, allocate_many, first_number, lookup_numbers, mark_gap, number_report,
+                        reconcile_numbers, seed_numbers, EXTERNAL, GAP, RESERVED, USED)
+
+MONTH = "2026-03"
+
+
+def test_allocation_is_stable_across_rebuilds():
+    first = allocate_many(1, MONTH, ["A#1", "B#1"])
+    again = allocate_many(1, MONTH, ["C#1", "B#1", "A#1"])
+
+    assert first == {"A#1": first_number(MONTH), "B#1": first_number(MONTH) + 1}
+    assert again == {**first, "C#1": first_number(MONTH) + 2}
+    # scope separati per azienda e mese
+    assert allocate(2, MONTH, "A#1") == first_number(MONTH)
+    assert allocate(1, "2026-04", "A#1") == first_number("2026-04")
+
+
+def test_concurrent_allocations_never_share_a_number():
+    results = []
+
+    def run(prefix):
+        results.append(allocate_many(1, MONTH, [f"{prefix}#{i}" for i in range(20)]))
+
+    threads = [threading.Thread(target=run, args=(p,)) for p in "ABCD"]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    numbers = [n for r in results for n in r.values()]
+    assert len(numbers) == len(set(numbers)) == 80
+
+
+def test_gaps_are_not_reassigned():
+    number = allocate(1, MONTH, "A#1")
+    mark_gap(1, MONTH, number, note="annullato")
+
+    assert allocate(1, MONTH, "B#1") == number + 1
+    assert "A#1" not in lookup_numbers(1, MONTH)
+
+
+def test_seed_imports_wal_numbers_only_for_a_new_scope():
+    assert seed_numbers(1, MONTH, {"A#1": 3005, "B#1": 3007}, used={"A#1"}) == 2
+    assert seed_numbers(1, MONTH, {"C#1": 3100}) == 0
+
+    assert allocate_many(1, MONTH, ["A#1", "D#1"]) == {"A#1": 3005, "D#1": 3008}
+    statuses = {number: status for number, _, status, _ in number_report(1, MONTH)}
+    assert statuses == {3005: USED, 3007: RESERVED, 3008: RESERVED}
+
+
+def test_reconcile_marks_used_external_and_gaps():
+    numbers = allocate_many(1, MONTH, ["A#1", "B#1", "C#1"])
+    a, b, c = numbers["A#1"], numbers["B#1"], numbers["C#1"]
+    reconcile_numbers(1, MONTH, [a, b])
+
+    changes = reconcile_numbers(1, MONTH, [a, c, c + 1])
+
+    assert changes == {"used": [c], "external": [c + 1], "gap": [b]}
+    statuses = {number: status for number, _, status, _ in number_report(1, MONTH)}
+    assert statuses == {a: USED, b: GAP, c: USED, c + 1: EXTERNAL}
+    # il numero creato a mano su FIC viene saltato
+    assert allocate(1, MONTH, "D#1") == c + 2
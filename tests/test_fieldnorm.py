@@ -0,0 +1,66 @@
+import pytest
+
+from fieldnorm import fic_value, normalized, normalizer_cache_stats
+from syncAnagrafiche3 import client_changes
+
+
+@pytest.mark.parametrize("field, fic, crm", [
+    ("vat_number", "IT01234567897", "01234567897"),
+    ("vat_number", "it 012.345.678-97", "01234567897"),
+    ("tax_code", "rssmra80a01h501u", "RSSMRA80A01H501U"),
+    ("tax_code", " RSS MRA 80A01 H501U ", "RSSMRA80A01H501U"),
+    ("address_zip", "118", "00118"),
+    ("address_zip", " 00118", "00118"),
+    ("address_province", "rm", "RM"),
+    ("address_province", "(Rm)", "RM"),
+    ("name", "ACME  Srl ", "acme srl"),
+    ("phone", "+39 06 1234567", "061234567"),
+    ("email", " Info@Acme.IT", "info@acme.it"),
+    ("ei_code", "m5uxcr1", "M5UXCR1"),
+])
+def test_equivalent_values_normalize_the_same(field, fic, crm):
+    assert normalized(field, fic) == normalized(field, crm)
+
+
+@pytest.mark.parametrize("field, fic, crm", [
+    ("vat_number", "01234567897", "01234567898"),
+    # il prefisso IT si toglie solo davanti a cifre: una P.IVA estera resta com'è
+    ("vat_number", "ITALIA1", "ALIA1"),
+    ("address_zip", "00118", "00119"),
+    ("address_province", "RM", "MI"),
+    ("tax_code", "RSSMRA80A01H501U", "RSSMRA80A01H501V"),
+])
+def test_real_differences_survive_normalization(field, fic, crm):
+    assert normalized(field, fic) != normalized(field, crm)
+
+
+def test_blank_and_none_are_the_same_empty_value():
+    for field in ("email", "tax_code", "address_zip", "notes", "unknown_field"):
+        assert normalized(field, None) == normalized(field, "") == normalized(field, "   ") == ""
+    # numeri (es. CAP letto come intero) diventano stringhe prima della normalizzazione
+    assert normalized("address_zip", 118) == "00118"
+
+
+def test_fic_value_reads_the_postal_code_under_either_name():
+    assert fic_value({"address_zip": "", "address_postal_code": "00118"}, "address_zip") == "00118"
+    assert fic_value({"address_zip": "20121"}, "address_zip") == "20121"
+    assert fic_value({}, "tax_code") is None
+
+
+def test_client_changes_ignores_format_only_differences():
+    existing = {"id": 1, "name": "ACME SRL", "vat_number": "IT01234567897", "tax_code": "rssmra80a01h501u",
+                "address_zip": "118", "address_province": "rm", "email": "", "phone": "+39 06 1234567"}
+    crm = {"name": "Acme srl", "vat_number": "01234567897", "tax_code": "RSSMRA80A01H501U",
+           "address_zip": "00118", "address_province": "RM", "email": None, "phone": "06 1234567"}
+    assert client_changes(existing, crm) == []
+
+    crm["address_province"] = "MI"
+    crm["email"] = "info@acme.it"
+    assert client_changes(existing, crm) == ["address_province", "email"]
+
+
+def test_normalizers_are_memoized():
+    hits, _ = normalizer_cache_stats()
+    for _ in range(3):
+        normalized("address_city", "San Donato  Milanese")
+    assert normalizer_cache_stats()[0] >= hits + 2
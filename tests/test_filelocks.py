@@ -0,0 +1,48 @@
+import json
+import socket
+
+import pytest
+
+import filelocks
+from filelocks import run_lock, JobAlreadyRunning, RUN_LOCK_TEMPLATE
+
+
+def _write_lock(name, pid, started="2026-10-19 06:00:00"):
+    with open(RUN_LOCK_TEMPLATE.format(name=name), "w", encoding="utf-8") as f:
+        json.dump({"pid": pid, "host": socket.gethostname(), "started": started}, f)
+
+
+def test_second_run_is_refused_while_first_holds_the_lock():
+    with run_lock("orders"):
+        with pytest.raises(JobAlreadyRunning):
+            with run_lock("orders"):
+                pass
+
+
+def test_stale_lock_of_dead_process_is_taken_over(monkeypatch):
+    _write_lock("orders", 999999)
+    monkeypatch.setattr(filelocks, "_pid_alive", lambda pid: False)
+    with run_lock("orders") as info:
+        with open(RUN_LOCK_TEMPLATE.format(name="orders"), encoding="utf-8") as f:
+            assert json.load(f)["pid"] == info["pid"]
+
+
+def test_takeover_does_not_remove_a_lock_created_meanwhile(monkeypatch):
+    """Due processi trovano scaduto lo stesso lock: il secondo non deve cancellare quello del primo."""
+    _write_lock("orders", 999999)
+    original = filelocks._is_stale
+
+    def stale_then_taken_over(info, max_hours):
+        if info.get("pid") == 999999:
+            # nel frattempo un altro processo ha rimosso il lock scaduto e creato il suo
+            _write_lock("orders", 424242, started="2026-10-19 06:05:00")
+            return True
+        return original(info, max_hours)
+
+    monkeypatch.setattr(filelocks, "_is_stale", stale_then_taken_over)
+    monkeypatch.setattr(filelocks, "_pid_alive", lambda pid: pid == 424242)
+    with pytest.raises(JobAlreadyRunning):
+        with run_lock("orders", max_hours=10 ** 6):
+            pass
+    with open(RUN_LOCK_TEMPLATE.format(name="orders"), encoding="utf-8") as f:
+        assert json.load(f)["pid"] == 424242
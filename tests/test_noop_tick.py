@@ -0,0 +1,29 @@
+from datetime import date
+
+import pytest
+
+import createOrders3
+import syncAnagrafiche3
+
+
+def _no_budget(job, *args, **kwargs):
+    raise AssertionError(f"budget aperto in un tick a vuoto ({job})")
+
+
+def test_completed_month_exits_before_opening_the_budget(monkeypatch):
+    monkeypatch.setattr(createOrders3, "start_budget", _no_budget)
+    monkeypatch.setattr("sys.argv", ["createOrders3.py"])
+    createOrders3._save_state(next_index=0, completed_month=date.today().strftime("%Y-%m"))
+
+    with pytest.raises(SystemExit) as exit_info:
+        createOrders3.main()
+    assert exit_info.value.code == 0
+
+
+def test_finished_sync_batch_exits_before_opening_the_budget(monkeypatch):
+    monkeypatch.setattr(syncAnagrafiche3, "start_budget", _no_budget)
+    with open(syncAnagrafiche3.BATCH_FILE, "w", encoding="utf-8") as f:
+        f.write("[]")
+
+    with pytest.raises(SystemExit):
+        syncAnagrafiche3.main()
@@ -0,0 +1,97 @@
+import json
+from types import SimpleNamespace
+
+import createOrders3
+from globalutils import CLIENTS_FILE, clients_cache_fingerprint, write_back_client
+from orderplan import write_plan, iter_plan, plan_is_current, read_plan_header
+from orderwal import wal_append, wal_done_keys
+
+MONTH = "2026-10"
+
+
+def _order(n, vat):
+    return SimpleNamespace(
+        entity=SimpleNamespace(id=n, name=f"Cliente {n}", vat_number=vat),
+        number=10000 + n,
+        payment_method=None,
+        items_list=[SimpleNamespace(code="S1", name="Servizio", description=None, net_price=10.0,
+                                    qty=1.0, discount=0.0, vat=SimpleNamespace(id=0))],
+    )
+
+
+class FakeDocsApi:
+    def __init__(self):
+        self.created = []
+
+    def create_issued_document(self, company_id, create_issued_document_request):
+        od = create_issued_document_request.data
+        self.created.append(od.number)
+        return SimpleNamespace(data=SimpleNamespace(id=len(self.created), number=od.number))
+
+    def list_issued_documents(self, *args, **kwargs):
+        return SimpleNamespace(data=[])
+
+
+def test_iter_plan_returns_slice_and_retry_keys():
+    write_plan(MONTH, "1:1", [_order(n, f"0000000000{n}") for n in range(1, 7)])
+    positions = [i for i, _ in iter_plan(MONTH, 2, 4, {"00000000006/10006"})]
+    assert positions == [3, 4, 6]
+
+
+def test_rebuild_resets_checkpoint_and_wal_skips_sent_orders():
+    # primo piano: 4 ordini, i primi 2 inviati, checkpoint a 2
+    old = [_order(n, f"0000000000{n}") for n in (1, 2, 3, 4)]
+    write_plan(MONTH, "4:1", old)
+    for od in old[:2]:
+        wal_append(MONTH, "ok", od.entity.vat_number, od.number, doc_id=od.number)
+    createOrders3._save_state(next_index=2)
+
+    # ricostruzione: un cliente prima saltato finisce in posizione 2
+    new = [old[0], _order(9, "00000000009"), *old[1:]]
+    write_plan(MONTH, "5:1", new)
+    createOrders3.reset_checkpoint_after_rebuild(MONTH)
+    assert createOrders3._load_state()["next_index"] == 0
+
+    api = FakeDocsApi()
+    ok, ko, already = createOrders3.send_orders(api, MONTH, createOrders3._load_state(), "2026-10-19", "2026-10-31")
+
+    assert sorted(api.created) == [10003, 10004, 10009]
+    assert (ok, ko, already) == (3, 0, 2)
+    assert len(wal_done_keys(MONTH)) == 5
+    assert createOrders3._load_state()["completed_month"] == MONTH
+
+
+def test_rebuild_without_checkpoint_leaves_state_alone():
+    createOrders3.reset_checkpoint_after_rebuild(MONTH)
+    assert createOrders3._load_state()["next_index"] == 0
+
+
+def test_plan_is_stale_when_vtiger_rows_or_fic_clients_change():
+    plan = write_plan(MONTH, "4:1", [_order(1, "00000000001")], clients="cache-a")
+
+    assert plan_is_current(read_plan_header(MONTH), "4:1", "cache-a")
+    assert not plan_is_current(read_plan_header(MONTH), "5:1", "cache-a")
+    # cliente FIC nuovo, modificato o eliminato: le entità del piano vanno ricostruite
+    assert not plan_is_current(read_plan_header(MONTH), "4:1", "cache-b")
+    assert not plan_is_current(None, "4:1", "cache-a")
+
+
+def test_empty_month_plan_stays_valid_whatever_the_clients():
+    write_plan(MONTH, None, [], clients="cache-a")
+
+    assert plan_is_current(read_plan_header(MONTH), None, "cache-b")
+    assert not plan_is_current(read_plan_header(MONTH), "1:1", "cache-b")
+    # righe presenti ma tutte di clienti assenti su FIC: dipende dalla cache
+    write_plan(MONTH, "1:1", [], skipped=["00000000002"], clients="cache-a")
+    assert not plan_is_current(read_plan_header(MONTH), "1:1", "cache-b")
+
+
+def test_clients_fingerprint_covers_the_write_back_journal():
+    assert clients_cache_fingerprint() is None
+    with open(CLIENTS_FILE, "w", encoding="utf-8") as f:
+        json.dump([{"id": 1, "name": "Alfa", "vat_number": "00000000001"}], f)
+    before = clients_cache_fingerprint()
+
+    write_back_client(None, {"id": 1, "name": "Alfa srl"})
+
+    assert before is not None and clients_cache_fingerprint() != before
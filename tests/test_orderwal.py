@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+from orderwal import order_key, recover_inflight, wal_append, wal_done_keys, wal_filename, wal_inflight, wal_load
+
+MONTH = "2026-03"
+
+
+class FakeDocsApi:
+    """Su FIC c'è solo l'ordine 3002 della P.IVA 01234567897."""
+
+    def __init__(self):
+        self.queries = []
+
+    def list_issued_documents(self, company_id, type, fields, q):
+        self.queries.append(q)
+        docs = []
+        if q.startswith("number = 3002 "):
+            docs.append(SimpleNamespace(id=900, entity=SimpleNamespace(vat_number="01234567897")))
+        return SimpleNamespace(data=docs)
+
+
+def test_done_keys_follow_the_last_record_and_skip_a_truncated_line():
+    wal_append(MONTH, "intent", "01234567897", 3002)
+    wal_append(MONTH, "ok", "01234567897", 3002, doc_id=900)
+    wal_append(MONTH, "intent", "09876543210", 3003)
+    wal_append(MONTH, "ko", "09876543210", 3003)
+    wal_append(MONTH, "intent", "11111111111", 3004)
+    with open(wal_filename(MONTH), "a", encoding="utf-8") as f:
+        f.write('{"status": "ok", "vat": "11111111111", "numb')   # crash a metà scrittura
+
+    assert wal_done_keys(MONTH) == {order_key("01234567897", 3002)}
+    assert [r["number"] for r in wal_inflight(MONTH)] == [3004]
+
+
+def test_recover_inflight_marks_found_orders_ok_and_the_rest_aborted():
+    wal_append(MONTH, "intent", "01234567897", 3002, date="2026-03-01")
+    wal_append(MONTH, "intent", "09876543210", 3003, date="2026-03-01")
+    docs_api = FakeDocsApi()
+
+    assert recover_inflight(docs_api, 1, MONTH, "test.log") == (1, 1)
+
+    last = wal_load(MONTH)
+    recovered = last[order_key("01234567897", 3002)]
+    assert recovered["status"] == "ok" and recovered["doc_id"] == 900 and recovered["recovered"]
+    assert last[order_key("09876543210", 3003)]["status"] == "aborted"
+    assert wal_done_keys(MONTH) == {order_key("01234567897", 3002)}
+    assert docs_api.queries[0] == "number = 3002 and date = '2026-03-01'"
+    # nessun ordine resta in volo: un secondo recupero non interroga FIC
+    assert recover_inflight(docs_api, 1, MONTH, "test.log") == (0, 0)
+    assert len(docs_api.queries) == 2
+
+
+def test_same_number_with_another_vat_is_not_a_match():
+    wal_append(MONTH, "intent", "22222222222", 3002, date="2026-03-01")
+
+    assert recover_inflight(FakeDocsApi(), 1, MONTH, "test.log") == (0, 1)
+    assert wal_done_keys(MONTH) == set()
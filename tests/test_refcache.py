@@ -0,0 +1,19 @@
+from refcache import vat_type_id, DEFAULT_VAT_ID
+
+
+def test_default_vat_type_wins_over_special_types_with_same_value():
+    items = [
+        {"id": 55, "value": 22, "description": "Split payment", "is_disabled": False},
+        {"id": DEFAULT_VAT_ID, "value": 22, "description": "", "is_disabled": False},
+    ]
+    assert vat_type_id(items) == DEFAULT_VAT_ID
+
+
+def test_search_when_default_has_another_value_or_is_missing():
+    items = [
+        {"id": DEFAULT_VAT_ID, "value": 10, "is_disabled": False},
+        {"id": 3, "value": 22, "is_disabled": True},
+        {"id": 4, "value": 22, "is_disabled": False},
+    ]
+    assert vat_type_id(items) == 4
+    assert vat_type_id([]) == DEFAULT_VAT_ID
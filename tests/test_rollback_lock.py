@@ -0,0 +1,27 @@
+import pytest
+
+import rollbackOrders
+from filelocks import run_lock, JobAlreadyRunning
+from orderwal import wal_append
+
+MONTH = "2026-03"
+
+
+def _run(monkeypatch, *args):
+    monkeypatch.setattr("sys.argv", ["rollbackOrders.py", "--month", MONTH, *args])
+    rollbackOrders.main()
+
+
+def test_read_only_modes_do_not_take_the_job_lock(monkeypatch, capsys):
+    wal_append(MONTH, "ok", "01234567897", 3002, date="2026-03-01", doc_id=900)
+
+    with run_lock("orders"):
+        _run(monkeypatch, "--dry-run")
+        _run(monkeypatch, "--list-runs")
+        # l'eliminazione vera invece aspetta che createOrders3 (o un altro rollback) abbia finito
+        with pytest.raises(JobAlreadyRunning):
+            _run(monkeypatch)
+
+    out = capsys.readouterr().out
+    assert "1 ordini verrebbero eliminati" in out
+    assert "1 ordini" in out
@@ -0,0 +1,28 @@
+import json
+
+import syncAnagrafiche3
+from syncAnagrafiche3 import extract_shard_batches, load_batch_file, shard_batch_file, shard_of
+
+VATS = ["01234567897", "09876543210", "11111111111", "22222222222", "33333333333", "44444444444"]
+
+
+def test_one_extraction_fills_every_shard_without_a_batch(monkeypatch):
+    extractions = []
+    reports = []
+    clients = [{"name": f"Cliente {v}", "vat_number": v} for v in VATS]
+    monkeypatch.setattr(syncAnagrafiche3, "get_clients_from_db", lambda: extractions.append(1) or list(clients))
+    monkeypatch.setattr(syncAnagrafiche3, "write_rejects_report", lambda rejects: reports.append(rejects) or "r.json")
+    monkeypatch.setattr(syncAnagrafiche3, "validate_clients", lambda cs: (cs[1:], [{"vat_number": cs[0]["vat_number"]}]))
+    # shard 0 ha ancora un batch a metà: non va toccato
+    in_progress = [{"name": "in corso", "vat_number": "55555555555"}]
+    with open(shard_batch_file(0, 3), "w", encoding="utf-8") as f:
+        json.dump(in_progress, f)
+
+    assert extract_shard_batches(3) == [1, 2]
+    assert extract_shard_batches(3) == []
+
+    assert len(extractions) == 1 and len(reports) == 1
+    assert load_batch_file(shard_batch_file(0, 3)) == in_progress
+    for shard in (1, 2):
+        batch = load_batch_file(shard_batch_file(shard, 3))
+        assert [c["vat_number"] for c in batch] == [v for v in VATS[1:] if shard_of(v, 3) == shard]
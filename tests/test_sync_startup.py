@@ -0,0 +1,22 @@
+import pytest
+
+import syncAnagrafiche3
+from globalutils import run_startup_tasks
+
+
+def _missing_method(*args):
+    raise AttributeError("list_payment_methods")
+
+
+def test_missing_payment_methods_api_returns_none(monkeypatch):
+    monkeypatch.setattr(syncAnagrafiche3, "get_refdata", _missing_method)
+    assert syncAnagrafiche3.load_payment_methods_cached(None, 1) is None
+
+
+def test_attribute_errors_of_other_startup_tasks_propagate(monkeypatch):
+    monkeypatch.setattr(syncAnagrafiche3, "get_refdata", lambda *args: [])
+    with pytest.raises(AttributeError):
+        run_startup_tasks({
+            "metodi_pagamento": lambda: syncAnagrafiche3.load_payment_methods_cached(None, 1),
+            "clienti_fic": lambda: None.by_id,
+        }, "test.log")
@@ -0,0 +1,23 @@
+import json
+
+from validators import validate_clients, write_rejects_report
+
+
+def test_validate_clients_splits_valid_and_rejects():
+    good = {"code": "A1", "name": "Alfa srl", "vat_number": "01234567897", "email": "info@alfa.it"}
+    bad = {"code": "B2", "name": "Beta srl", "vat_number": "01234567890", "ei_code": "x", "email": "no"}
+
+    valid, rejects = validate_clients([good, bad])
+
+    assert valid == [good]
+    assert [r["code"] for r in rejects] == ["B2"]
+    assert len(rejects[0]["errors"]) == 3
+
+
+def test_rejects_report_is_written_atomically(workdir):
+    rejects = [{"code": "B2", "name": "Beta srl", "vat_number": "01234567890", "errors": ["P.IVA non valida"]}]
+
+    filename = write_rejects_report(rejects)
+
+    assert json.load(open(filename, encoding="utf-8")) == rejects
+    assert [p.name for p in workdir.iterdir()] == [filename]
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+
+import webhookReceiver
+from webhookReceiver import handle_event, journal_append, journal_load, pending_events, retry_delay
+
+
+class FakeApiError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+
+def _failing(status):
+    def apply_event(clients_api, event):
+        raise FakeApiError(status)
+    return apply_event
+
+
+def _receive(event_id="ev-1"):
+    return journal_append(event_id, "received", action="update", ids=[42], type="x")
+
+
+def test_transient_failure_is_journaled_and_rescheduled(monkeypatch):
+    retried = []
+    monkeypatch.setattr(webhookReceiver, "apply_event", _failing(503))
+    monkeypatch.setattr(webhookReceiver, "schedule_retry", lambda event, delay: retried.append((event, delay)))
+
+    handle_event(None, _receive())
+    handle_event(None, retried[-1][0])
+
+    assert [(e["attempts"], d) for e, d in retried] == [(1, retry_delay(1)), (2, retry_delay(2))]
+    assert retry_delay(2) == 2 * retry_delay(1)
+    entry = journal_load()["ev-1"]
+    assert entry["status"] == "failed" and entry["attempts"] == 2 and not entry["gave_up"]
+
+
+def test_permanent_error_and_retry_cap_give_up(monkeypatch):
+    retried = []
+    monkeypatch.setattr(webhookReceiver, "schedule_retry", lambda event, delay: retried.append(event))
+
+    monkeypatch.setattr(webhookReceiver, "apply_event", _failing(403))
+    handle_event(None, _receive("ev-perm"))
+
+    monkeypatch.setattr(webhookReceiver, "apply_event", _failing(503))
+    event = dict(_receive("ev-cap"), attempts=webhookReceiver.RETRY_MAX_ATTEMPTS - 1)
+    handle_event(None, event)
+
+    assert retried == []
+    journal = journal_load()
+    assert journal["ev-perm"]["gave_up"] and journal["ev-cap"]["gave_up"]
+    assert pending_events(journal) == []
+
+
+def test_failed_events_are_resumed_on_startup_after_backoff(monkeypatch):
+    retried = []
+    monkeypatch.setattr(webhookReceiver, "apply_event", _failing(503))
+    monkeypatch.setattr(webhookReceiver, "schedule_retry", lambda event, delay: retried.append(event))
+    handle_event(None, _receive("ev-failed"))
+    _receive("ev-new")
+    journal_append("ev-old", "received", action="delete", ids=[7], type="x")
+    journal_append("ev-old", "failed", error="errore registrato senza retry")
+
+    now = datetime.now()
+    pending = {e["event_id"]: (e.get("attempts", 0), delay) for e, delay in pending_events(journal_load(), now)}
+
+    assert pending["ev-new"] == (0, 0)
+    assert pending["ev-old"] == (1, 0)
+    attempts, delay = pending["ev-failed"]
+    assert attempts == 1 and 0 < delay <= retry_delay(1)
+    later = now + timedelta(seconds=retry_delay(1) + 1)
+    assert dict((e["event_id"], d) for e, d in pending_events(journal_load(), later))["ev-failed"] == 0
@@ -0,0 +1,71 @@
+import os
+
+# Trasporto HTTP dell'SDK configurato in un unico punto: dimensione del pool
+# urllib3 adeguata al numero di worker, timeout di connessione e lettura,
+# compressione delle risposte e statistiche di riuso delle connessioni.
+# I valori si possono sovrascrivere da .env.
+HTTP_CONNECT_TIMEOUT = float(os.getenv("FIC_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("FIC_HTTP_READ_TIMEOUT", "60"))
+HTTP_COMPRESSION = os.getenv("FIC_HTTP_COMPRESSION", "1") != "0"
+# connessioni in più rispetto ai worker (es. thread di avvio in parallelo)
+HTTP_POOL_HEADROOM = 2
+
+
+def configure_transport(configuration, workers=1):
+    """Dimensiona il pool di connessioni: va fatto prima di creare l'ApiClient."""
+    pool_size = int(os.getenv("FIC_HTTP_POOL_SIZE", "0")) or max(workers, 1) + HTTP_POOL_HEADROOM
+    configuration.connection_pool_maxsize = pool_size
+    return configuration
+
+
+def install_transport(api_client, pool_manager=None,
+                      connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                      compression=HTTP_COMPRESSION):
+    """
+    Applica timeout e compressione a tutte le chiamate dell'ApiClient.
+    `pool_manager` permette di usare un client HTTP alternativo compatibile con
+    urllib3.PoolManager (stessa interfaccia request()).
+    """
+    if pool_manager is not None:
+        api_client.rest_client.pool_manager = pool_manager
+
+    if compression:
+        # urllib3 decomprime in automatico le risposte gzip/deflate
+        api_client.set_default_header("Accept-Encoding", "gzip, deflate")
+
+    call_api = api_client.call_api
+
+    def call_api_with_timeout(*args, **kwargs):
+        if kwargs.get("_request_timeout") is None:
+            kwargs["_request_timeout"] = (connect_timeout, read_timeout)
+        return call_api(*args, **kwargs)
+
+    api_client.call_api = call_api_with_timeout
+    return api_client
+
+
+def transport_stats(api_client):
+    """Richieste, connessioni aperte e connessioni riusate sui pool urllib3 dell'ApiClient."""
+    stats = {"pools": 0, "requests": 0, "connections": 0, "reused": 0}
+    pool_manager = getattr(getattr(api_client, "rest_client", None), "pool_manager", None)
+    pools = getattr(pool_manager, "pools", None)
+    if pools is None:
+        return stats
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        stats["pools"] += 1
+        stats["requests"] += getattr(pool, "num_requests", 0)
+        stats["connections"] += getattr(pool, "num_connections", 0)
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
+
+
+def log_transport_stats(api_client, log_filename):
+    from globalutils import log
+
+    s = transport_stats(api_client)
+    if s["requests"]:
+        log(f"HTTP: {s['requests']} richieste, {s['connections']} connessioni aperte, "
+            f"{s['reused']} riusi ({s['reused'] * 100 // s['requests']}%)", log_filename, "notice")
@@ -0,0 +1,107 @@
+import re
+from datetime import datetime
+
+from filelocks import atomic_write_json
+
+# Validazione locale delle anagrafiche prima di qualsiasi chiamata API:
+# P.IVA e codice fiscale con checksum, codice SDI, sintassi email/PEC.
+REJECTS_FILE_TEMPLATE = "rejects-{day}.json"
+
+PIVA_RE = re.compile(r"^\d{11}$")
+CF_RE = re.compile(r"^[A-Z]{6}[0-9LMNPQRSTUV]{2}[ABCDEHLMPRST][0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{3}[A-Z]$")
+# 7 caratteri per i privati, 6 per la PA; "0000000" se si usa la PEC
+SDI_RE = re.compile(r"^[A-Z0-9]{6,7}$")
+EMAIL_RE = re.compile(r"^[A-Za-z0-9.!#$%&'*+/=?^_`{|}~-]+@[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?(?:\.[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?)+$")
+
+# valori dei caratteri in posizione dispari (1a, 3a, ...) per il check del CF
+_CF_ODD = dict(zip(
+    "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+    [1, 0, 5, 7, 9, 13, 15, 17, 19, 21,
+     1, 0, 5, 7, 9, 13, 15, 17, 19, 21, 2, 4, 18, 20, 11, 3, 6, 8, 12, 14, 16, 10, 22, 25, 24, 23]
+))
+_CF_EVEN = {**{str(i): i for i in range(10)}, **{chr(65 + i): i for i in range(26)}}
+
+
+def is_valid_piva(vat):
+    if not vat or not PIVA_RE.match(vat):
+        return False
+    digits = [int(c) for c in vat]
+    total = sum(digits[0:10:2])
+    for d in digits[1:10:2]:
+        d *= 2
+        total += d - 9 if d > 9 else d
+    return (10 - total % 10) % 10 == digits[10]
+
+
+def is_valid_codice_fiscale(cf):
+    """Accetta CF persona fisica (16 caratteri) o CF numerico di società (= P.IVA)."""
+    if not cf:
+        return False
+    if len(cf) == 11:
+        return is_valid_piva(cf)
+    if not CF_RE.match(cf):
+        return False
+    total = sum(_CF_ODD[c] for c in cf[0:15:2]) + sum(_CF_EVEN[c] for c in cf[1:15:2])
+    return chr(65 + total % 26) == cf[15]
+
+
+def is_valid_sdi(code):
+    return bool(code) and bool(SDI_RE.match(code))
+
+
+def is_valid_email(email):
+    return bool(email) and len(email) <= 254 and bool(EMAIL_RE.match(email))
+
+
+def _clean(value, upper=False):
+    value = str(value or "").strip()
+    return value.upper() if upper else value
+
+
+def validate_client(client):
+    """Ritorna la lista degli errori del cliente (vuota se valido). I campi opzionali vuoti sono ammessi."""
+    errors = []
+    vat = _clean(client.get("vat_number"))
+    tax_code = _clean(client.get("tax_code"), upper=True)
+    ei_code = _clean(client.get("ei_code"), upper=True)
+    email = _clean(client.get("email"))
+    pec = _clean(client.get("certified_email"))
+
+    if not is_valid_piva(vat):
+        errors.append(f"P.IVA non valida: '{vat}'")
+    if tax_code and not is_valid_codice_fiscale(tax_code):
+        errors.append(f"Codice fiscale non valido: '{tax_code}'")
+    if ei_code and not is_valid_sdi(ei_code):
+        errors.append(f"Codice SDI non valido: '{ei_code}'")
+    if email and not is_valid_email(email):
+        errors.append(f"Email non valida: '{email}'")
+    if pec and not is_valid_email(pec):
+        errors.append(f"PEC non valida: '{pec}'")
+    return errors
+
+
+def validate_clients(clients):
+    """
+    Valida in un solo passaggio tutto il batch estratto.
+    Ritorna (validi, scartati) dove ogni scartato ha code, name, vat_number ed errors.
+    """
+    valid = []
+    rejects = []
+    for c in clients:
+        errors = validate_client(c)
+        if errors:
+            rejects.append({
+                "code": c.get("code"),
+                "name": c.get("name"),
+                "vat_number": c.get("vat_number"),
+                "errors": errors,
+            })
+        else:
+            valid.append(c)
+    return valid, rejects
+
+
+def write_rejects_report(rejects):
+    filename = REJECTS_FILE_TEMPLATE.format(day=datetime.now().strftime("%Y%m%d"))
+    atomic_write_json(filename, rejects, indent=2)
+    return filename
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Ricevitore dei webhook di Fatture in Cloud che tiene aggiornata la cache clienti.
+
+FIC notifica creazione, modifica ed eliminazione dei clienti (formato
+CloudEvents: header ce-id / ce-type, corpo {"data": {"ids": [...]}}).
+Per ogni evento il cliente viene riletto da API e applicato alla cache
+(fic_clients.json) con lo stesso write-back della sync; le eliminazioni
+vengono tolte dalla cache. La cache resta aggiornata fra un download completo
+e l'altro, senza rileggere tutta la lista.
+
+  python webhookReceiver.py                      # ascolta su WEBHOOK_HOST:WEBHOOK_PORT
+  python webhookReceiver.py --replay [--since 2025-01-31]
+  python webhookReceiver.py --send-test update 12345   # evento di prova al ricevitore locale
+
+Ogni evento ricevuto viene scritto nel giornale webhook_events.jsonl prima di
+rispondere a FIC: gli eventi già visti (stesso ce-id) vengono ignorati, quelli
+ricevuti ma non applicati (crash) vengono ripresi all'avvio, e --replay li
+riapplica tutti. Gli eventi falliti vengono ritentati con backoff esponenziale
+(anche dopo un riavvio) fino a RETRY_MAX_ATTEMPTS tentativi; i 4xx permanenti
+non vengono ritentati, come nella dead-letter queue. Con FIC_WEBHOOK_PUBLIC_KEY
+(file PEM) e PyJWT installato viene verificata la firma di FIC.
+"""
+import os
+import json
+import uuid
+import queue
+import argparse
+import threading
+import urllib.request
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from dotenv import load_dotenv
+from globalutils import log, fic_api_client, fic_client_record, write_back_client, remove_cached_client, CLIENTS_FILE
+from deadletter import classify_error
+
+load_dotenv()
+
+log_filename = f"webhook-{datetime.now().strftime('%Y%m%d')}.log"
+
+company_id = int(os.getenv("COMPANY_ID"))
+
+LISTEN_HOST = os.getenv("WEBHOOK_HOST", "localhost")
+LISTEN_PORT = int(os.getenv("WEBHOOK_PORT", "8082"))
+WEBHOOK_PATH = "/webhooks/fic"
+EVENTS_FILE = "webhook_events.jsonl"
+PUBLIC_KEY_FILE = os.getenv("FIC_WEBHOOK_PUBLIC_KEY")
+
+EVENT_PREFIX = "it.fattureincloud.webhooks.entities.clients."
+EVENT_ACTIONS = ("create", "update", "delete")
+
+DATE_FMT = "%Y-%m-%d %H:%M:%S"
+
+# retry degli eventi falliti: 30 s, 1, 2, 4, 8 min ... fino a un'ora, poi si rinuncia
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+RETRY_MAX_ATTEMPTS = 6
+
+_events = queue.Queue()
+
+
+# --- GIORNALE EVENTI ---
+def journal_append(event_id, status, **extra):
+    record = {"ts": datetime.now().strftime(DATE_FMT), "event_id": event_id, "status": status}
+    record.update(extra)
+    with open(EVENTS_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    return record
+
+
+def journal_load():
+    """
+    Ritorna {event_id: {"event": evento ricevuto, "status": ultimo stato, "attempts": tentativi falliti,
+    "next_retry": prossimo retry, "gave_up": True se non va più ritentato}} in ordine di arrivo.
+    """
+    events = {}
+    if not os.path.exists(EVENTS_FILE):
+        return events
+    with open(EVENTS_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # riga finale troncata
+            entry = events.setdefault(record["event_id"], {"event": None, "status": None, "attempts": 0,
+                                                           "next_retry": None, "gave_up": False})
+            if record["status"] == "received":
+                entry["event"] = record
+            elif record["status"] == "failed":
+                entry["attempts"] = record.get("attempt", entry["attempts"] + 1)
+                entry["next_retry"] = record.get("next_retry")
+                entry["gave_up"] = bool(record.get("gave_up"))
+            entry["status"] = record["status"]
+    return events
+
+
+# --- APPLICAZIONE ALLA CACHE ---
+def apply_event(clients_api, event):
+    """Applica un evento alla cache clienti. Ritorna il numero di clienti toccati."""
+    from fattureincloud_python_sdk.rest import ApiException
+
+    if not os.path.exists(CLIENTS_FILE):
+        # senza cache non c'è niente da aggiornare: il prossimo download completo sarà già aggiornato
+        return 0
+
+    touched = 0
+    for client_id in event["ids"]:
+        if event["action"] == "delete":
+            touched += remove_cached_client(None, client_id)
+            continue
+        try:
+            resp = clients_api.get_client(company_id, client_id, fieldset="detailed")
+        except ApiException as e:
+            if e.status == 404:
+                # eliminato dopo la notifica: vale l'ultimo stato
+                touched += remove_cached_client(None, client_id)
+                continue
+            raise
+        write_back_client(None, fic_client_record(resp.data))
+        touched += 1
+    return touched
+
+
+# --- RETRY ---
+def retry_delay(attempts):
+    """Secondi di attesa prima del prossimo tentativo, dopo `attempts` fallimenti."""
+    return min(RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0), RETRY_MAX_SECONDS)
+
+
+def schedule_retry(event, delay):
+    """Rimette l'evento in coda fra `delay` secondi."""
+    timer = threading.Timer(max(delay, 0), _events.put, args=(event,))
+    timer.daemon = True
+    timer.start()
+
+
+def handle_event(clients_api, event):
+    """Applica un evento dalla coda; se fallisce lo registra e, se ritentabile, ne programma il retry."""
+    try:
+        touched = apply_event(clients_api, event)
+    except Exception as e:
+        attempts = event.get("attempts", 0) + 1
+        error_class, _ = classify_error(e)
+        if error_class == "permanent" or attempts >= RETRY_MAX_ATTEMPTS:
+            journal_append(event["event_id"], "failed", attempt=attempts, gave_up=True, error=str(e)[:500])
+            log(f"Evento {event['event_id']} non applicato ({attempts} tentativi, {error_class}): {e}. "
+                f"Non verrà ritentato.", log_filename, "error")
+            return None
+        delay = retry_delay(attempts)
+        next_retry = (datetime.now() + timedelta(seconds=delay)).strftime(DATE_FMT)
+        journal_append(event["event_id"], "failed", attempt=attempts, next_retry=next_retry, error=str(e)[:500])
+        log(f"Evento {event['event_id']} non applicato (tentativo {attempts}): {e}. Retry alle {next_retry}.",
+            log_filename, "warning")
+        schedule_retry(dict(event, attempts=attempts), delay)
+        return None
+    journal_append(event["event_id"], "applied", touched=touched)
+    log(f"Evento {event['action']} {event['ids']} applicato alla cache ({touched} clienti).", log_filename, "notice")
+    return touched
+
+
+def pending_events(journal, now=None):
+    """Eventi del giornale da riprendere all'avvio: [(evento, secondi di attesa)]."""
+    now = now or datetime.now()
+    pending = []
+    for entry in journal.values():
+        event = entry["event"]
+        if not event:
+            continue
+        if entry["status"] == "received":
+            pending.append((event, 0))
+        elif entry["status"] == "failed" and not entry["gave_up"]:
+            # fallimenti registrati prima dei retry (senza next_retry): subito
+            delay = 0
+            if entry["next_retry"]:
+                delay = max((datetime.strptime(entry["next_retry"], DATE_FMT) - now).total_seconds(), 0)
+            pending.append((dict(event, attempts=entry["attempts"]), delay))
+    return pending
+
+
+def worker(clients_api):
+    while True:
+        event = _events.get()
+        try:
+            handle_event(clients_api, event)
+        finally:
+            _events.task_done()
+
+
+# --- SERVER HTTP ---
+def verify_signature(headers):
+    """Verifica il JWT firmato da FIC (header Authorization) se è configurata la chiave pubblica."""
+    if not PUBLIC_KEY_FILE:
+        return True
+    import jwt
+
+    token = (headers.get("Authorization") or "").removeprefix("Bearer ").strip()
+    with open(PUBLIC_KEY_FILE, "r", encoding="utf-8") as f:
+        public_key = f.read()
+    try:
+        jwt.decode(token, public_key, algorithms=["ES256"], options={"verify_aud": False})
+    except jwt.PyJWTError:
+        return False
+    return True
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    seen = set()
+
+    def _reply(self, status, body=None):
+        payload = json.dumps(body or {}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _challenge(self):
+        # verifica della sottoscrizione: FIC si aspetta la challenge nel corpo della risposta
+        challenge = self.headers.get("x-fic-verification-challenge")
+        if challenge is None:
+            return False
+        self._reply(200, {"verification": challenge})
+        return True
+
+    def do_GET(self):
+        if self.path.split("?")[0] != WEBHOOK_PATH or not self._challenge():
+            self._reply(404)
+
+    def do_POST(self):
+        if self.path.split("?")[0] != WEBHOOK_PATH:
+            self._reply(404)
+            return
+        if self._challenge():
+            return
+        if not verify_signature(self.headers):
+            log("Webhook con firma non valida rifiutato.", log_filename, "warning")
+            self._reply(401)
+            return
+
+        event_id = self.headers.get("ce-id")
+        event_type = self.headers.get("ce-type") or ""
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            ids = json.loads(self.rfile.read(length) or b"{}").get("data", {}).get("ids") or []
+        except ValueError:
+            self._reply(400)
+            return
+
+        action = event_type.removeprefix(EVENT_PREFIX)
+        if not event_id or not event_type.startswith(EVENT_PREFIX) or action not in EVENT_ACTIONS:
+            # eventi di altre entità: confermati e ignorati
+            self._reply(200)
+            return
+        if event_id in self.seen:
+            self._reply(200, {"duplicate": True})
+            return
+
+        # nel giornale prima della risposta: un evento confermato a FIC non si perde
+        event = journal_append(event_id, "received", action=action, ids=ids, type=event_type)
+        self.seen.add(event_id)
+        _events.put(event)
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        # silenzia log HTTP
+        return
+
+
+def serve(host=LISTEN_HOST, port=LISTEN_PORT):
+    import fattureincloud_python_sdk
+
+    journal = journal_load()
+    WebhookHandler.seen = set(journal)
+    pending = pending_events(journal)
+
+    with fic_api_client() as api_client:
+        clients_api = fattureincloud_python_sdk.ClientsApi(api_client)
+        threading.Thread(target=worker, args=(clients_api,), daemon=True).start()
+        if pending:
+            log(f"Riprendo {len(pending)} eventi ricevuti o falliti e non applicati.", log_filename, "notice")
+            for event, delay in pending:
+                if delay:
+                    schedule_retry(event, delay)
+                else:
+                    _events.put(event)
+
+        httpd = HTTPServer((host, port), WebhookHandler)
+        log(f"Ricevitore webhook in ascolto su http://{host}:{port}{WEBHOOK_PATH}", log_filename, "notice")
+        print(f"In ascolto su http://{host}:{port}{WEBHOOK_PATH}")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            _events.join()
+
+
+def replay(since=None):
+    """Riapplica gli eventi del giornale (dal giorno `since` 'YYYY-MM-DD' se indicato)."""
+    import fattureincloud_python_sdk
+
+    events = [e["event"] for e in journal_load().values()
+              if e["event"] and (since is None or e["event"]["ts"] >= since)]
+    with fic_api_client() as api_client:
+        clients_api = fattureincloud_python_sdk.ClientsApi(api_client)
+        for event in events:
+            touched = apply_event(clients_api, event)
+            journal_append(event["event_id"], "applied", touched=touched, replay=True)
+    print(f"Riapplicati {len(events)} eventi.")
+    log(f"Replay webhook: riapplicati {len(events)} eventi.", log_filename, "notice")
+
+
+def send_test_event(action, ids, url=None):
+    """Generatore locale: invia al ricevitore un evento come lo invierebbe FIC."""
+    url = url or f"http://{LISTEN_HOST}:{LISTEN_PORT}{WEBHOOK_PATH}"
+    request = urllib.request.Request(
+        url,
+        data=json.dumps({"data": {"ids": ids}}).encode("utf-8"),
+        method="POST",
+        headers={
+            "Content-Type": "application/json",
+            "ce-id": str(uuid.uuid4()),
+            "ce-type": EVENT_PREFIX + action,
+            "ce-source": "https://api-v2.fattureincloud.it",
+            "ce-specversion": "1.0",
+            "ce-subject": f"company:{company_id}",
+            "ce-time": datetime.now().astimezone().isoformat(),
+        },
+    )
+    with urllib.request.urlopen(request, timeout=10) as resp:
+        print(resp.status, resp.read().decode("utf-8"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ricevitore webhook FIC per la cache clienti")
+    parser.add_argument("--replay", action="store_true", help="riapplica gli eventi del giornale")
+    parser.add_argument("--since", metavar="YYYY-MM-DD", help="con --replay: solo gli eventi da questa data")
+    parser.add_argument("--send-test", nargs="+", metavar=("AZIONE", "ID"),
+                        help="invia un evento di prova al ricevitore locale (create|update|delete seguito dagli id)")
+    parser.add_argument("--url", help="con --send-test: URL del ricevitore")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.send_test:
+        action, *ids = args.send_test
+        if action not in EVENT_ACTIONS or not ids:
+            raise SystemExit("Uso: --send-test create|update|delete ID [ID ...]")
+        send_test_event(action, [int(i) for i in ids], args.url)
+    elif args.replay:
+        replay(args.since)
+    else:
+        serve()